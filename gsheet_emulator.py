@@ -0,0 +1,417 @@
+import os
+import re
+import time
+import random
+import threading
+from collections import deque, Counter
+from gspread.exceptions import APIError, WorksheetNotFound
+from gspread.cell import Cell
+from gspread.utils import numericise_all
+
+# ==========================================
+# Googleスプレッドシートのローカル代替（オフライン試験・ベンチマーク用）
+# ==========================================
+# kakeibo.py / schedule_gsheet.py が使う gspread の範囲だけをメモリ上で再現する。
+# 1呼び出しごとの遅延・ランダムなエラー・分あたりクォータ超過(429)を注入できるので、
+# 保存方式の改善をネットワークなしで再現性のある形で測れる。
+#
+# 環境変数 GSHEET_EMULATOR=1 で各アプリがこちらを使う。
+#   GSHEET_EMULATOR_LATENCY       1呼び出しの遅延（秒）
+#   GSHEET_EMULATOR_JITTER        遅延に足すゆらぎの上限（秒）
+#   GSHEET_EMULATOR_ERROR_RATE    500エラーを返す確率 (0〜1)
+#   GSHEET_EMULATOR_READS_PER_MIN / GSHEET_EMULATOR_WRITES_PER_MIN  分あたりクォータ
+#   GSHEET_EMULATOR_SEED          乱数シード
+#   GSHEET_EMULATOR_FRESH_OBJECTS 1 にすると本物の gspread と同じく、開くたびに別のブック / ワークシートのオブジェクトを返す
+#                                 （中身は共有。オブジェクトの同一性に頼ったキャッシュやロックの誤りを見つける用）
+
+READ_METHODS = {"get", "get_all_values", "get_all_records", "acell", "cell", "col_values", "row_values", "batch_get", "worksheets", "get_worksheet", "worksheet"}
+
+
+class _FakeResponse:
+    """gspread の APIError が期待するレスポンスの最小限の形"""
+
+    def __init__(self, code, status, message):
+        self.status_code = code
+        self._payload = {"error": {"code": code, "status": status, "message": message}}
+        self.text = message
+
+    def json(self):
+        return self._payload
+
+
+def _api_error(code, status, message):
+    return APIError(_FakeResponse(code, status, message))
+
+
+# --- A1表記の解釈 ---
+def _col_to_index(letters):
+    n = 0
+    for ch in letters.upper():
+        n = n * 26 + (ord(ch) - ord('A') + 1)
+    return n
+
+
+def _parse_a1(range_name):
+    """'A1' / 'A2:E' / 'B3:C10' / 'A:A' を (開始行, 開始列, 終了行|None, 終了列|None) に変換（1始まり）"""
+    if '!' in range_name:
+        range_name = range_name.split('!', 1)[1]
+    parts = range_name.split(':')
+    m = re.fullmatch(r'([A-Za-z]*)(\d*)', parts[0])
+    start_col = _col_to_index(m.group(1)) if m.group(1) else 1
+    start_row = int(m.group(2)) if m.group(2) else 1
+    if len(parts) == 1:
+        return start_row, start_col, start_row, start_col
+    m = re.fullmatch(r'([A-Za-z]*)(\d*)', parts[1])
+    end_col = _col_to_index(m.group(1)) if m.group(1) else None
+    end_row = int(m.group(2)) if m.group(2) else None
+    return start_row, start_col, end_row, end_col
+
+
+def _user_entered(value):
+    """USER_ENTERED の時、数値に見える文字列は数値として保存される"""
+    if isinstance(value, str):
+        try:
+            return int(value)
+        except ValueError:
+            try:
+                return float(value)
+            except ValueError:
+                return value
+    return value
+
+
+def _formatted(value):
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    return str(value)
+
+
+class EmulatorWorksheet:
+    def __init__(self, spreadsheet, title, rows, cols, sheet_id):
+        self.spreadsheet = spreadsheet
+        self.spreadsheet_id = spreadsheet.id
+        self.title = title
+        self.id = sheet_id
+        self.row_count = int(rows)
+        self.col_count = int(cols)
+        self._cells = []  # 行のリスト（行ごとに値のリスト）
+
+    def _call(self, method, fn):
+        return self.spreadsheet.client._call(method, fn)
+
+    # --- 内部ヘルパー（ロック内で呼ぶ） ---
+    def _last_row(self):
+        for i in range(len(self._cells) - 1, -1, -1):
+            if any(v not in (None, "") for v in self._cells[i]):
+                return i + 1
+        return 0
+
+    def _set(self, row, col, value):
+        while len(self._cells) < row:
+            self._cells.append([])
+        line = self._cells[row - 1]
+        while len(line) < col:
+            line.append("")
+        line[col - 1] = value
+        self.row_count = max(self.row_count, row)
+        self.col_count = max(self.col_count, col)
+
+    def _write_block(self, start_row, start_col, values, value_input_option):
+        convert = _user_entered if value_input_option == 'USER_ENTERED' else (lambda v: v)
+        for r, line in enumerate(values):
+            for c, v in enumerate(line):
+                self._set(start_row + r, start_col + c, convert(v))
+
+    def _read_block(self, range_name):
+        start_row, start_col, end_row, end_col = _parse_a1(range_name)
+        end_row = end_row or len(self._cells)
+        result = []
+        for r in range(start_row, min(end_row, len(self._cells)) + 1):
+            line = self._cells[r - 1]
+            stop = min(end_col, len(line)) if end_col else len(line)
+            values = [_formatted(v) for v in line[start_col - 1:stop]]
+            # API と同じく末尾の空セルは返さない
+            while values and values[-1] == "":
+                values.pop()
+            result.append(values)
+        while result and not result[-1]:
+            result.pop()
+        return result
+
+    # --- 読み込み ---
+    def get_all_values(self, **kwargs):
+        return self._call('get_all_values', lambda: [[_formatted(v) for v in line] for line in self._cells[:self._last_row()]])
+
+    def get(self, range_name=None, **kwargs):
+        return self._call('get', lambda: self._read_block(range_name or 'A1:ZZZ'))
+
+    def batch_get(self, ranges, **kwargs):
+        return self._call('batch_get', lambda: [self._read_block(r) for r in ranges])
+
+    def get_all_records(self, head=1, **kwargs):
+        def read():
+            values = [[_formatted(v) for v in line] for line in self._cells[:self._last_row()]]
+            if len(values) < head:
+                return []
+            keys = values[head - 1]
+            records = []
+            for line in values[head:]:
+                line = numericise_all(line + [""] * (len(keys) - len(line)), empty2zero=False, default_blank="")
+                records.append(dict(zip(keys, line)))
+            return records
+        return self._call('get_all_records', read)
+
+    def acell(self, label, **kwargs):
+        def read():
+            row, col, _, _ = _parse_a1(label)
+            values = self._read_block(label)
+            value = values[0][0] if values and values[0] else None
+            return Cell(row, col, value)
+        return self._call('acell', read)
+
+    def cell(self, row, col, **kwargs):
+        def read():
+            line = self._cells[row - 1] if row <= len(self._cells) else []
+            value = _formatted(line[col - 1]) if col <= len(line) else None
+            return Cell(row, col, value or None)
+        return self._call('cell', read)
+
+    def col_values(self, col, **kwargs):
+        def read():
+            values = [_formatted(line[col - 1]) if col <= len(line) else "" for line in self._cells]
+            while values and values[-1] == "":
+                values.pop()
+            return values
+        return self._call('col_values', read)
+
+    def row_values(self, row, **kwargs):
+        return self._call('row_values', lambda: [_formatted(v) for v in self._cells[row - 1]] if row <= len(self._cells) else [])
+
+    # --- 書き込み ---
+    def update(self, values=None, range_name=None, value_input_option=None, **kwargs):
+        # 旧API update('A1', [[...]]) の引数順にも対応
+        if isinstance(values, str) and not isinstance(range_name, str):
+            values, range_name = range_name, values
+        if not isinstance(values, list) or (values and not isinstance(values[0], list)):
+            values = [[values]]
+
+        def write():
+            start_row, start_col, _, _ = _parse_a1(range_name or 'A1')
+            self._write_block(start_row, start_col, values, value_input_option)
+            return {"updatedRange": f"{self.title}!{range_name or 'A1'}"}
+        return self._call('update', write)
+
+    def batch_update(self, data, value_input_option=None, **kwargs):
+        def write():
+            for item in data:
+                start_row, start_col, _, _ = _parse_a1(item["range"])
+                self._write_block(start_row, start_col, item["values"], value_input_option)
+            return {"totalUpdatedRanges": len(data)}
+        return self._call('batch_update', write)
+
+    def update_acell(self, label, value):
+        def write():
+            row, col, _, _ = _parse_a1(label)
+            self._set(row, col, _user_entered(value))
+        return self._call('update_acell', write)
+
+    def update_cell(self, row, col, value):
+        return self._call('update_cell', lambda: self._set(row, col, _user_entered(value)))
+
+    def append_row(self, values, value_input_option='RAW', **kwargs):
+        return self.append_rows([values], value_input_option=value_input_option)
+
+    def append_rows(self, values, value_input_option='RAW', **kwargs):
+        def write():
+            start = self._last_row() + 1
+            self._write_block(start, 1, values, value_input_option)
+            return {"updates": {"updatedRows": len(values)}}
+        return self._call('append_rows', write)
+
+    def clear(self):
+        def write():
+            self._cells = []
+        return self._call('clear', write)
+
+    def update_title(self, title):
+        def write():
+            self.title = title
+        return self._call('update_title', write)
+
+    def resize(self, rows=None, cols=None):
+        def write():
+            if rows is not None:
+                self.row_count = int(rows)
+                del self._cells[int(rows):]
+            if cols is not None:
+                self.col_count = int(cols)
+        return self._call('resize', write)
+
+
+class EmulatorSpreadsheet:
+    def __init__(self, client, key):
+        self.client = client
+        self.id = key
+        self._worksheets = []
+        self._next_sheet_id = 0
+        self._new_worksheet("Sheet1", 1000, 26)
+
+    def _new_worksheet(self, title, rows, cols):
+        ws = EmulatorWorksheet(self, title, rows, cols, self._next_sheet_id)
+        self._next_sheet_id += 1
+        self._worksheets.append(ws)
+        return ws
+
+    @property
+    def sheet1(self):
+        return self.get_worksheet(0)
+
+    def worksheets(self, **kwargs):
+        return self.client._call('worksheets', lambda: [self.client._handle(ws) for ws in self._worksheets])
+
+    def get_worksheet(self, index):
+        def read():
+            if 0 <= index < len(self._worksheets):
+                return self.client._handle(self._worksheets[index])
+            raise WorksheetNotFound(f"index {index} not found")
+        return self.client._call('get_worksheet', read)
+
+    def worksheet(self, title):
+        def read():
+            for ws in self._worksheets:
+                if ws.title == title:
+                    return self.client._handle(ws)
+            raise WorksheetNotFound(title)
+        return self.client._call('worksheet', read)
+
+    def add_worksheet(self, title, rows, cols, index=None):
+        def write():
+            if any(ws.title == title for ws in self._worksheets):
+                raise _api_error(400, "INVALID_ARGUMENT", f'A sheet with the name "{title}" already exists.')
+            ws = self._new_worksheet(title, rows, cols)
+            if index is not None:
+                self._worksheets.remove(ws)
+                self._worksheets.insert(index, ws)
+            return self.client._handle(ws)
+        return self.client._call('add_worksheet', write)
+
+    def del_worksheet(self, worksheet):
+        def write():
+            self._worksheets[:] = [ws for ws in self._worksheets if ws.id != worksheet.id]
+        return self.client._call('del_worksheet', write)
+
+
+class EmulatorClient:
+    """gspread.Client の代わり。遅延・エラー・クォータの注入と呼び出し統計を持つ"""
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, reads_per_minute=None, writes_per_minute=None, seed=None,
+                 fresh_objects=False):
+        self.latency = latency
+        self.fresh_objects = fresh_objects
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.reads_per_minute = reads_per_minute
+        self.writes_per_minute = writes_per_minute
+        self._rng = random.Random(seed)
+        self._lock = threading.RLock()
+        self._spreadsheets = {}
+        self._read_times = deque()
+        self._write_times = deque()
+        self.stats = Counter()
+
+    def open_by_key(self, key):
+        # 存在しないキーは空のブックとして作る（オフラインで初回から動かせるように）
+        with self._lock:
+            if key not in self._spreadsheets:
+                self._spreadsheets[key] = EmulatorSpreadsheet(self, key)
+            return self._handle(self._spreadsheets[key])
+
+    def _handle(self, obj):
+        # fresh_objects の時は中身（__dict__）を共有する別のオブジェクトを返す
+        if not self.fresh_objects:
+            return obj
+        handle = object.__new__(type(obj))
+        handle.__dict__ = obj.__dict__
+        return handle
+
+    def reset_stats(self):
+        with self._lock:
+            self.stats = Counter()
+
+    def _check_quota(self, is_read, now):
+        times = self._read_times if is_read else self._write_times
+        limit = self.reads_per_minute if is_read else self.writes_per_minute
+        while times and now - times[0] >= 60:
+            times.popleft()
+        if limit is not None and len(times) >= limit:
+            kind = "Read" if is_read else "Write"
+            raise _api_error(429, "RESOURCE_EXHAUSTED", f"Quota exceeded for quota metric '{kind} requests' and limit '{kind} requests per minute per user'")
+        times.append(now)
+
+    def _call(self, method, fn):
+        is_read = method in READ_METHODS
+        # 遅延はロックの外で待つ（本物と同じく呼び出し同士は並行に進む）
+        with self._lock:
+            delay = self.latency + (self._rng.uniform(0, self.jitter) if self.jitter else 0)
+            fail = self.error_rate and self._rng.random() < self.error_rate
+        if delay:
+            time.sleep(delay)
+
+        with self._lock:
+            self.stats[method] += 1
+            self.stats["reads" if is_read else "writes"] += 1
+            try:
+                self._check_quota(is_read, time.monotonic())
+            except APIError:
+                self.stats["quota_errors"] += 1
+                raise
+            if fail:
+                self.stats["injected_errors"] += 1
+                raise _api_error(500, "INTERNAL", "Internal error encountered.")
+            return fn()
+
+
+_default_client = None
+_default_lock = threading.Lock()
+
+
+def is_enabled():
+    return os.environ.get('GSHEET_EMULATOR', '') not in ('', '0')
+
+
+def get_client():
+    """プロセス全体で共有するエミュレータ（環境変数で設定）を返す"""
+    global _default_client
+    with _default_lock:
+        if _default_client is None:
+            def env(name, cast):
+                val = os.environ.get(name)
+                return cast(val) if val else None
+            _default_client = EmulatorClient(
+                latency=env('GSHEET_EMULATOR_LATENCY', float) or 0.0,
+                jitter=env('GSHEET_EMULATOR_JITTER', float) or 0.0,
+                error_rate=env('GSHEET_EMULATOR_ERROR_RATE', float) or 0.0,
+                reads_per_minute=env('GSHEET_EMULATOR_READS_PER_MIN', int),
+                writes_per_minute=env('GSHEET_EMULATOR_WRITES_PER_MIN', int),
+                seed=env('GSHEET_EMULATOR_SEED', int),
+                fresh_objects=bool(env('GSHEET_EMULATOR_FRESH_OBJECTS', int)),
+            )
+        return _default_client
+
+
+if __name__ == "__main__":
+    # 簡易ベンチマーク: 1件ずつの追記と一括追記の比較（1呼び出し 50ms の遅延）
+    client = EmulatorClient(latency=0.05, seed=0)
+    ws = client.open_by_key("bench").sheet1
+    rows = [["2026-01-01", "食費", f"メモ{i}", "口座", 100 + i] for i in range(100)]
+
+    t0 = time.perf_counter()
+    for r in rows:
+        ws.append_row(r, value_input_option='USER_ENTERED')
+    t1 = time.perf_counter()
+    ws.append_rows(rows, value_input_option='USER_ENTERED')
+    t2 = time.perf_counter()
+    print(f"append_row x{len(rows)}: {t1 - t0:.2f}s / append_rows x1: {t2 - t1:.3f}s")
+    print(dict(client.stats))
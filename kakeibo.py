@@ -4,12 +4,30 @@ import gspread
 from google.oauth2.service_account import Credentials
 import os
 import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import kakeibo_mirror
+import kakeibo_import
+import kakeibo_log
+import kakeibo_search
+import kakeibo_budget
+import gsheet_emulator
+import sheets_scheduler
 
 # --- クラウド設定 ---
 SHEET_ID = '1oj76xzUj-Z7iBp-eLLc9DZ8fgxpchDM3fuWa-SfEFzk'
 
+# --- 支出の大分類（あなたがカスタマイズした大分類） ---
+EXPENSE_CATEGORIES = ['食費', '交通費', '宿泊費','趣味費', '経費','特定支出','自己投資', 'その他']
+
 # --- Googleスプレッドシート連携関数（ブック全体を取得） ---
+# 認証とブックを開く処理はプロセス全体で1回だけ（呼び出しのたびに開き直すと、同時の読み込みもまとまらない）
+@st.cache_resource
 def get_spreadsheet():
+    # オフライン試験・ベンチマーク用のローカル代替
+    if gsheet_emulator.is_enabled():
+        return sheets_scheduler.open_by_key(gsheet_emulator.get_client(), SHEET_ID)
+
     scopes = [
         'https://www.googleapis.com/auth/spreadsheets',
         'https://www.googleapis.com/auth/drive'
@@ -20,15 +38,18 @@ def get_spreadsheet():
         credentials = Credentials.from_service_account_info(dict(st.secrets["gcp_service_account"]), scopes=scopes)
     
     gc = gspread.authorize(credentials)
-    return gc.open_by_key(SHEET_ID)
+    # 以降のシート操作はすべてクォータ管理付きのスケジューラを通す
+    return sheets_scheduler.open_by_key(gc, SHEET_ID)
 
 # --- 残高データ（1枚目のシート）の読み込み ---
+# 1枚目のシートは 媒体ID → 表示名・残高 の対応表も兼ねる（ログは媒体IDで記録する）
 def load_balance_data():
     sh = get_spreadsheet()
     ws = sh.get_worksheet(0) # 1枚目のシートを取得
     data = ws.get_all_records()
     if not data:
         df = pd.DataFrame({
+            'ID': ['M1', 'M2', 'M3', 'M4'],
             '媒体': ['口座', 'PayPay', 'マナカ', 'Suica'],
             '残高': [0, 0, 0, 0]
         })
@@ -37,31 +58,189 @@ def load_balance_data():
     else:
         df = pd.DataFrame(data)
         df['残高'] = pd.to_numeric(df['残高'], errors='coerce').fillna(0).astype(int)
-        return df
+        if 'ID' not in df.columns:
+            df = migrate_medium_ids(sh, df)
+        df['ID'] = df['ID'].astype(str)
+        return df[['ID', '媒体', '残高']]
+
+# --- 新しい媒体ID（M + 連番）を払い出す ---
+def new_medium_id(df):
+    numbers = pd.to_numeric(df['ID'].astype(str).str.lstrip('M'), errors='coerce').dropna()
+    return f"M{int(numbers.max()) + 1 if len(numbers) else 1}"
+
+# --- 媒体名だけだった頃のシートにIDを振り、ログの対象媒体もIDに置き換える ---
+# 途中で失敗しても続きからやり直せるように、次の順で進める。
+#  1. ログに出てくる媒体名をすべて対応表に登録し、ID列の見出しを「ID(移行中)」にして残高シートを保存
+#  2. ログを媒体IDの形に書き換える（書き換え済みのパーティションは飛ばす）
+#  3. 見出しを「ID」にして保存（ここで移行完了）
+# 見出しが「ID」になるまでは、次に開いた時も保存済みの対応表で 2 から続ける
+MIGRATING_ID_HEADER = 'ID(移行中)'
+
+def migrate_medium_ids(sh, df):
+    if MIGRATING_ID_HEADER in df.columns:
+        df = df.rename(columns={MIGRATING_ID_HEADER: 'ID'})
+        df['ID'] = df['ID'].astype(str)
+    else:
+        df.insert(0, 'ID', [f"M{i + 1}" for i in range(len(df))])
+
+    def resolve(name):
+        nonlocal df
+        hit = df.loc[df['媒体'] == name, 'ID']
+        if len(hit):
+            return hit.iloc[0]
+        # 改名・削除済みでログにしか残っていない媒体も、残高0で対応表に登録しておく
+        medium_id = new_medium_id(df)
+        df = pd.concat([df, pd.DataFrame({'ID': [medium_id], '媒体': [name], '残高': [0]})], ignore_index=True)
+        return medium_id
+
+    def save_mapping():
+        save_balance_data(df.rename(columns={'ID': MIGRATING_ID_HEADER}))
+
+    kakeibo_log.migrate_media_columns(sh, resolve, before_write=save_mapping)
+    save_balance_data(df)
+    return df
 
 # --- 残高データ（1枚目のシート）の保存 ---
+# 消してから書くと、書き込みに失敗した時に残高と媒体IDの対応表が消える。
+# 今ある行の上に1回の update で上書きし、減った媒体の古い行も同じ呼び出しで空白にする
 def save_balance_data(df):
     sh = get_spreadsheet()
     ws = sh.get_worksheet(0)
-    ws.clear() 
     data_to_write = [df.columns.values.tolist()] + df.values.tolist()
+    data_to_write += [[''] * len(df.columns) for _ in range(len(ws.col_values(1)) - len(data_to_write))]
     # 【修正】数値をそのまま数値として記録するためにオプションを追加
-    ws.update(values=data_to_write, value_input_option='USER_ENTERED') 
+    ws.update(range_name='A1', values=data_to_write, value_input_option='USER_ENTERED') 
 
-# --- ログ（2枚目のシート）への追記関数 ---
-def append_transaction_log(date, category, memo, medium, amount):
+# --- 残高の差分反映（変わった媒体の残高セルだけを書き換える） ---
+def apply_balance_deltas(deltas):
+    df = load_balance_data()
+    # 対応表に無い媒体IDがあれば、どれも書かずに失敗させる（残高が変わらないまま保存済みに見えないように）
+    unknown = [medium_id for medium_id in deltas if medium_id not in set(df['ID'])]
+    if unknown:
+        raise KeyError(f"残高シートに無い媒体IDです: {', '.join(unknown)}")
+    updates = []
+    for medium_id, delta in deltas.items():
+        rows = df.index[df['ID'] == medium_id]
+        # ヘッダーが1行目なので、DataFrame の i 行目はシートの i+2 行目（残高はC列）
+        new_balance = int(df.loc[rows[0], '残高'] + delta)
+        updates.append({"range": f"C{rows[0] + 2}", "values": [[new_balance]]})
+    if updates:
+        get_spreadsheet().get_worksheet(0).batch_update(updates, value_input_option='USER_ENTERED')
+
+# --- 媒体名の変更（対応表の1セルだけを書き換える。ログはIDなので触らない） ---
+def rename_medium(df, medium_id, new_name):
+    row = df.index[df['ID'] == medium_id][0]
+    get_spreadsheet().get_worksheet(0).update_cell(int(row) + 2, 2, new_name)
+
+# --- ログ（年別シート）への追記関数 ---
+def append_transaction_log(date, category, memo, from_id, to_id, amount):
+    # 日付の年のシート（トランザクションログ_2026 など）に追記し、ログ索引を更新する
+    # シートは本当に存在しない時だけ作成する（通信エラーや429では作らない）
+    # 同じ流れで月次集計にも足し込む（予算超過の判定はこの集計だけを読む）
+    append_transaction_logs([[str(date), category, memo, from_id, to_id, amount]])
+
+# --- ログへの一括追記（明細取り込み用。年ごとに1回のAPI呼び出しでまとめて書く） ---
+def append_transaction_logs(rows):
+    # 集計への足し込みはログが書けた後のベストエフォート（失敗したら作り直しの印を立てる）
+    kakeibo_budget.append_with_aggregates(get_spreadsheet(), rows, kakeibo_log.append_log_rows)
+
+# --- 明細取り込みの1バッチ分を確定させる（ログを書いてから、そのバッチ分の残高を反映する） ---
+def commit_import_batch(rows, deltas):
+    append_transaction_logs(rows)
+    try:
+        with get_balance_lock():
+            apply_balance_deltas(deltas)
+    except Exception as e:
+        # ログは書けているので、再取り込みでは入らない。残高に未反映の分として画面から足せるようにする
+        raise kakeibo_import.BalancePending(e) from e
+
+# --- 今月の予算と支出合計（登録が保存されたら読み直す） ---
+@st.cache_data(ttl=60)
+def load_budget_status(month):
     sh = get_spreadsheet()
-    
-    # 2枚目のシート（インデックス1）を取得。無ければ自動作成する。
+    return kakeibo_budget.load_budgets(sh), kakeibo_budget.load_month_totals(sh, month)
+
+# --- 月次集計をミラーから作り直す ---
+def rebuild_month_totals():
+    # ミラーの同期と読み込みは集計のロックの中で行う（その間に追記された分を取りこぼさない）
+    def load_log():
+        sync_log_mirror()
+        return kakeibo_mirror.load_mirror()
+    n = kakeibo_budget.rebuild_aggregates(get_spreadsheet(), load_log)
+    load_budget_status.clear()
+    return n
+
+# --- ログのローカルミラーを差分同期 ---
+def sync_log_mirror(full=False):
+    sh = get_spreadsheet()
+    index = kakeibo_log.load_index(sh)
+    return kakeibo_mirror.sync_mirror(sh, index, full=full)
+
+# --- ミラーからの集計（ミラーの世代・同期済み行数が変わった時だけ再計算） ---
+@st.cache_data(max_entries=4)
+def load_spending_pivots(mirror_key, medium_names):
+    df_log = kakeibo_mirror.load_mirror()
+    return kakeibo_mirror.monthly_by_category(df_log), kakeibo_mirror.monthly_by_medium(df_log, dict(medium_names))
+
+# --- 媒体ごとの履歴用の索引（ミラーの世代・同期済み行数が変わった時だけ作り直す） ---
+# ログ全体を持つので、古い世代・行数の分は残さない
+@st.cache_resource(max_entries=1)
+def load_medium_index(mirror_key):
+    df_log = kakeibo_mirror.load_mirror()
+    return df_log, kakeibo_mirror.build_medium_index(df_log)
+
+# --- メモ検索の索引（プロセス全体で共有し、ミラーに増えた行だけ追加で索引づけ） ---
+@st.cache_resource
+def get_search_index():
+    return kakeibo_search.MemoSearchIndex()
+
+# --- 書き込み用のスレッドプール（プロセス全体で共有、同時実行数を制限） ---
+@st.cache_resource
+def get_io_executor():
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix='kakeibo-io')
+
+# --- 残高シートの読み書きを直列化するロック（同時に複数の登録が走っても差分が消えないように） ---
+@st.cache_resource
+def get_balance_lock():
+    return threading.Lock()
+
+# --- 1件の登録をシートに反映する（スレッドプール上で実行） ---
+def commit_entry(deltas, log_row, balance_lock, balance_written):
+    # 先にログを書く（ここで失敗したら何も書いていないので、そのまま失敗として扱う）
+    append_transaction_log(*log_row)
+    # ログが書けてから、画面上の古い残高ではなく最新の残高に差分を足して保存する。
+    # 書けたことは残高を読む画面側と同じロックの中で記録する（反映済みの残高に二重に上乗せしないように）
     try:
-        ws_log = sh.get_worksheet(1)
-    except Exception:
-        ws_log = sh.add_worksheet(title="トランザクションログ", rows="1000", cols="5")
-        # ヘッダー行を作成
-        ws_log.append_row(["日付", "大分類", "小分類・メモ", "対象媒体", "金額"], value_input_option='USER_ENTERED')
-        
-    # 【修正】日付が文字列扱いになって ' がつくのを防ぐためにオプションを追加
-    ws_log.append_row([str(date), category, memo, medium, amount], value_input_option='USER_ENTERED')
+        with balance_lock:
+            apply_balance_deltas(deltas)
+            balance_written.set()
+    except Exception as e:
+        raise RuntimeError(f'ログは保存しましたが、残高の更新に失敗しました（{e}）') from e
+
+# --- 登録をバックグラウンドに送り、画面には先に反映する（楽観的更新） ---
+def submit_entry(label, deltas, log_row):
+    balance_written = threading.Event()
+    future = get_io_executor().submit(commit_entry, deltas, log_row, get_balance_lock(), balance_written)
+    st.session_state.entries.append({"label": label, "deltas": deltas, "log_row": log_row, "future": future,
+                                     "balance_written": balance_written, "notified": False})
+
+def entry_status(entry):
+    future = entry["future"]
+    if not future.done():
+        return 'pending'
+    return 'failed' if future.exception() is not None else 'committed'
+
+# --- 保存状況の一覧は直近の分だけ残す（保存中と、まだ知らせていない失敗は消さない） ---
+MAX_FINISHED_ENTRIES = 10
+
+def prune_entries(entries):
+    finished = [e for e in entries if entry_status(e) == 'committed' or (entry_status(e) == 'failed' and e["notified"])]
+    dropped = {id(e) for e in finished[:-MAX_FINISHED_ENTRIES]}
+    return [e for e in entries if id(e) not in dropped]
+
+# --- Sheets API のエラー表示（再試行しても失敗した時） ---
+def show_sheets_error(e):
+    st.error(f'スプレッドシートへの保存に失敗しました。時間をおいてもう一度お試しください。（{e}）')
 
 
 # ==========================================
@@ -69,10 +248,67 @@ def append_transaction_log(date, category, memo, medium, amount):
 # ==========================================
 
 # --- アプリ起動時にデータ読み込み ---
-df_balances = load_balance_data()
+if 'entries' not in st.session_state:
+    st.session_state.entries = []
+st.session_state.entries = prune_entries(st.session_state.entries)
+
+# --- 残高がまだシートに書かれていない登録は、シートの残高に上乗せして表示する ---
+# 残高の読み込みと「書かれたか」の判定は、書き込み側と同じロックの中で行う
+with get_balance_lock():
+    df_balances = load_balance_data()
+    pending_entries = [e for e in st.session_state.entries if entry_status(e) == 'pending']
+    unwritten_entries = [e for e in pending_entries if not e["balance_written"].is_set()]
+for entry in unwritten_entries:
+    for medium_id, delta in entry["deltas"].items():
+        df_balances.loc[df_balances['ID'] == medium_id, '残高'] += delta
+
+# フォームでは表示名で選び、記録には媒体IDを使う
+medium_ids = dict(zip(df_balances['媒体'], df_balances['ID']))
+medium_names = dict(zip(df_balances['ID'], df_balances['媒体']))
+
+# --- 今月の予算と支出合計（集計シートが無い・足し込みに失敗していた時はミラーから作る） ---
+this_month = kakeibo_budget.month_key(datetime.date.today())
+budgets, month_totals = load_budget_status(this_month)
+if month_totals is None or kakeibo_budget.aggregates_stale():
+    rebuild_month_totals()
+    budgets, month_totals = load_budget_status(this_month)
+month_totals = dict(month_totals)
+# 保存中の支出も残高と同じように上乗せしておく
+for entry in pending_entries:
+    log_date, log_category, amount = entry["log_row"][0], entry["log_row"][1], entry["log_row"][5]
+    if log_category in EXPENSE_CATEGORIES and kakeibo_budget.month_key(log_date) == this_month:
+        month_totals[log_category] = month_totals.get(log_category, 0) + amount
 
 st.title('家計簿 ＆ 総資産ダッシュボード')
 
+# --- 登録の保存状況（保存中の間だけ1秒ごとに部分更新） ---
+@st.fragment(run_every=1 if pending_entries else None)
+def show_entry_status():
+    entries = st.session_state.entries
+    if not entries:
+        return
+    still_pending = False
+    needs_rerun = False
+    for entry in reversed(entries[-10:]):
+        status = entry_status(entry)
+        if status == 'pending':
+            still_pending = True
+            st.info(f"⏳ 保存中: {entry['label']}")
+        elif status == 'committed':
+            st.caption(f"✅ 保存済み: {entry['label']}")
+        else:
+            st.error(f"❌ 保存失敗: {entry['label']}（{entry['future'].exception()}）")
+            if not entry["notified"]:
+                entry["notified"] = True
+                needs_rerun = True
+    # 失敗があった時（上乗せをやめる）と、保存中が無くなった時（更新を止める）は全体を再描画
+    if needs_rerun or (pending_entries and not still_pending):
+        load_budget_status.clear()
+        st.rerun()
+
+with st.expander('📝 登録の保存状況', expanded=bool(pending_entries)):
+    show_entry_status()
+
 # --- 1. 収入の入力セクション ---
 st.header('👛 収入の登録')
 with st.form(key='income_form'):
@@ -90,12 +326,15 @@ with st.form(key='income_form'):
     if submit_income:
         if income_amount > 0:
             df_balances.loc[df_balances['媒体'] == selected_medium_inc, '残高'] += income_amount
-            save_balance_data(df_balances)
             
-            # 収入ログを追記
-            append_transaction_log(income_date, "収入", income_memo, selected_medium_inc, income_amount)
+            # 残高の更新と収入ログの追記はバックグラウンドで行う
+            submit_entry(
+                f'収入 {selected_medium_inc} +{income_amount:,}円 {income_memo}',
+                {medium_ids[selected_medium_inc]: income_amount},
+                (income_date, "収入", income_memo, "", medium_ids[selected_medium_inc], income_amount),
+            )
             
-            st.success(f'{selected_medium_inc}に {income_amount:,}円 を足し算し、ログに記録しました！')
+            st.success(f'{selected_medium_inc}に {income_amount:,}円 を足し算しました（ログに保存中…）')
         else:
             st.warning('収入金額を入力してください。')
 
@@ -108,7 +347,7 @@ with st.form(key='expense_form'):
     with col1:
         expense_date = st.date_input('日付', datetime.date.today())
         # あなたがカスタマイズした大分類を適用
-        expense_category = st.selectbox('大分類', ['食費', '交通費', '宿泊費','趣味費', '経費','特定支出','自己投資', 'その他'])
+        expense_category = st.selectbox('大分類', EXPENSE_CATEGORIES)
     with col2:
         medium_list = df_balances['媒体'].tolist()
         selected_medium = st.selectbox('支払い媒体を選択', medium_list)
@@ -122,12 +361,22 @@ with st.form(key='expense_form'):
         if expense_amount > 0:
             # 1. 残高から引き算してSheet1を更新
             df_balances.loc[df_balances['媒体'] == selected_medium, '残高'] -= expense_amount
-            save_balance_data(df_balances)
             
-            # 2. 支出ログをSheet2に追記
-            append_transaction_log(expense_date, expense_category, expense_memo, selected_medium, expense_amount)
+            # 2. Sheet1の更新と支出ログの追記はバックグラウンドで行う
+            submit_entry(
+                f'{expense_category} {selected_medium} -{expense_amount:,}円 {expense_memo}',
+                {medium_ids[selected_medium]: -expense_amount},
+                (expense_date, expense_category, expense_memo, medium_ids[selected_medium], "", expense_amount),
+            )
             
-            st.success(f'{selected_medium}から {expense_amount:,}円 を引き算し、支出ログに記録しました！')
+            st.success(f'{selected_medium}から {expense_amount:,}円 を引き算しました（ログに保存中…）')
+
+            # 今月の予算を超えたら知らせる
+            budget = budgets.get(expense_category, 0)
+            if budget > 0 and kakeibo_budget.month_key(expense_date) == this_month:
+                spent = month_totals.get(expense_category, 0) + expense_amount
+                if spent > budget:
+                    st.warning(f'⚠️ {expense_category}が今月の予算を超えました（{spent:,} / {budget:,} 円）')
         else:
             st.warning('支出金額を入力してください。')
 
@@ -157,13 +406,76 @@ with st.form(key='transfer_form'):
             # 1. 移動元から引き算、移動先に足し算
             df_balances.loc[df_balances['媒体'] == from_medium, '残高'] -= transfer_amount
             df_balances.loc[df_balances['媒体'] == to_medium, '残高'] += transfer_amount
-            save_balance_data(df_balances)
             
-            # 2. 証跡としてログに記録（対象媒体を「元→先」と表記）
-            log_medium_str = f"{from_medium} → {to_medium}"
-            append_transaction_log(transfer_date, "振替", transfer_memo, log_medium_str, transfer_amount)
+            # 2. 証跡としてログに記録（元媒体ID・先媒体IDの両方を入れる）。保存はバックグラウンドで行う
+            from_id, to_id = medium_ids[from_medium], medium_ids[to_medium]
+            submit_entry(
+                f'振替 {from_medium} → {to_medium} {transfer_amount:,}円',
+                {from_id: -transfer_amount, to_id: transfer_amount},
+                (transfer_date, "振替", transfer_memo, from_id, to_id, transfer_amount),
+            )
             
-            st.success(f'【振替完了】{from_medium} から {to_medium} へ {transfer_amount:,}円 を移動し、ログに記録しました。')
+            st.success(f'【振替】{from_medium} から {to_medium} へ {transfer_amount:,}円 を移動しました（ログに保存中…）')
+
+st.divider()
+
+# --- 3-2. 📥 明細CSVの一括取り込み ---
+st.header('📥 明細CSVの一括取り込み')
+with st.form(key='import_form'):
+    col1, col2 = st.columns(2)
+    with col1:
+        import_source = st.selectbox('明細の種類', list(kakeibo_import.IMPORT_SOURCES.keys()))
+    with col2:
+        medium_list = df_balances['媒体'].tolist()
+        import_medium = st.selectbox('この明細の媒体', medium_list, key='import_medium_select')
+    statement_file = st.file_uploader('明細CSVファイル', type=['csv'])
+    submit_import = st.form_submit_button(label='取り込んで残高に反映する')
+
+    if submit_import:
+        if statement_file is None:
+            st.warning('明細CSVファイルを選択してください。')
+        else:
+            try:
+                # 既存ログと突き合わせるため、先にミラーを最新にして内容ハッシュの索引を作る
+                sync_log_mirror()
+                hash_index = kakeibo_import.build_hash_index(kakeibo_mirror.load_mirror())
+
+                # ログと残高はバッチごとに確定させる（途中で失敗しても、確定したバッチは両方そろって残る）
+                with st.spinner('明細を取り込んでいます...'):
+                    imported, skipped, deltas = kakeibo_import.import_statement(
+                        statement_file, import_source, medium_ids[import_medium], hash_index, commit_import_batch
+                    )
+
+                for medium_id, delta in deltas.items():
+                    df_balances.loc[df_balances['ID'] == medium_id, '残高'] += delta
+                st.success(f'{imported:,} 件を取り込みました（重複 {skipped:,} 件はスキップ）。')
+            except kakeibo_import.ImportInterrupted as e:
+                for medium_id, delta in e.deltas.items():
+                    df_balances.loc[df_balances['ID'] == medium_id, '残高'] += delta
+                message = f'{e.imported:,} 件まではログと残高に反映しました。'
+                if e.pending:
+                    # ログには入った分（再取り込みでは重複として飛ばされる）の残高は、下のボタンで反映する
+                    pending = st.session_state.setdefault('pending_import_deltas', {})
+                    for medium_id, delta in e.pending_deltas.items():
+                        pending[medium_id] = pending.get(medium_id, 0) + delta
+                    message += f'続く {e.pending:,} 件はログに保存しましたが、残高には未反映です（下の「残高に反映する」で反映できます）。'
+                st.error(f'{message}残りは保存できませんでした。同じ明細をもう一度取り込むと、続きから入ります。（{e.error}）')
+            except gspread.exceptions.APIError as e:
+                show_sheets_error(e)
+
+# --- 取り込みでログには入ったが、残高に未反映の増減 ---
+if st.session_state.get('pending_import_deltas'):
+    pending = st.session_state.pending_import_deltas
+    st.warning('ログには保存済みで、残高に未反映の取り込みがあります: '
+               + ' / '.join(f'{medium_names.get(medium_id, medium_id)} {delta:+,}円' for medium_id, delta in pending.items()))
+    if st.button('残高に反映する', key='apply_pending_import'):
+        try:
+            with get_balance_lock():
+                apply_balance_deltas(pending)
+            del st.session_state.pending_import_deltas
+            st.rerun()
+        except Exception as e:
+            st.error(f'❌ 残高の更新に失敗しました（{e}）。もう一度押してください。')
 
 st.divider()
 
@@ -176,15 +488,21 @@ with st.form(key='add_medium_form'):
     submit_medium = st.form_submit_button(label='残高を保存する')
 
     if submit_medium and new_medium:
-        if new_medium in df_balances['媒体'].values:
-            df_balances.loc[df_balances['媒体'] == new_medium, '残高'] = initial_balance
-            st.success(f'{new_medium} の残高を {initial_balance:,}円 に更新しました。')
-        else:
-            new_row = pd.DataFrame({'媒体': [new_medium], '残高': [initial_balance]})
-            df_balances = pd.concat([df_balances, new_row], ignore_index=True)
-            st.success(f'新しく {new_medium} を登録しました。')
-        
-        save_balance_data(df_balances)
+        try:
+            ws_balance = get_spreadsheet().get_worksheet(0)
+            if new_medium in df_balances['媒体'].values:
+                row = df_balances.index[df_balances['媒体'] == new_medium][0]
+                df_balances.loc[row, '残高'] = initial_balance
+                ws_balance.update_cell(int(row) + 2, 3, initial_balance)
+                st.success(f'{new_medium} の残高を {initial_balance:,}円 に更新しました。')
+            else:
+                new_id = new_medium_id(df_balances)
+                new_row = pd.DataFrame({'ID': [new_id], '媒体': [new_medium], '残高': [initial_balance]})
+                df_balances = pd.concat([df_balances, new_row], ignore_index=True)
+                ws_balance.append_row([new_id, new_medium, initial_balance], value_input_option='USER_ENTERED')
+                st.success(f'新しく {new_medium} を登録しました。')
+        except gspread.exceptions.APIError as e:
+            show_sheets_error(e)
 
 st.divider()
 
@@ -203,9 +521,13 @@ with st.form(key='edit_medium_form'):
         elif new_medium_name in df_balances['媒体'].values:
             st.warning(f'「{new_medium_name}」はすでに存在します。別の名前を入力してください。')
         else:
-            df_balances.loc[df_balances['媒体'] == old_medium, '媒体'] = new_medium_name
-            save_balance_data(df_balances)
-            st.success(f'「{old_medium}」を「{new_medium_name}」に変更しました。')
+            try:
+                # 対応表の名前セルを1つ書き換えるだけ（ログは媒体IDなので履歴はそのままつながる）
+                rename_medium(df_balances, medium_ids[old_medium], new_medium_name)
+                df_balances.loc[df_balances['媒体'] == old_medium, '媒体'] = new_medium_name
+                st.success(f'「{old_medium}」を「{new_medium_name}」に変更しました。')
+            except gspread.exceptions.APIError as e:
+                show_sheets_error(e)
 
 st.divider()
 
@@ -218,3 +540,141 @@ st.subheader(f'💰 総資産: {total_assets:,} 円')
 st.write('**【各媒体の残高】**')
 for index, row in df_balances.iterrows():
     st.text(f"・{row['媒体']}: {row['残高']:,} 円")
+
+st.divider()
+
+# --- 6-2. 今月の予算（月次集計シートから） ---
+st.header('🎯 今月の予算')
+
+if not any(budgets.get(c, 0) > 0 for c in EXPENSE_CATEGORIES):
+    st.caption('予算はまだ設定されていません。下の「予算の設定」から大分類ごとの月予算を入れてください。')
+for category in EXPENSE_CATEGORIES:
+    budget = budgets.get(category, 0)
+    if budget <= 0:
+        continue
+    spent = month_totals.get(category, 0)
+    st.progress(min(spent / budget, 1.0), text=f'{category}: {spent:,} / {budget:,} 円')
+    if spent > budget:
+        st.warning(f'⚠️ {category}は予算を {spent - budget:,} 円 超えています')
+
+with st.expander('⚙️ 予算の設定'):
+    df_budget = pd.DataFrame({'大分類': EXPENSE_CATEGORIES, '月予算': [budgets.get(c, 0) for c in EXPENSE_CATEGORIES]})
+    edited_budget = st.data_editor(
+        df_budget, hide_index=True, use_container_width=True, disabled=['大分類'],
+        column_config={'月予算': st.column_config.NumberColumn('月予算（円）', min_value=0, step=1000)},
+        key='budget_editor',
+    )
+    col1, col2 = st.columns(2)
+    if col1.button('予算を保存'):
+        try:
+            kakeibo_budget.save_budgets(get_spreadsheet(), dict(zip(edited_budget['大分類'], edited_budget['月予算'].fillna(0).astype(int))))
+            load_budget_status.clear()
+            st.success('予算を保存しました。')
+            st.rerun()
+        except gspread.exceptions.APIError as e:
+            show_sheets_error(e)
+    # 集計がログとずれた時（シートを手で直した時など）用
+    if col2.button('♻️ 月次集計を作り直す'):
+        n = rebuild_month_totals()
+        st.toast(f'{n} 件の月次集計をログから作り直しました')
+        st.rerun()
+
+st.divider()
+
+# --- 7. 支出分析（ローカルミラーから集計） ---
+st.header('📈 支出分析')
+
+# セッション開始時と、ボタンが押された時だけシートと差分同期する
+if 'mirror_synced' not in st.session_state:
+    sync_log_mirror()
+    st.session_state.mirror_synced = True
+
+col1, col2 = st.columns(2)
+if col1.button('🔄 ログを同期'):
+    added = sync_log_mirror()
+    st.toast(f'{added} 件の新しいログを取り込みました')
+if col2.button('♻️ ミラーを作り直す'):
+    added = sync_log_mirror(full=True)
+    st.toast(f'{added} 件のログからミラーを再構築しました')
+
+# ミラーは作り直すと行数が同じでも中身が変わるので、キャッシュは (世代, 行数) で見分ける
+mirror_key = kakeibo_mirror.mirror_key(kakeibo_mirror.load_meta())
+mirror_generation, synced_rows = mirror_key
+pivot_category, pivot_medium = load_spending_pivots(mirror_key, tuple(sorted(medium_names.items())))
+
+if pivot_category.empty:
+    st.caption('まだ支出ログがありません。')
+else:
+    st.caption(f'同期済みログ: {synced_rows:,} 件')
+    st.subheader('月別 × 大分類')
+    st.bar_chart(pivot_category)
+    st.dataframe(pivot_category, use_container_width=True)
+
+    st.subheader('月別 × 支払い媒体')
+    st.bar_chart(pivot_medium)
+    st.dataframe(pivot_medium, use_container_width=True)
+
+# --- 媒体ごとの入出金履歴（媒体IDの索引から引く） ---
+with st.expander('🏦 媒体ごとの履歴'):
+    history_medium = st.selectbox('媒体を選択', df_balances['媒体'].tolist(), key='history_medium_select')
+    df_log_all, medium_index = load_medium_index(mirror_key)
+    df_history = kakeibo_mirror.medium_history(df_log_all, medium_index, medium_ids[history_medium])
+    if df_history.empty:
+        st.caption('この媒体のログはありません。')
+    else:
+        df_history = df_history.assign(
+            元媒体=df_history['元媒体ID'].map(medium_names).fillna(''),
+            先媒体=df_history['先媒体ID'].map(medium_names).fillna(''),
+        )
+        st.dataframe(df_history[['日付', '大分類', '小分類・メモ', '元媒体', '先媒体', '増減']], use_container_width=True)
+
+# --- ログ検索（メモ・大分類・媒体名から探して合計を出す） ---
+with st.expander('🔎 ログ検索'):
+    search_query = st.text_input('検索語（例: ポケカ、カメラ関連）', key='search_query')
+    col1, col2 = st.columns(2)
+    search_range = col1.date_input('期間（任意）', value=[], key='search_range')
+    search_categories = col2.multiselect('大分類で絞り込み（任意）', ['収入', '振替'] + EXPENSE_CATEGORIES, key='search_categories')
+
+    if search_query:
+        df_log_all, medium_index = load_medium_index(mirror_key)
+        # 媒体名に一致した場合は、その媒体のログも一致扱いにする
+        matched_ids = [mid for name, mid in medium_ids.items() if kakeibo_search.normalize(search_query) in kakeibo_search.normalize(name)]
+        medium_rows = [row for mid in matched_ids for row in medium_index.get(mid, [])]
+        search_start, search_end = (search_range[0], search_range[1]) if len(search_range) == 2 else (None, None)
+        hits, hits_total = kakeibo_search.search(
+            get_search_index(), df_log_all, mirror_generation, search_query,
+            start=search_start, end=search_end, categories=search_categories, medium_rows=medium_rows,
+        )
+        st.write(f'**{len(hits):,} 件 / 合計 {hits_total:,} 円**')
+        if not hits.empty:
+            hits = hits.assign(
+                元媒体=hits['元媒体ID'].map(medium_names).fillna(''),
+                先媒体=hits['先媒体ID'].map(medium_names).fillna(''),
+            )
+            st.dataframe(hits[['日付', '大分類', '小分類・メモ', '元媒体', '先媒体', '金額']].head(200), use_container_width=True)
+
+# --- 期間を指定してログを表示（必要な年のシートだけを読む） ---
+with st.expander('🔍 期間を指定してログを表示'):
+    with st.form(key='log_query_form'):
+        today = datetime.date.today()
+        query_range = st.date_input('期間', value=[today.replace(day=1), today], key='log_query_range')
+        submit_query = st.form_submit_button(label='ログを表示')
+
+    if submit_query and len(query_range) == 2:
+        try:
+            log_rows = kakeibo_log.read_log(get_spreadsheet(), query_range[0], query_range[1])
+            if log_rows:
+                n_cols = len(kakeibo_log.LOG_HEADER)
+                df_query = pd.DataFrame([(r + [""] * n_cols)[:n_cols] for r in log_rows], columns=kakeibo_log.LOG_HEADER)
+                df_query['元媒体ID'] = df_query['元媒体ID'].map(medium_names).fillna('')
+                df_query['先媒体ID'] = df_query['先媒体ID'].map(medium_names).fillna('')
+                df_query = df_query.rename(columns={'元媒体ID': '元媒体', '先媒体ID': '先媒体'})
+                st.dataframe(df_query, use_container_width=True)
+            else:
+                st.caption('この期間のログはありません。')
+        except gspread.exceptions.APIError as e:
+            show_sheets_error(e)
+
+# --- API 呼び出しの状況（クォータで待たされた・再試行した回数など） ---
+with st.expander('🔧 API呼び出し状況'):
+    st.json(sheets_scheduler.get_scheduler().metrics())
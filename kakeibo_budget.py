@@ -0,0 +1,234 @@
+import threading
+from collections import Counter
+from gspread.exceptions import WorksheetNotFound
+import kakeibo_log
+
+# ==========================================
+# 大分類ごとの月予算と月次集計
+# ==========================================
+# 「月次集計」シートに 月 × 大分類 の支出合計を持っておき、ログを追記するたびに
+# 該当するセルだけ差分で足し込む。予算超過の判定はこの小さなシートだけを読めば済む。
+# 集計がずれた時は、ローカルミラーから丸ごと作り直せる。
+# 足し込みはログの追記が成功した後のベストエフォートで、失敗してもログは残し、
+# 「作り直しが必要」の印を立てる（次の画面表示で作り直す）。
+
+BUDGET_TITLE = "予算"
+BUDGET_HEADER = ["大分類", "月予算"]
+AGG_TITLE = "月次集計"
+AGG_HEADER = ["月", "大分類", "合計"]
+
+# 支出として集計しない大分類
+NON_EXPENSE_CATEGORIES = ["収入", "振替"]
+
+# 集計シートの読み書きはスレッドプールから同時に走るので直列化する。
+# ログの追記 + 足し込みと、作り直し（ログの読み込み + 書き込み）も同じロックで直列化する
+_aggregate_lock = threading.Lock()
+# 足し込みに失敗して集計がログとずれている印
+_stale = threading.Event()
+
+
+def _find_worksheet(sh, title):
+    try:
+        return sh.worksheet(title)
+    except WorksheetNotFound:
+        return None
+
+
+def _get_or_create(sh, title, header):
+    ws = _find_worksheet(sh, title)
+    if ws is None:
+        ws = sh.add_worksheet(title=title, rows="100", cols=str(len(header)))
+        ws.append_row(header, value_input_option='RAW')
+    return ws
+
+
+def _overwrite(ws, rows):
+    """シート全体を rows に置き換える
+
+    消してから書くと、書き込みに失敗した時にシートが空になる。今ある行の上に1回の update で上書きし、
+    新しい行数を超える古い行も同じ呼び出しで空白にするので、失敗した時は書く前のまま残る。
+    """
+    width = max(len(row) for row in rows)
+    rows = rows + [[""] * width for _ in range(len(ws.col_values(1)) - len(rows))]
+    if len(rows) > ws.row_count:
+        ws.resize(rows=len(rows))
+    ws.update(range_name='A1', values=rows, value_input_option='RAW')
+
+
+def month_key(date):
+    return f"{date.year}-{date.month:02d}"
+
+
+# --- 予算 ---
+def load_budgets(sh):
+    """{大分類: 月予算} を返す。予算シートが無ければ空"""
+    ws = _find_worksheet(sh, BUDGET_TITLE)
+    if ws is None:
+        return {}
+    budgets = {}
+    for row in ws.get_all_values()[1:]:
+        if len(row) >= 2 and row[0]:
+            budgets[row[0]] = int(str(row[1]).replace(',', '') or 0)
+    return budgets
+
+
+def save_budgets(sh, budgets):
+    ws = _get_or_create(sh, BUDGET_TITLE, BUDGET_HEADER)
+    _overwrite(ws, [BUDGET_HEADER] + [[category, int(amount)] for category, amount in budgets.items()])
+
+
+# --- 月次集計 ---
+def load_month_totals(sh, month):
+    """指定月の {大分類: 支出合計} を返す。集計シートがまだ無ければ None"""
+    ws = _find_worksheet(sh, AGG_TITLE)
+    if ws is None:
+        return None
+    totals = {}
+    for row in ws.get_all_values()[1:]:
+        if len(row) >= 3 and row[0] == month:
+            totals[row[1]] = int(str(row[2]).replace(',', '') or 0)
+    return totals
+
+
+def aggregates_stale():
+    """足し込みに失敗して、集計を作り直す必要があるか"""
+    return _stale.is_set()
+
+
+def _increments(rows):
+    increments = Counter()
+    for row in rows:
+        d = kakeibo_log._row_date(row[0])
+        if d is None or row[1] in NON_EXPENSE_CATEGORIES:
+            continue
+        increments[(month_key(d), row[1])] += int(row[5])
+    return increments
+
+
+def _add_increments(sh, increments):
+    """集計シートの該当セルに足し込む（_aggregate_lock の中で呼ぶ）"""
+    if not increments:
+        return
+    ws = _get_or_create(sh, AGG_TITLE, AGG_HEADER)
+    positions = {}
+    for row_no, row in enumerate(ws.get_all_values()[1:], start=2):
+        if len(row) >= 3:
+            positions[(row[0], row[1])] = (row_no, int(str(row[2]).replace(',', '') or 0))
+
+    updates = []
+    new_rows = []
+    for (month, category), amount in sorted(increments.items()):
+        if (month, category) in positions:
+            row_no, current = positions[(month, category)]
+            updates.append({"range": f"C{row_no}", "values": [[current + amount]]})
+        else:
+            new_rows.append([month, category, amount])
+    # 月は '2026-01' のまま文字列で残したいので RAW で書く
+    if updates:
+        ws.batch_update(updates, value_input_option='RAW')
+    if new_rows:
+        ws.append_rows(new_rows, value_input_option='RAW')
+
+
+def add_to_aggregates(sh, rows):
+    """追記したログ行（[日付, 大分類, メモ, 元媒体ID, 先媒体ID, 金額]）の分だけ集計を足し込む"""
+    increments = _increments(rows)
+    with _aggregate_lock:
+        _add_increments(sh, increments)
+
+
+def append_with_aggregates(sh, rows, append_log=kakeibo_log.append_log_rows):
+    """ログを追記し、成功したら集計に足し込む。ログの追記に失敗した時だけ例外を投げる
+
+    集計の足し込みに失敗してもログは巻き戻さず、作り直しが必要な印を立てるだけにする。
+    """
+    increments = _increments(rows)
+    with _aggregate_lock:
+        append_log(sh, rows)
+        try:
+            _add_increments(sh, increments)
+        except Exception as e:
+            print(f"Log: 月次集計の足し込みに失敗しました（次の表示で作り直します）: {e}")
+            _stale.set()
+
+
+def rebuild_aggregates(sh, load_log):
+    """全ログから月次集計を作り直す（シートへの書き込みは1回だけ）
+
+    load_log はログの DataFrame（ミラー）を返す関数。集計のロックの中で呼ぶので、
+    読み込みから書き込みまでの間に追記・足し込みが割り込んで消えることはない。
+    """
+    with _aggregate_lock:
+        df_log = load_log()
+        exp = df_log[~df_log["大分類"].isin(NON_EXPENSE_CATEGORIES) & df_log["日付"].notna()]
+        totals = exp.groupby([exp["日付"].dt.strftime('%Y-%m'), exp["大分類"]])["金額"].sum()
+        rows = [AGG_HEADER] + [[month, category, int(amount)] for (month, category), amount in totals.items()]
+        ws = _get_or_create(sh, AGG_TITLE, AGG_HEADER)
+        _overwrite(ws, rows)
+        _stale.clear()
+    return len(rows) - 1
+
+
+if __name__ == "__main__":
+    import gsheet_emulator
+    import kakeibo_mirror
+    from gspread.exceptions import APIError
+
+    def load_log(sh):
+        return kakeibo_mirror.normalize_log_rows(kakeibo_log.read_log(sh))
+
+    def log_totals(sh):
+        df = load_log(sh)
+        exp = df[~df["大分類"].isin(NON_EXPENSE_CATEGORIES)]
+        return {k: int(v) for k, v in exp.groupby([exp["日付"].dt.strftime('%Y-%m'), exp["大分類"]])["金額"].sum().items()}
+
+    def sheet_totals(sh):
+        return {(r[0], r[1]): int(r[2]) for r in sh.worksheet(AGG_TITLE).get_all_values()[1:]}
+
+    # 集計の足し込みに失敗しても、ログは残って作り直しの印が立つ（ログと残高が食い違ったままにならない）
+    client = gsheet_emulator.EmulatorClient(latency=0)
+    sh = client.open_by_key('budget')
+    append_with_aggregates(sh, [["2026-03-01", "食費", "昼", "M1", "", 800]])
+    ws_agg = sh.worksheet(AGG_TITLE)
+
+    def unavailable(*args, **kwargs):
+        raise gsheet_emulator._api_error(503, "UNAVAILABLE", "The service is currently unavailable.")
+    ws_agg.batch_update = unavailable
+    append_with_aggregates(sh, [["2026-03-02", "食費", "夜", "M1", "", 1200]])
+    assert len(kakeibo_log.read_log(sh)) == 2 and aggregates_stale()
+    assert load_month_totals(sh, "2026-03") == {"食費": 800}
+    del ws_agg.batch_update
+    rebuild_aggregates(sh, lambda: load_log(sh))
+    assert not aggregates_stale() and load_month_totals(sh, "2026-03") == {"食費": 2000}
+
+    # 作り直しと追記が同時に走っても、足し込みが消えたり二重になったりしない
+    client.latency = 0.002
+    def writer(w):
+        for j in range(20):
+            append_with_aggregates(sh, [[f"2026-0{3 + j % 2}-{j + 1:02d}", "交通費", f"電車{w}", "M2", "", 100 + w]])
+    threads = [threading.Thread(target=writer, args=(w,)) for w in range(4)]
+    for t in threads:
+        t.start()
+    n_rebuilds = 0
+    while any(t.is_alive() for t in threads):
+        rebuild_aggregates(sh, lambda: load_log(sh))
+        n_rebuilds += 1
+    for t in threads:
+        t.join()
+    assert sheet_totals(sh) == log_totals(sh), (sheet_totals(sh), log_totals(sh))
+    print(f"足し込みの失敗 → 作り直し: OK / 追記 {4 * 20}件と同時に作り直し {n_rebuilds}回: 集計はログと一致 {sheet_totals(sh)}")
+
+    # 予算の保存は1回の上書き: 失敗しても前の予算が残り、減った大分類の行は空白になる
+    save_budgets(sh, {"食費": 30000, "交通費": 8000, "趣味費": 5000})
+    ws_budget = sh.worksheet(BUDGET_TITLE)
+    ws_budget.update = unavailable
+    try:
+        save_budgets(sh, {"食費": 25000})
+        raise AssertionError("予算の保存の失敗が伝わっていない")
+    except APIError:
+        pass
+    assert load_budgets(sh) == {"食費": 30000, "交通費": 8000, "趣味費": 5000}
+    del ws_budget.update
+    save_budgets(sh, {"食費": 25000})
+    assert load_budgets(sh) == {"食費": 25000} and len(ws_budget.col_values(1)) == 2
+    print(f"予算の保存に失敗 → 前の予算が残る / 上書き後: {load_budgets(sh)}")
@@ -0,0 +1,308 @@
+import io
+import re
+import csv
+import codecs
+import hashlib
+import datetime
+from collections import Counter
+
+# ==========================================
+# 明細CSVの一括取り込み
+# ==========================================
+# 銀行・PayPay・交通系ICカードの明細CSVを1行ずつ読み、
+# 取り込み元ごとのマッパーで家計簿ログと同じ形
+# (日付, 大分類, 小分類・メモ, 元媒体ID, 先媒体ID, 金額) に変換する。
+# 重複は内容ハッシュの索引で弾くので、期間が重なる明細を再取り込みしても安全。
+# 書き込みは batch_size 件ずつ「ログ + そのバッチ分の残高」をまとめて確定させるので、
+# 途中で失敗しても、それまでのバッチはログと残高がそろった状態で残る（続きは再取り込みで入る）。
+# ログは書けたのに残高の反映だけ失敗したバッチは、再取り込みでは重複として飛ばされるので、
+# 「残高に未反映の増減」として別に返し、画面から残高にだけ足せるようにする。
+
+BATCH_SIZE = 500
+
+
+class BalancePending(Exception):
+    """write_batch が投げる: そのバッチのログは書けたが、残高の反映に失敗した"""
+
+    def __init__(self, error):
+        super().__init__(str(error))
+        self.error = error
+
+
+class ImportInterrupted(Exception):
+    """途中のバッチの書き込みに失敗した。imported 件（deltas の分の残高を含む）までは確定済み。
+    pending 件はログには書けたが残高は未反映（pending_deltas を残高に足せばそろう。取り込み直しでは入らない）"""
+
+    def __init__(self, imported, skipped, deltas, error, pending=0, pending_deltas=None):
+        super().__init__(f"{imported:,} 件を取り込んだところで失敗しました（{error}）")
+        self.imported = imported
+        self.skipped = skipped
+        self.deltas = deltas
+        self.error = error
+        self.pending = pending
+        self.pending_deltas = pending_deltas or {}
+
+
+def _pick(row, *names):
+    """候補の列名のうち最初に見つかった値を返す（明細の種類で列名の揺れがあるため）"""
+    for name in names:
+        val = row.get(name)
+        if val is not None and str(val).strip() != "":
+            return str(val).strip()
+    return ""
+
+
+def _yen(text):
+    """'1,200' や '¥1,200' や '-200' を整数の円に変換する"""
+    text = re.sub(r'[,¥￥円\s]', '', text or "")
+    if not text or text in ('-', '－'):
+        return 0
+    try:
+        return int(float(text))
+    except ValueError:
+        return 0
+
+
+def _parse_date(text):
+    """'2026/1/5 12:34'、'2026-01-05'、'2026年1月5日'、'20260105' などを日付にする"""
+    m = re.match(r'\s*(\d{4})\D?(\d{1,2})\D?(\d{1,2})', text or "")
+    if not m:
+        return None
+    try:
+        return datetime.date(int(m.group(1)), int(m.group(2)), int(m.group(3)))
+    except ValueError:
+        return None
+
+
+# --- 取り込み元ごとのマッパー ---
+# 1行(dict)を受け取り、(日付, 大分類, メモ, 入出金の向き付き金額) を返す。対象外の行は None。
+
+def _map_bank(row):
+    date = _parse_date(_pick(row, '日付', '取引日', 'お取引日', '年月日'))
+    memo = _pick(row, '摘要', 'お取引内容', '取引内容', '内容')
+    out_amount = _yen(_pick(row, 'お引出し', 'お支払金額', '出金', '出金金額', '支払金額'))
+    in_amount = _yen(_pick(row, 'お預入れ', 'お預り金額', '入金', '入金金額', '預入金額'))
+    if date is None:
+        return None
+    if in_amount > 0:
+        return date, "収入", memo, in_amount
+    if out_amount > 0:
+        return date, "その他", memo, -out_amount
+    return None
+
+
+def _map_paypay(row):
+    date = _parse_date(_pick(row, '取引日', '日時', '日付'))
+    content = _pick(row, '取引内容')
+    partner = _pick(row, '取引先')
+    memo = f"{content} {partner}".strip()
+    out_amount = _yen(_pick(row, '出金金額（円）', '出金金額(円)', '出金金額'))
+    in_amount = _yen(_pick(row, '入金金額（円）', '入金金額(円)', '入金金額'))
+    if date is None:
+        return None
+    if in_amount > 0:
+        return date, "収入", memo, in_amount
+    if out_amount > 0:
+        return date, "その他", memo, -out_amount
+    return None
+
+
+def _map_ic_card(row):
+    date = _parse_date(_pick(row, '日付', '利用日', '年月日'))
+    kind = _pick(row, '種別', '利用種別', '処理')
+    route = " → ".join(s for s in [_pick(row, '入場駅', '利用駅', '入場'), _pick(row, '出場駅', '出場')] if s)
+    memo = " ".join(s for s in [kind, route] if s)
+    diff = _yen(_pick(row, '差額', '金額', '利用額'))
+    if date is None or diff == 0:
+        return None
+    if diff > 0:
+        return date, "収入", memo or "チャージ", diff
+    # 運賃・物販は交通費として扱う
+    return date, "交通費", memo, diff
+
+
+IMPORT_SOURCES = {
+    "銀行口座": _map_bank,
+    "PayPay": _map_paypay,
+    "交通系ICカード": _map_ic_card,
+}
+
+
+# --- CSV の読み込み（ファイル全体をメモリに載せない） ---
+def iter_statement_rows(binary_file):
+    """アップロードされたバイナリのCSVを1行ずつ dict で返す。UTF-8 / Shift_JIS を自動判別"""
+    head = binary_file.read(4096)
+    binary_file.seek(0)
+    try:
+        # 4096バイト目で UTF-8 の文字が切れていても、続きがある前提（final=False）なら UTF-8 と判定できる
+        codecs.getincrementaldecoder('utf-8-sig')().decode(head, final=False)
+        encoding = 'utf-8-sig'
+    except UnicodeDecodeError:
+        encoding = 'cp932'
+    text = io.TextIOWrapper(binary_file, encoding=encoding, errors='replace', newline='')
+    try:
+        for row in csv.DictReader(text):
+            yield {(k or "").strip(): v for k, v in row.items()}
+    finally:
+        # アップロードファイル本体を閉じないように切り離す
+        text.detach()
+
+
+def iter_transactions(binary_file, source, medium_id):
+    """明細CSVをログ行 [日付, 大分類, メモ, 元媒体ID, 先媒体ID, 金額] と残高の増減の組に変換して流す"""
+    mapper = IMPORT_SOURCES[source]
+    for row in iter_statement_rows(binary_file):
+        mapped = mapper(row)
+        if mapped is None:
+            continue
+        date, category, memo, signed_amount = mapped
+        # 入金はこの媒体が「先」、出金はこの媒体が「元」
+        from_id, to_id = ("", medium_id) if signed_amount > 0 else (medium_id, "")
+        yield [str(date), category, memo, from_id, to_id, abs(signed_amount)], signed_amount
+
+
+# --- 重複判定用の内容ハッシュ ---
+def row_hash(date, category, memo, from_id, to_id, amount):
+    fields = [str(date), str(category), str(memo), str(from_id), str(to_id)]
+    key = "\x1f".join([f.strip() for f in fields] + [str(int(amount))])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def build_hash_index(df_log):
+    """既存ログ（ミラーの DataFrame）から 内容ハッシュ → 件数 の索引を作る"""
+    if df_log.empty:
+        return Counter()
+    dates = df_log["日付"].dt.strftime('%Y-%m-%d').fillna("")
+    return Counter(
+        row_hash(d, c, m, f, t, a)
+        for d, c, m, f, t, a in zip(dates, df_log["大分類"], df_log["小分類・メモ"], df_log["元媒体ID"], df_log["先媒体ID"], df_log["金額"])
+    )
+
+
+def import_statement(binary_file, source, medium_id, hash_index, write_batch, batch_size=BATCH_SIZE):
+    """明細を流し込み、重複を除いた行を batch_size 件ずつ write_batch(ログ行, {媒体ID: 残高の増減}) に渡す。
+
+    write_batch はそのバッチのログと残高をまとめて確定させる。途中で例外になったら、
+    それまでに確定したバッチの件数と増減を持った ImportInterrupted を投げる。
+    ログは書けて残高だけ失敗した時は write_batch が BalancePending を投げ、そのバッチは pending に入る。
+    同じ日に同額の電車賃が2回あるような正当な重複もあるので、
+    ハッシュごとの出現回数で比較する（既存ログにある回数までは重複とみなす）。
+    戻り値: (取り込み件数, 重複スキップ件数, {媒体ID: 残高の増減})
+    """
+    seen = Counter()
+    deltas = Counter()
+    batch = []
+    imported = 0
+    skipped = 0
+
+    def commit(batch):
+        batch_deltas = Counter()
+        for _, signed_amount, _, _ in batch:
+            batch_deltas[medium_id] += signed_amount
+        def mark_logged():
+            # ログに書けた行だけを索引に反映する（同じセッションでの再取り込み対策）
+            for _, _, h, n in batch:
+                hash_index[h] = max(hash_index[h], n)
+
+        try:
+            write_batch([log_row for log_row, _, _, _ in batch], dict(batch_deltas))
+        except BalancePending as e:
+            mark_logged()
+            raise ImportInterrupted(imported, skipped, dict(deltas), e.error, len(batch), dict(batch_deltas)) from e
+        except Exception as e:
+            raise ImportInterrupted(imported, skipped, dict(deltas), e) from e
+        deltas.update(batch_deltas)
+        mark_logged()
+        return len(batch)
+
+    for log_row, signed_amount in iter_transactions(binary_file, source, medium_id):
+        h = row_hash(*log_row)
+        seen[h] += 1
+        if seen[h] <= hash_index[h]:
+            skipped += 1
+            continue
+
+        batch.append((log_row, signed_amount, h, seen[h]))
+        if len(batch) >= batch_size:
+            imported += commit(batch)
+            batch = []
+
+    if batch:
+        imported += commit(batch)
+
+    return imported, skipped, dict(deltas)
+
+
+if __name__ == "__main__":
+    import gsheet_emulator
+    import kakeibo_log
+    import kakeibo_mirror
+
+    def bank_csv(n, pad=0, encoding='utf-8'):
+        lines = ["日付,摘要,お引出し,お預入れ"]
+        for i in range(n):
+            memo = ("x" * pad if i == 0 else "") + f"コンビニのお弁当と飲み物{i}"
+            lines.append(f"2026/3/{1 + i % 28},{memo},{'' if i % 5 == 0 else 100 + i},{1000 + i if i % 5 == 0 else ''}")
+        return ("\n".join(lines) + "\n").encode(encoding)
+
+    # 4096バイト目で UTF-8 の文字が切れる明細でも、列名とメモが化けない
+    split_pads = 0
+    for pad in range(8):
+        data = bank_csv(300, pad)
+        try:
+            data[:4096].decode('utf-8')
+        except UnicodeDecodeError:
+            split_pads += 1
+        rows = list(iter_statement_rows(io.BytesIO(data)))
+        assert len(rows) == 300 and all(r["摘要"].startswith(("x", "コンビニ")) for r in rows), pad
+    assert split_pads > 0
+    assert next(iter_statement_rows(io.BytesIO(bank_csv(10, encoding='cp932'))))["摘要"] == "コンビニのお弁当と飲み物0"
+
+    # 3バッチ目の書き込みで失敗: それまでの2バッチはログと残高の両方に入り、取り込み直すと続きから入る
+    sh = gsheet_emulator.EmulatorClient(latency=0).open_by_key('import')
+    balance = Counter()
+    calls = Counter()
+
+    def write_batch(rows, deltas):
+        calls["batches"] += 1
+        if calls["batches"] == 3:
+            raise gsheet_emulator._api_error(503, "UNAVAILABLE", "The service is currently unavailable.")
+        kakeibo_log.append_log_rows(sh, rows)
+        balance.update(deltas)
+
+    data = bank_csv(250)
+    try:
+        import_statement(io.BytesIO(data), "銀行口座", "M1", Counter(), write_batch, batch_size=50)
+        raise AssertionError("途中の失敗が伝わっていない")
+    except ImportInterrupted as e:
+        assert e.imported == 100 and len(kakeibo_log.read_log(sh)) == 100 and e.deltas == dict(balance)
+
+    hash_index = build_hash_index(kakeibo_mirror.normalize_log_rows(kakeibo_log.read_log(sh)))
+    imported, skipped, _ = import_statement(io.BytesIO(data), "銀行口座", "M1", hash_index, write_batch, batch_size=50)
+    expected = sum(signed for _, signed in iter_transactions(io.BytesIO(data), "銀行口座", "M1"))
+    assert (imported, skipped) == (150, 100) and len(kakeibo_log.read_log(sh)) == 250 and balance["M1"] == expected
+    # ログは書けて残高だけ失敗したバッチは、取り込み直しで飛ばされる代わりに「残高に未反映」として返る
+    sh = gsheet_emulator.EmulatorClient(latency=0).open_by_key('import-pending')
+    balance = Counter()
+    calls = Counter()
+
+    def write_batch_balance_fails(rows, deltas):
+        calls["batches"] += 1
+        kakeibo_log.append_log_rows(sh, rows)
+        if calls["batches"] == 2:
+            raise BalancePending(gsheet_emulator._api_error(503, "UNAVAILABLE", "The service is currently unavailable."))
+        balance.update(deltas)
+
+    try:
+        import_statement(io.BytesIO(data), "銀行口座", "M1", Counter(), write_batch_balance_fails, batch_size=50)
+        raise AssertionError("途中の失敗が伝わっていない")
+    except ImportInterrupted as e:
+        assert (e.imported, e.pending) == (50, 50) and len(kakeibo_log.read_log(sh)) == 100
+        pending_deltas = e.pending_deltas
+    hash_index = build_hash_index(kakeibo_mirror.normalize_log_rows(kakeibo_log.read_log(sh)))
+    import_statement(io.BytesIO(data), "銀行口座", "M1", hash_index, write_batch_balance_fails, batch_size=50)
+    balance.update(pending_deltas)
+    assert len(kakeibo_log.read_log(sh)) == 250 and balance["M1"] == expected
+
+    print(f"文字の境界: {split_pads}/8 通りで4096バイト目が文字の途中 → すべて UTF-8 で読めた / "
+          f"途中で失敗した取り込み: 100件確定 → 取り込み直しで残り {imported}件（重複 {skipped}件）、残高 {balance['M1']:,}円")
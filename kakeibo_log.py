@@ -0,0 +1,326 @@
+import re
+import datetime
+import threading
+from gspread.exceptions import WorksheetNotFound
+
+# ==========================================
+# トランザクションログの年別パーティション
+# ==========================================
+# ログは「トランザクションログ_2026」のように1年1枚のシートに分けて保存し、
+# 「ログ索引」シートに各パーティションの期間と行数を記録する。
+# 書き込みは日付の年のパーティションへ、読み込みは必要な年のシートだけを開く。
+#
+# 媒体は名前ではなく残高シートの媒体ID（M1, M2, ...）で記録する。
+# 支出は 元媒体ID だけ、収入は 先媒体ID だけ、振替は両方が入る。
+
+LOG_HEADER = ["日付", "大分類", "小分類・メモ", "元媒体ID", "先媒体ID", "金額"]
+# 媒体名を文字列で持っていた頃のヘッダー（移行判定用）
+OLD_LOG_HEADER = ["日付", "大分類", "小分類・メモ", "対象媒体", "金額"]
+INDEX_TITLE = "ログ索引"
+INDEX_HEADER = ["パーティション", "年", "開始日", "終了日", "行数"]
+LEGACY_TITLE = "トランザクションログ"
+MIGRATED_LEGACY_TITLE = "トランザクションログ_移行済み"
+
+# 索引の行数は読んでから書き戻すので、スレッドプールからの追記は直列化する
+_append_lock = threading.Lock()
+
+
+def partition_title(year):
+    return f"{LEGACY_TITLE}_{year}"
+
+
+def _row_date(value):
+    """ログの日付セル（'2026-01-05' や '2026/1/5'）を日付に変換する"""
+    m = re.match(r'\s*(\d{4})\D(\d{1,2})\D(\d{1,2})', str(value))
+    if not m:
+        return None
+    try:
+        return datetime.date(int(m.group(1)), int(m.group(2)), int(m.group(3)))
+    except ValueError:
+        return None
+
+
+def _find_worksheet(sh, title):
+    try:
+        return sh.worksheet(title)
+    except WorksheetNotFound:
+        return None
+
+
+# --- 索引シート ---
+# 索引の見出しは中身と一緒に最後に書くので、見出しがあれば索引（と旧ログの移行）は書き終わっている
+def _open_index(sh):
+    ws_index = _find_worksheet(sh, INDEX_TITLE)
+    values = ws_index.get_all_values() if ws_index is not None else []
+    if not values or values[0][:len(INDEX_HEADER)] != INDEX_HEADER:
+        # 索引が無い、または作る途中で失敗していた → 最初から作り直す
+        return _create_index(sh, ws_index)
+
+    index = []
+    for row_no, row in enumerate(values[1:], start=2):
+        row = (row + [""] * len(INDEX_HEADER))[:len(INDEX_HEADER)]
+        if not row[0]:
+            continue
+        index.append({
+            "title": row[0],
+            "year": int(row[1]),
+            "start": _row_date(row[2]),
+            "end": _row_date(row[3]),
+            "rows": int(str(row[4]).replace(',', '') or 0),
+            "row_no": row_no,
+        })
+    return ws_index, index
+
+
+def load_index(sh):
+    """索引を [{title, year, start, end, rows, row_no}, ...] で返す。無ければ作る（旧ログがあれば分割して移行）"""
+    return _open_index(sh)[1]
+
+
+def _index_values(part):
+    return [part["title"], part["year"], str(part["start"] or ""), str(part["end"] or ""), part["rows"]]
+
+
+def _write_index_rows(ws_index, index, changed):
+    data = []
+    for part in changed:
+        data.append({
+            "range": f"A{part['row_no']}:E{part['row_no']}",
+            "values": [_index_values(part)],
+        })
+    if data:
+        ws_index.batch_update(data, value_input_option='USER_ENTERED')
+
+
+def _create_index(sh, ws_index):
+    """索引を作る。旧ログがあれば先に年別パーティションへ写し、索引は最後に1回で書く"""
+    legacy = _find_worksheet(sh, LEGACY_TITLE)
+    index = _copy_legacy_log(sh, legacy) if legacy is not None else []
+    if ws_index is None:
+        ws_index = sh.add_worksheet(title=INDEX_TITLE, rows=str(max(100, len(index) + 1)), cols=str(len(INDEX_HEADER)))
+    ws_index.update(values=[INDEX_HEADER] + [_index_values(part) for part in index], value_input_option='USER_ENTERED')
+    if legacy is not None:
+        # 旧シートは消さずに名前を変えて残しておく（ここで失敗しても索引は書けているので、移行は済んでいる）
+        legacy.update_title(MIGRATED_LEGACY_TITLE)
+    return ws_index, index
+
+
+def _copy_legacy_log(sh, legacy):
+    """1枚にまとまっていた旧ログを年別パーティションに写し、索引の中身を返す
+
+    パーティションは追記ではなく A1 からの上書きで書くので、途中で失敗して
+    やり直しても行が重複しない（索引ができるまでは他の書き込みは無い）。
+    """
+    rows = [r for r in legacy.get_all_values()[1:] if any(str(c).strip() for c in r)]
+    by_year = {}
+    for row in rows:
+        d = _row_date(row[0]) or datetime.date.today()
+        by_year.setdefault(d.year, []).append((d, row))
+
+    index = []
+    for row_no, year in enumerate(sorted(by_year), start=2):
+        items = by_year[year]
+        title = partition_title(year)
+        ws = _find_worksheet(sh, title)
+        if ws is None:
+            ws = sh.add_worksheet(title=title, rows=str(max(1000, len(items) + 1)), cols=str(len(OLD_LOG_HEADER)))
+        # 媒体名のままの行なので旧ヘッダーで作り、媒体IDへの移行は migrate_media_columns に任せる
+        ws.update(values=[OLD_LOG_HEADER] + [row for _, row in items], value_input_option='USER_ENTERED')
+        dates = [d for d, _ in items]
+        index.append({"title": title, "year": year, "start": min(dates), "end": max(dates), "rows": len(items), "row_no": row_no})
+    return index
+
+
+# --- 書き込み ---
+def _append_partitioned(sh, ws_index, index, rows):
+    by_year = {}
+    for row in rows:
+        d = _row_date(row[0]) or datetime.date.today()
+        by_year.setdefault(d.year, []).append((d, row))
+
+    by_title = {part["title"]: part for part in index}
+    changed = []
+    for year in sorted(by_year):
+        items = by_year[year]
+        title = partition_title(year)
+        part = by_title.get(title)
+        if part is None:
+            ws = _find_worksheet(sh, title)
+            if ws is None:
+                ws = sh.add_worksheet(title=title, rows="1000", cols=str(len(LOG_HEADER)))
+                ws.append_row(LOG_HEADER, value_input_option='USER_ENTERED')
+            row_no = max([p["row_no"] for p in index], default=1) + 1
+            part = {"title": title, "year": year, "start": None, "end": None, "rows": 0, "row_no": row_no}
+            index.append(part)
+            by_title[title] = part
+        else:
+            ws = sh.worksheet(title)
+
+        ws.append_rows([row for _, row in items], value_input_option='USER_ENTERED')
+
+        dates = [d for d, _ in items]
+        part["start"] = min([d for d in [part["start"], *dates] if d])
+        part["end"] = max([d for d in [part["end"], *dates] if d])
+        part["rows"] += len(items)
+        changed.append(part)
+
+    _write_index_rows(ws_index, index, changed)
+    return index
+
+
+def append_log_rows(sh, rows):
+    """ログ行を日付の年のパーティションに追記し、索引の期間と行数を更新する"""
+    with _append_lock:
+        ws_index, index = _open_index(sh)
+        return _append_partitioned(sh, ws_index, index, rows)
+
+
+# --- 媒体名 → 媒体ID への移行 ---
+def split_medium(category, medium_text, resolve):
+    """旧ログの対象媒体（'口座' や '口座 → PayPay'）を (元媒体ID, 先媒体ID) にする"""
+    medium_text = str(medium_text).strip()
+    if category == "振替" and " → " in medium_text:
+        from_name, to_name = medium_text.split(" → ", 1)
+        return resolve(from_name.strip()), resolve(to_name.strip())
+    if not medium_text:
+        return "", ""
+    if category == "収入":
+        return "", resolve(medium_text)
+    return resolve(medium_text), ""
+
+
+def migrate_media_columns(sh, resolve, before_write=None):
+    """旧ヘッダーのパーティションを 元媒体ID / 先媒体ID の形に書き換える（書き換え済みのパーティションは飛ばす）
+
+    resolve は媒体名から媒体IDを返す関数。残高シートに無い名前（改名・削除済み）は
+    呼び出し側で新しいIDを登録してもらう。先に旧ヘッダーのパーティションをすべて読んで resolve を済ませ、
+    書き換える前に before_write() を呼ぶ（ここで 媒体名 → ID の対応表を保存してもらえば、
+    書き換えの途中で失敗しても、次は同じ対応表で残りのパーティションから続けられる）。
+    """
+    pending = []
+    for part in load_index(sh):
+        ws = sh.worksheet(part["title"])
+        values = ws.get_all_values()
+        if not values or values[0][:len(OLD_LOG_HEADER)] != OLD_LOG_HEADER:
+            continue
+        converted = [LOG_HEADER]
+        for row in values[1:]:
+            row = (row + [""] * len(OLD_LOG_HEADER))[:len(OLD_LOG_HEADER)]
+            from_id, to_id = split_medium(row[1], row[3], resolve)
+            converted.append([row[0], row[1], row[2], from_id, to_id, row[4]])
+        pending.append((ws, converted))
+
+    if pending and before_write is not None:
+        before_write()
+    for ws, converted in pending:
+        # 消してから書くと、書き込みに失敗した時にログが消える。行数は同じで列は増えるだけなので、
+        # 1回の update で上書きすれば、失敗しても旧ヘッダーのまま残って次回やり直せる
+        ws.update(values=converted, value_input_option='USER_ENTERED')
+    return len(pending)
+
+
+# --- 読み込み ---
+def partitions_for_range(index, start=None, end=None):
+    """期間 [start, end] に掛かるパーティションだけを返す"""
+    result = []
+    for part in sorted(index, key=lambda p: p["year"]):
+        if part["rows"] == 0:
+            continue
+        if start and part["end"] and part["end"] < start:
+            continue
+        if end and part["start"] and part["start"] > end:
+            continue
+        result.append(part)
+    return result
+
+
+def read_log(sh, start=None, end=None, index=None):
+    """期間内のログ行を返す。必要な年のシートだけを読む"""
+    if index is None:
+        index = load_index(sh)
+    rows = []
+    for part in partitions_for_range(index, start, end):
+        for row in sh.worksheet(part["title"]).get_all_values()[1:]:
+            d = _row_date(row[0]) if row else None
+            if d is None:
+                continue
+            if (start and d < start) or (end and d > end):
+                continue
+            rows.append(row)
+    return rows
+
+
+if __name__ == "__main__":
+    import gsheet_emulator
+    from gspread.exceptions import APIError
+
+    # 1枚の旧ログ（媒体名のまま）を年別に分け、媒体IDに書き換える。2枚目の書き換えで失敗させ、
+    # 保存しておいた対応表で続きから書き換えられることを確かめる
+    sh = gsheet_emulator.EmulatorClient(latency=0).open_by_key('log')
+    legacy = sh.add_worksheet(title=LEGACY_TITLE, rows="100", cols="5")
+    legacy.append_rows([OLD_LOG_HEADER,
+                        ["2025-12-01", "食費", "昼", "口座", 800],
+                        ["2025-12-24", "収入", "返金", "旧カード", 300],
+                        ["2026-01-02", "振替", "ATM", "口座 → PayPay", 5000],
+                        ["2026-01-03", "交通費", "電車", "旧カード", 200]], value_input_option='USER_ENTERED')
+    index = load_index(sh)
+    assert [p["title"] for p in index] == [partition_title(2025), partition_title(2026)]
+
+    saved = {}
+
+    def run_migration(mapping):
+        def resolve(name):
+            if name not in mapping:
+                mapping[name] = f"M{len(mapping) + 1}"
+            return mapping[name]
+        return migrate_media_columns(sh, resolve, before_write=lambda: saved.update(mapping))
+
+    ws_2026 = sh.worksheet(partition_title(2026))
+
+    def unavailable(*args, **kwargs):
+        raise gsheet_emulator._api_error(503, "UNAVAILABLE", "The service is currently unavailable.")
+    ws_2026.update = unavailable
+    try:
+        run_migration({"口座": "M1", "PayPay": "M2"})
+        raise AssertionError("書き換えの失敗が伝わっていない")
+    except APIError:
+        pass
+    # 1枚目は書き換え済み、2枚目は旧ヘッダーのまま（ログは消えていない）。対応表は書き換える前に保存済み
+    assert sh.worksheet(partition_title(2025)).get_all_values()[0] == LOG_HEADER
+    assert ws_2026.get_all_values()[0][:len(OLD_LOG_HEADER)] == OLD_LOG_HEADER and len(ws_2026.get_all_values()) == 3
+    assert saved == {"口座": "M1", "PayPay": "M2", "旧カード": "M3"}
+
+    del ws_2026.update
+    assert run_migration(dict(saved)) == 1
+    rows = read_log(sh)
+    assert [r[3:5] for r in rows] == [["M1", ""], ["", "M3"], ["M1", "M2"], ["M3", ""]]
+    assert run_migration(dict(saved)) == 0
+    assert len(read_log(sh, datetime.date(2026, 1, 1), datetime.date(2026, 1, 2))) == 1
+    print(f"途中で失敗した媒体IDへの書き換え → 続きから完了: {[r[3:5] for r in rows]}")
+
+    # 索引を書く所で失敗しても、次に開いた時に旧ログの移行からやり直し、行は重複しない
+    sh = gsheet_emulator.EmulatorClient(latency=0).open_by_key('log-resume')
+    sh.add_worksheet(title=LEGACY_TITLE, rows="100", cols="5").append_rows(
+        [OLD_LOG_HEADER, ["2025-12-01", "食費", "昼", "口座", 800], ["2026-01-02", "食費", "朝", "口座", 300],
+         ["2026-01-03", "交通費", "電車", "口座", 200]], value_input_option='USER_ENTERED')
+    add_worksheet = sh.add_worksheet
+
+    def add_failing_index(title, rows, cols, index=None):
+        ws = add_worksheet(title=title, rows=rows, cols=cols, index=index)
+        if title == INDEX_TITLE:
+            ws.update = unavailable
+        return ws
+    sh.add_worksheet = add_failing_index
+    try:
+        load_index(sh)
+        raise AssertionError("索引の書き込みの失敗が伝わっていない")
+    except APIError:
+        pass
+    del sh.add_worksheet
+    del sh.worksheet(INDEX_TITLE).update
+    assert _find_worksheet(sh, LEGACY_TITLE) is not None
+    index = load_index(sh)
+    assert [(p["title"], p["rows"], p["row_no"]) for p in index] == [(partition_title(2025), 1, 2), (partition_title(2026), 2, 3)]
+    assert len(sh.worksheet(partition_title(2026)).get_all_values()) == 3
+    assert _find_worksheet(sh, LEGACY_TITLE) is None and load_index(sh) == index
+    print("索引の作成で失敗した旧ログの移行 → 次に開いた時にやり直して完了")
@@ -0,0 +1,312 @@
+import os
+import glob
+import json
+import secrets
+import threading
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+# ==========================================
+# トランザクションログのローカル列指向ミラー
+# ==========================================
+# ログシートを Arrow IPC (Feather v2, 非圧縮) で手元に複製しておき、集計はすべてミラーから行う。
+# 同期は年別パーティションごとに「前回までに取り込んだ行数」より後ろの行だけを取得する差分方式。
+# 索引の行数が変わっていない年のシートは読みにいかない。
+# 取り込んだ行は新しいパートファイル（part-000001.arrow …）として足すだけで、それまでのファイルは書き直さない。
+# 読む時はメタ情報に載っているパートをメモリマップで開いて順につなぐ。パートが COMPACT_PARTS 個を
+# 超えたら1つにまとめ直す（内容は変わらないので世代もそのまま）。
+# パートを書いてからメタ情報を置き換えるので、途中で落ちてもメタ情報に載っていない書きかけのパートが残るだけ。
+# 作り直すたびにメタ情報の「世代」（ランダムなID）を新しくする。同じ世代の間は行が末尾に増えるだけなので、
+# ミラーから作るキャッシュや索引は (世代, 行数) で見分け、世代が変わったら最初から作る。
+#
+# メタ情報の行数は2つある。
+#   rows        … シートから読み進めた行数（途中の空行も数える。次の同期はこの続きから読む）
+#   mirror_rows … ミラーに入っている行数（空行は取り込まないので rows 以下）。キャッシュのキーはこちら
+
+MIRROR_DIR = '.kakeibo_mirror'
+LOG_COLUMNS = ["日付", "大分類", "小分類・メモ", "元媒体ID", "先媒体ID", "金額"]
+# ログの列構成・ミラーのファイル構成が変わったらミラーを作り直すための版数（4: mirror_rows を追加）
+SCHEMA_VERSION = 4
+ID_COLUMNS = ["元媒体ID", "先媒体ID"]
+# パートがこの数を超えたら1つにまとめ直す
+COMPACT_PARTS = 32
+
+# 支出集計から除外する大分類（お金が減ったわけではないもの）
+NON_EXPENSE_CATEGORIES = ["収入", "振替"]
+
+# 同期はプロセス内で1つずつ（同じ行を2つのパートに取り込まないように）
+_sync_lock = threading.RLock()
+
+
+def _meta_path(mirror_dir):
+    return os.path.join(mirror_dir, 'meta.json')
+
+
+def _empty_frame():
+    return pd.DataFrame({
+        "日付": pd.Series(dtype='datetime64[ns]'),
+        "大分類": pd.Series(dtype=str),
+        "小分類・メモ": pd.Series(dtype=str),
+        "元媒体ID": pd.Series(dtype=str),
+        "先媒体ID": pd.Series(dtype=str),
+        "金額": pd.Series(dtype='int64'),
+    })
+
+
+def _new_meta(next_part=0):
+    # パートの番号は作り直しても戻さない（読んでいる途中の古いメタ情報のパートを上書きしないように）
+    return {"rows": 0, "mirror_rows": 0, "partitions": {}, "schema": SCHEMA_VERSION, "generation": secrets.token_hex(8),
+            "parts": [], "next_part": next_part}
+
+
+def load_meta(mirror_dir=MIRROR_DIR):
+    """同期状態（パーティションごとの取り込み済み行数・世代・パートファイル）を読み込む"""
+    meta_path = _meta_path(mirror_dir)
+    if os.path.exists(meta_path):
+        with open(meta_path, encoding='utf-8') as f:
+            return json.load(f)
+    return {"rows": 0, "mirror_rows": 0, "partitions": {}, "schema": SCHEMA_VERSION, "generation": None, "parts": [], "next_part": 0}
+
+
+def mirror_key(meta):
+    """ミラーの内容を見分けるキー (世代, ミラーの行数)。キャッシュのキーに使う"""
+    return meta.get("generation"), meta.get("mirror_rows", 0)
+
+
+def _read_parts(mirror_dir, parts):
+    if not parts:
+        return _empty_frame()
+    # 非圧縮の Arrow IPC なので、メモリマップで開けばファイルの中身をそのまま列として使える
+    tables = [feather.read_table(os.path.join(mirror_dir, name), memory_map=True) for name in parts]
+    return pa.concat_tables(tables).to_pandas()
+
+
+def load_mirror(mirror_dir=MIRROR_DIR):
+    """ミラーのパートを順につないで DataFrame として返す"""
+    while True:
+        parts = load_meta(mirror_dir).get("parts", [])
+        try:
+            return _read_parts(mirror_dir, parts)
+        except FileNotFoundError:
+            # 読む間にまとめ直されて古いパートが消えた。新しいメタ情報で読み直す
+            if load_meta(mirror_dir).get("parts", []) == parts:
+                raise
+
+
+def normalize_log_rows(values):
+    """シートから取得した生の行（文字列のリスト）をミラーの列型に揃える"""
+    if not values:
+        return _empty_frame()
+    # 末尾の空セルは API が省略するので列数を揃える
+    rows = [(list(r) + [""] * len(LOG_COLUMNS))[:len(LOG_COLUMNS)] for r in values]
+    df = pd.DataFrame(rows, columns=LOG_COLUMNS)
+    df["日付"] = pd.to_datetime(df["日付"], errors='coerce', format='mixed')
+    amount = df["金額"].astype(str).str.replace(',', '', regex=False).str.replace('¥', '', regex=False)
+    df["金額"] = pd.to_numeric(amount, errors='coerce').fillna(0).astype('int64')
+    for col in ["大分類", "小分類・メモ"] + ID_COLUMNS:
+        df[col] = df[col].astype(str)
+    return df
+
+
+def _write_part(df, meta, mirror_dir):
+    """df を新しいパートファイルに書き、メタ情報のパートに足す"""
+    os.makedirs(mirror_dir, exist_ok=True)
+    name = f"part-{meta['next_part']:06d}.arrow"
+    meta["next_part"] += 1
+    path = os.path.join(mirror_dir, name)
+    table = pa.Table.from_pandas(df.reset_index(drop=True), preserve_index=False)
+    # 一時ファイルに書いてから置き換え（途中で落ちても壊れたパートを残さない）
+    feather.write_feather(table, path + '.tmp', compression='uncompressed')
+    os.replace(path + '.tmp', path)
+    meta["parts"].append(name)
+
+
+def _write_meta(meta, mirror_dir):
+    meta_path = _meta_path(mirror_dir)
+    with open(meta_path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    os.replace(meta_path + '.tmp', meta_path)
+
+
+def _remove_unlisted(meta, mirror_dir):
+    """メタ情報に載っていないパート（まとめ直し・作り直しの前のもの、書きかけのもの）と以前の1ファイル構成を消す"""
+    listed = set(meta["parts"])
+    stale = glob.glob(os.path.join(mirror_dir, 'part-*.arrow*')) + [os.path.join(mirror_dir, 'log.arrow')]
+    for path in stale:
+        if os.path.basename(path) not in listed and os.path.exists(path):
+            os.remove(path)
+
+
+def compact_mirror(mirror_dir=MIRROR_DIR):
+    """パートを1つにまとめ直す（内容は変わらないので世代はそのまま）"""
+    with _sync_lock:
+        meta = load_meta(mirror_dir)
+        if len(meta.get("parts", [])) <= 1:
+            return False
+        df = _read_parts(mirror_dir, meta["parts"])
+        meta["parts"] = []
+        _write_part(df, meta, mirror_dir)
+        _write_meta(meta, mirror_dir)
+        _remove_unlisted(meta, mirror_dir)
+        return True
+
+
+def sync_mirror(sh, index, mirror_dir=MIRROR_DIR, full=False):
+    """各パーティションの未同期行だけを取得し、新しいパートとしてミラーに足す。追加した行数を返す"""
+    with _sync_lock:
+        meta = load_meta(mirror_dir)
+        # 1枚シート時代・媒体名時代のミラー（列構成が違う）と、1ファイル構成・世代の無い頃のミラーは作り直す
+        if full or meta.get("schema") != SCHEMA_VERSION or not meta.get("generation"):
+            meta = _new_meta(meta.get("next_part", 0))
+            full = True
+        synced = meta["partitions"]
+
+        new_values = []
+        for part in sorted(index, key=lambda p: p["year"]):
+            done = synced.get(part["title"], 0)
+            if part["rows"] <= done:
+                continue
+            # 1行目はヘッダーなので、データ行 n 行を取り込み済みなら n+2 行目から読む
+            raw_values = sh.worksheet(part["title"]).get(f"A{done + 2}:F")
+            new_values += [r for r in raw_values if any(str(c).strip() for c in r)]
+            synced[part["title"]] = done + len(raw_values)
+
+        if not new_values and not full:
+            return 0
+
+        if new_values:
+            _write_part(normalize_log_rows(new_values), meta, mirror_dir)
+        meta["rows"] = sum(synced.values())
+        meta["mirror_rows"] += len(new_values)
+        os.makedirs(mirror_dir, exist_ok=True)
+        _write_meta(meta, mirror_dir)
+        if full:
+            _remove_unlisted(meta, mirror_dir)
+        elif len(meta["parts"]) > COMPACT_PARTS:
+            compact_mirror(mirror_dir)
+        return len(new_values)
+
+
+# ==========================================
+# 集計（すべて列演算で行う）
+# ==========================================
+def _expenses(df):
+    df = df[~df["大分類"].isin(NON_EXPENSE_CATEGORIES) & df["日付"].notna()]
+    return df.assign(月=df["日付"].dt.strftime('%Y-%m'))
+
+
+def monthly_by_category(df):
+    """月 × 大分類 の支出合計"""
+    exp = _expenses(df)
+    if exp.empty:
+        return pd.DataFrame()
+    return exp.pivot_table(index="月", columns="大分類", values="金額", aggfunc='sum', fill_value=0)
+
+
+def monthly_by_medium(df, medium_names):
+    """月 × 支払い媒体 の支出合計（列名は媒体IDから表示名に変換する）"""
+    exp = _expenses(df)
+    if exp.empty:
+        return pd.DataFrame()
+    pivot = exp.pivot_table(index="月", columns="元媒体ID", values="金額", aggfunc='sum', fill_value=0)
+    pivot = pivot.rename(columns=medium_names)
+    pivot.columns.name = "媒体"
+    return pivot
+
+
+# ==========================================
+# 媒体ごとの履歴
+# ==========================================
+def build_medium_index(df):
+    """媒体ID → その媒体が元・先どちらかに出てくるログの行番号（昇順）"""
+    index = {}
+    for col in ID_COLUMNS:
+        for medium_id, rows in df.groupby(col).indices.items():
+            if medium_id:
+                index[medium_id] = np.union1d(index.get(medium_id, np.array([], dtype='int64')), rows)
+    return index
+
+
+def medium_history(df, medium_index, medium_id):
+    """1つの媒体の入出金履歴。増減列は その媒体から見た符号付きの金額"""
+    rows = medium_index.get(medium_id)
+    if rows is None or len(rows) == 0:
+        return _empty_frame().assign(増減=pd.Series(dtype='int64'))
+    hist = df.iloc[rows]
+    sign = np.where(hist["先媒体ID"] == medium_id, 1, 0) - np.where(hist["元媒体ID"] == medium_id, 1, 0)
+    return hist.assign(増減=hist["金額"].to_numpy() * sign)
+
+
+if __name__ == "__main__":
+    import time
+    import tempfile
+    import gsheet_emulator
+    import kakeibo_log
+
+    # シートのログを少しずつ追記しながら同期する。差分は新しいパートになり、それまでのパートは書き直さない
+    sh = gsheet_emulator.EmulatorClient(latency=0).open_by_key('mirror')
+    rng = np.random.default_rng(0)
+
+    def log_rows(n, year=2026):
+        return [[f"{year}-{1 + i % 12:02d}-{1 + i % 28:02d}", ["食費", "交通費", "収入"][i % 3], f"メモ{i}", "M1", "", int(rng.integers(100, 5000))]
+                for i in range(n)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        mirror_dir = os.path.join(tmp, 'mirror')
+        # 以前の1ファイル構成のミラーは作り直され、古いファイルは消える
+        os.makedirs(mirror_dir)
+        feather.write_feather(pa.Table.from_pandas(_empty_frame(), preserve_index=False), os.path.join(mirror_dir, 'log.arrow'))
+        with open(_meta_path(mirror_dir), 'w', encoding='utf-8') as f:
+            json.dump({"rows": 0, "partitions": {}, "schema": 2, "generation": "old"}, f)
+
+        kakeibo_log.append_log_rows(sh, log_rows(20_000))
+        assert sync_mirror(sh, kakeibo_log.load_index(sh), mirror_dir) == 20_000
+        assert not os.path.exists(os.path.join(mirror_dir, 'log.arrow'))
+        meta = load_meta(mirror_dir)
+        first_part = os.path.join(mirror_dir, meta["parts"][0])
+        first_mtime = os.stat(first_part).st_mtime_ns
+        generation = meta["generation"]
+
+        t0 = time.perf_counter()
+        for _ in range(COMPACT_PARTS - 1):
+            kakeibo_log.append_log_rows(sh, log_rows(3))
+            sync_mirror(sh, kakeibo_log.load_index(sh), mirror_dir)
+        t1 = time.perf_counter()
+        meta = load_meta(mirror_dir)
+        assert len(meta["parts"]) == COMPACT_PARTS and os.stat(first_part).st_mtime_ns == first_mtime
+        assert meta["generation"] == generation and meta["rows"] == 20_000 + 3 * (COMPACT_PARTS - 1)
+        expected = normalize_log_rows(kakeibo_log.read_log(sh))
+        pd.testing.assert_frame_equal(load_mirror(mirror_dir), expected)
+
+        # 書きかけで落ちたパート（メタ情報に載っていない）は読まない
+        feather.write_feather(pa.Table.from_pandas(normalize_log_rows(log_rows(5)), preserve_index=False),
+                              os.path.join(mirror_dir, f"part-{meta['next_part']:06d}.arrow"))
+        assert len(load_mirror(mirror_dir)) == meta["mirror_rows"]
+
+        # パートが増えすぎたら1つにまとめ直す（内容と世代は変わらない）
+        kakeibo_log.append_log_rows(sh, log_rows(3))
+        sync_mirror(sh, kakeibo_log.load_index(sh), mirror_dir)
+        meta = load_meta(mirror_dir)
+        assert len(meta["parts"]) == 1 and meta["generation"] == generation
+        assert sorted(os.listdir(mirror_dir)) == sorted(meta["parts"] + ["meta.json"])
+        pd.testing.assert_frame_equal(load_mirror(mirror_dir), normalize_log_rows(kakeibo_log.read_log(sh)))
+
+        # 同期前にシートで空にされた行は、読み進めた行数（rows）には入るがミラーの行数には入らない
+        kakeibo_log.append_log_rows(sh, log_rows(3))
+        ws_2026 = sh.worksheet(kakeibo_log.partition_title(2026))
+        ws_2026.update(range_name=f"A{len(ws_2026.get_all_values()) - 1}", values=[[""] * len(LOG_COLUMNS)])
+        assert sync_mirror(sh, kakeibo_log.load_index(sh), mirror_dir) == 2
+        synced = load_meta(mirror_dir)
+        assert synced["rows"] == synced["mirror_rows"] + 1 == len(load_mirror(mirror_dir)) + 1
+        assert mirror_key(synced) == (generation, len(load_mirror(mirror_dir)))
+
+        # 作り直すと世代が変わり、シートで直した行も反映される
+        ws_2026.update(range_name='C2', values=[["直したメモ"]])
+        assert sync_mirror(sh, kakeibo_log.load_index(sh), mirror_dir, full=True) == synced["mirror_rows"]
+        rebuilt = load_meta(mirror_dir)
+        assert rebuilt["generation"] != generation and rebuilt["parts"][0] not in meta["parts"]
+        assert load_mirror(mirror_dir)["小分類・メモ"].iloc[0] == "直したメモ"
+        print(f"差分同期 {COMPACT_PARTS - 1}回（既存 20,000行）: 1回 {(t1 - t0) / (COMPACT_PARTS - 1) * 1000:.1f}ms / "
+              f"まとめ直し後のパート {len(meta['parts'])}個")
@@ -0,0 +1,159 @@
+import math
+import threading
+import unicodedata
+from collections import Counter, defaultdict
+import numpy as np
+import pandas as pd
+
+# ==========================================
+# ログのメモ検索（文字 bigram の転置索引）
+# ==========================================
+# 日本語は単語区切りがないので、小分類・メモと大分類を2文字ずつに区切って索引にする。
+# 索引はミラーの行番号を文書IDとし、ミラーに行が増えた分だけ追加で索引づけする。
+# ミラーが作り直されると行番号の指す行が変わるので、ミラーの世代が変わったら最初から作り直す。
+# 媒体は名前が変わっても追えるよう、索引には入れずに媒体IDの索引（kakeibo_mirror）から引く。
+
+TEXT_FIELDS = ["小分類・メモ", "大分類"]
+
+
+def normalize(text):
+    """全角英数・半角カナの揺れをなくし、小文字にそろえる"""
+    return unicodedata.normalize('NFKC', str(text)).lower()
+
+
+def tokenize(text):
+    """1文字（1文字だけの検索用）と2文字の組を返す。空白をまたぐ組は作らない"""
+    tokens = []
+    for word in normalize(text).split():
+        tokens.extend(word)
+        tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+    return tokens
+
+
+class MemoSearchIndex:
+    def __init__(self):
+        self.postings = defaultdict(dict)  # 語 → {行番号: 出現回数}
+        self.n_docs = 0
+        self.generation = None  # 索引づけしたミラーの世代（kakeibo_mirror のメタ情報）
+        # セッションをまたいで共有するので、追記と検索は排他にする
+        self.lock = threading.Lock()
+
+    def add_rows(self, texts):
+        """新しく増えたログ行を末尾に追加で索引づけする"""
+        for text in texts:
+            doc = self.n_docs
+            for token, tf in Counter(tokenize(text)).items():
+                self.postings[token][doc] = tf
+            self.n_docs += 1
+
+    def catch_up(self, df_log, generation):
+        """ミラーに追いつく。ミラーが作り直されていたら（世代が変わったら）最初から作る"""
+        if generation != self.generation or len(df_log) < self.n_docs:
+            self.postings = defaultdict(dict)
+            self.n_docs = 0
+            self.generation = generation
+        if len(df_log) > self.n_docs:
+            new_rows = df_log.iloc[self.n_docs:]
+            texts = new_rows[TEXT_FIELDS[0]].astype(str)
+            for field in TEXT_FIELDS[1:]:
+                texts = texts + " " + new_rows[field].astype(str)
+            self.add_rows(texts)
+
+    def match(self, query):
+        """全ての語を含む行に BM25 風の点数をつけて {行番号: 点数} で返す"""
+        query_tokens = set()
+        for word in normalize(query).split():
+            # 2文字以上の語は bigram、1文字の語はその文字で引く
+            query_tokens.update(word[i:i + 2] for i in range(len(word) - 1) if len(word) > 1)
+            if len(word) == 1:
+                query_tokens.add(word)
+        if not query_tokens:
+            return {}
+
+        # 出現行の少ない語から絞り込む
+        postings = sorted((self.postings.get(t, {}) for t in query_tokens), key=len)
+        if not postings[0]:
+            return {}
+        candidates = set(postings[0])
+        for p in postings[1:]:
+            candidates.intersection_update(p)
+            if not candidates:
+                return {}
+
+        scores = {}
+        for p in postings:
+            idf = math.log(1 + self.n_docs / len(p))
+            for doc in candidates:
+                tf = p[doc]
+                scores[doc] = scores.get(doc, 0.0) + idf * tf / (tf + 1.2)
+        return scores
+
+
+def search(index, df_log, generation, query, start=None, end=None, categories=None, medium_rows=None):
+    """検索して (該当行の DataFrame（点数順）, 金額の合計) を返す
+
+    generation は df_log を読んだミラーの世代。medium_rows には検索語が媒体名に一致した媒体の行番号を渡す（その行も一致扱い）。
+    """
+    with index.lock:
+        index.catch_up(df_log, generation)
+        scores = index.match(query)
+    if medium_rows is not None and len(medium_rows):
+        bonus = max(scores.values(), default=1.0)
+        for doc in medium_rows:
+            scores[int(doc)] = scores.get(int(doc), 0.0) + bonus
+    if not scores:
+        return df_log.iloc[0:0].assign(点数=pd.Series(dtype=float)), 0
+
+    docs = np.fromiter(scores.keys(), dtype='int64', count=len(scores))
+    hits = df_log.iloc[docs].assign(点数=np.fromiter(scores.values(), dtype=float, count=len(scores)))
+
+    # 期間・大分類の絞り込みは候補行に対して列演算で行う
+    mask = np.ones(len(hits), dtype=bool)
+    if start is not None:
+        mask &= (hits["日付"] >= pd.Timestamp(start)).to_numpy()
+    if end is not None:
+        mask &= (hits["日付"] <= pd.Timestamp(end)).to_numpy()
+    if categories:
+        mask &= hits["大分類"].isin(categories).to_numpy()
+    hits = hits[mask].sort_values(["点数", "日付"], ascending=[False, False])
+    return hits, int(hits["金額"].sum())
+
+
+if __name__ == "__main__":
+    import os
+    import tempfile
+    import gsheet_emulator
+    import kakeibo_log
+    import kakeibo_mirror
+
+    # シートのログをミラーに同期して検索し、シート側を直してミラーを作り直した後も正しく引けるか確かめる
+    sh = gsheet_emulator.EmulatorClient(latency=0).open_by_key('search')
+    kakeibo_log.append_log_rows(sh, [
+        ["2026-01-05", "趣味", "ポケカ 拡張パック", "M1", "", 1800],
+        ["2026-01-06", "食費", "コンビニ お弁当", "M1", "", 600],
+        ["2026-02-01", "趣味", "カメラ関連 レンズ", "M2", "", 45000],
+    ])
+    index = MemoSearchIndex()
+    with tempfile.TemporaryDirectory() as tmp:
+        mirror_dir = os.path.join(tmp, 'mirror')
+
+        def run(query):
+            kakeibo_mirror.sync_mirror(sh, kakeibo_log.load_index(sh), mirror_dir)
+            generation = kakeibo_mirror.load_meta(mirror_dir)["generation"]
+            hits, total = search(index, kakeibo_mirror.load_mirror(mirror_dir), generation, query)
+            return hits["小分類・メモ"].tolist(), total
+
+        assert run("ポケカ") == (["ポケカ 拡張パック"], 1800)
+        # 1行追記しただけなら、増えた行だけを索引づけする
+        kakeibo_log.append_log_rows(sh, [["2026-02-10", "趣味", "ポケカ スリーブ", "M1", "", 700]])
+        assert run("ポケカ")[1] == 2500 and index.n_docs == 4
+
+        # シートのメモを直してミラーを作り直すと、行数は同じでも行の中身が変わる
+        ws = sh.worksheet(kakeibo_log.partition_title(2026))
+        ws.update(range_name='C2', values=[["ボードゲーム"]])
+        generation = kakeibo_mirror.load_meta(mirror_dir)["generation"]
+        kakeibo_mirror.sync_mirror(sh, kakeibo_log.load_index(sh), mirror_dir, full=True)
+        assert kakeibo_mirror.load_meta(mirror_dir)["generation"] != generation
+        assert run("ポケカ") == (["ポケカ スリーブ"], 700)
+        assert run("ボードゲーム") == (["ボードゲーム"], 1800)
+    print(f"ミラーの作り直しの後も検索結果が一致: 索引 {index.n_docs} 行")
@@ -1,72 +1,48 @@
 import streamlit as st
 import pandas as pd
 import datetime
+import schedule_logic
+import schedule_store
+import schedule_slots
 
 # ==========================================
 # 0. アプリ設定 (ワイドモード)
 # ==========================================
 st.set_page_config(page_title="日程調整AI", page_icon="🗓️", layout="wide")
 
-if 'schedule_data' not in st.session_state:
-    st.session_state.schedule_data = {
-        "title": "未定のイベント",
-        "dates": [],       
-        "votes": {},       # { "ユーザー名": {日付: 点数} }
-        "comments": {}     # { "ユーザー名": {日付: "コメント"} } ★日付ごとに保存する形に変更
-    }
+# イベントはサーバー全体で共有するストアに置き、URL の ?event=<ID> で選ぶ（schedule_store.py）
+# 使われていないイベントはメモリの上限を超えるとディスクに退避され、次に開いた時に読み込み直される
+store = schedule_store.get_store()
+event_id = st.query_params.get("event")
+# 共有の Poll なので、書き換える時は必ず store.editing() の中で行う
+data = store.get(event_id)
 
-data = st.session_state.schedule_data
+if data is None:
+    # イベントは「作成」を押した時だけ作る（知らないIDを開いただけでは増やさない）
+    st.title("🗓️ 日程調整AI")
+    if event_id:
+        st.warning("イベントが見つかりません。URL を確認するか、新しく作成してください。")
+    if st.button("新しいイベントを作成 ➕", type="primary"):
+        st.query_params["event"] = store.create_event()
+        st.rerun()
+    st.stop()
 
 # ==========================================
-# 1. ロジック関数
-# ==========================================
-def calculate_best_date():
-    if not data["dates"] or not data["votes"]:
-        return None, None, []
-
-    df = pd.DataFrame(index=data["dates"])
-    users = list(data["votes"].keys())
-    
-    # 投票データの展開
-    for user in users:
-        user_votes = data["votes"][user]
-        df[user] = df.index.map(lambda d: user_votes.get(d, 0))
-
-    # 集計列の作成
-    df["合計"] = df[users].sum(axis=1)
-    
-    # NGの人リストを作成
-    def get_ng_names(row):
-        ng_list = [u for u in users if row[u] == 0]
-        return ", ".join(ng_list) if ng_list else ""
-
-    df["NGの人"] = df.apply(get_ng_names, axis=1)
-
-    # ランキングソート
-    df["_ng_count"] = (df[users] == 0).sum(axis=1)
-    df_sorted = df.sort_values(by=["合計", "_ng_count"], ascending=[False, True])
-    df_sorted = df_sorted.drop(columns=["_ng_count"])
-    
-    # 1位タイを抽出
-    if not df_sorted.empty:
-        max_score = df_sorted["合計"].iloc[0]
-        top_dates = df_sorted[df_sorted["合計"] == max_score].index.tolist()
-    else:
-        top_dates = []
-
-    return df, df_sorted, top_dates
-
-# ==========================================
-# 2. UI構築
+# 1. UI構築
 # ==========================================
 st.title("🗓️ 日程調整AI")
 
-tab1, tab2, tab3 = st.tabs(["① イベント作成", "② 投票入力", "③ 結果発表"])
+tab1, tab2, tab3, tab4 = st.tabs(["① イベント作成", "② 投票入力", "③ 結果発表", "④ 時間帯で探す"])
 
 # --- タブ1: イベント作成 ---
 with tab1:
     c1, c2 = st.columns([2, 1])
-    data["title"] = c1.text_input("イベント名", data["title"])
+    new_title = c1.text_input("イベント名", data.title)
+    if new_title != data.title:
+        with store.editing(event_id) as data:
+            data.title = new_title
+    c2.caption("🔗 このページのURL（?event=...）を共有すると、同じイベントに投票できます")
+    c2.code(f"?event={event_id}", language="text")
 
     st.subheader("候補日の自動生成")
     
@@ -95,25 +71,26 @@ with tab1:
                     generated_dates.append(date_str)
                 curr += datetime.timedelta(days=1)
             
-            data["dates"] = generated_dates
-            data["votes"] = {} 
-            data["comments"] = {} # リセット
+            with store.editing(event_id) as data:
+                data.set_dates(generated_dates, reset=True)
             st.success(f"{len(generated_dates)}日分の候補日を作成しました！")
             st.rerun()
 
     st.write("---")
     st.caption("👇 手動編集エリア")
-    current_text = "\n".join(data["dates"])
+    current_text = "\n".join(data.dates)
     edited_text = st.text_area("候補日一覧", value=current_text, height=150)
     if st.button("リスト保存"):
-        data["dates"] = [d.strip() for d in edited_text.split('\n') if d.strip()]
+        # 残した候補日は同じIDのままなので、投票は消えない
+        with store.editing(event_id) as data:
+            data.set_dates([d.strip() for d in edited_text.split('\n') if d.strip()])
         st.success("更新しました")
 
 # --- タブ2: 投票入力 ---
 with tab2:
-    st.header(f"「{data['title']}」への投票")
+    st.header(f"「{data.title}」への投票")
     
-    if not data["dates"]:
+    if not data.date_ids:
         st.warning("候補日がありません。タブ①で作成してください。")
     else:
         st.info("💡 **凡例**: 🤩参加(3点) / 🤔未定(2点) / 🕒条件付(1点) / 🙅不可(0点)")
@@ -122,113 +99,178 @@ with tab2:
         
         if user_name:
             st.write("---")
-            with st.form("vote_form"):
-                answers = {}
-                comments_temp = {}
-                options = ["🤩 参加", "🤔 未定", "🕒 条件", "🙅 不可"]
-                
-                # ★ここが進化した入力欄
-                # ヘッダーで見出しをつける
-                h1, h2, h3 = st.columns([1.5, 3, 2])
-                h1.caption("日程")
-                h2.caption("回答")
-                h3.caption("備考 (任意)")
-                
-                for date in data["dates"]:
-                    # 1行に3要素を並べる
-                    c1, c2, c3 = st.columns([1.5, 3, 2]) 
-                    
-                    # 1. 日付
-                    c1.markdown(f"**{date}**")
-                    
-                    # 2. ラジオボタン
-                    choice = c2.radio(
-                        f"{date}", 
-                        options, 
-                        horizontal=True, 
-                        key=f"radio_{date}",
-                        label_visibility="collapsed"
-                    )
-                    
-                    # 3. 備考入力欄（ここに追加！）
-                    comment = c3.text_input(
-                        f"comment_{date}", 
-                        placeholder="遅れます etc.",
-                        label_visibility="collapsed",
-                        key=f"comment_{date}"
+            # 前回の回答を初期値にして、候補日ごとの 回答・備考 を1つの表で編集する
+            prev_answers = data.answers(user_name)
+            prev_comments = data.user_comments(user_name)
+            grid_key = f"vote_grid_{user_name}"
+            grid_source = (data.dates, prev_answers, prev_comments)
+            grid = st.session_state.get(grid_key)
+            # 候補日や保存済みの回答が変わった時だけ表を作り直す（キーを変えて編集内容も捨てる）
+            if grid is None or grid["source"] != grid_source:
+                grid = st.session_state[grid_key] = {
+                    "source": grid_source,
+                    "base": schedule_logic.vote_grid(data.dates, prev_answers, prev_comments),
+                    "version": grid["version"] + 1 if grid else 0,
+                }
+
+            edited_grid = st.data_editor(
+                grid["base"],
+                key=f"{grid_key}_{grid['version']}",
+                hide_index=True,
+                use_container_width=True,
+                disabled=["日程"],
+                column_config={
+                    "日程": st.column_config.TextColumn("日程"),
+                    "回答": st.column_config.SelectboxColumn("回答", options=schedule_logic.SCORE_OPTIONS, required=True),
+                    "備考": st.column_config.TextColumn("備考 (任意)", help="遅れます etc."),
+                },
+            )
+
+            # 一括入力（今の表の内容に上書きして、表を作り直す）
+            b1, b2, b3 = st.columns(3)
+            bulk = None
+            if b1.button("土日を全部 🤩参加"):
+                bulk = (schedule_logic.SCORE_OPTIONS[0], True)
+            if b2.button("全部 🤩参加"):
+                bulk = (schedule_logic.SCORE_OPTIONS[0], False)
+            if b3.button("全部 🙅不可"):
+                bulk = (schedule_logic.SCORE_OPTIONS[3], False)
+            if bulk:
+                grid["base"] = schedule_logic.fill_answers(edited_grid, *bulk)
+                grid["version"] += 1
+                st.rerun()
+
+            # 前回から変わったセルだけを送る
+            score_changes, comment_changes = schedule_logic.grid_changes(edited_grid, prev_answers, prev_comments)
+            n_changes = len(set(score_changes) | set(comment_changes))
+            st.caption(f"変更あり: {n_changes}日分" if n_changes else "前回の回答から変更はありません")
+
+            st.write("---")
+            if st.button("投票する", type="primary", disabled=not n_changes):
+                with store.editing(event_id) as data:
+                    # 表を開いている間に別の画面で消えた・名前が変わった候補日への変更は捨てる
+                    labels = set(data.dates)
+                    data.apply_vote_changes(
+                        user_name,
+                        {d: s for d, s in score_changes.items() if d in labels},
+                        {d: c for d, c in comment_changes.items() if d in labels},
                     )
-                    
-                    # データ格納処理
-                    if "🤩" in choice: score = 3
-                    elif "🤔" in choice: score = 2
-                    elif "🕒" in choice: score = 1
-                    else: score = 0
-                    answers[date] = score
-                    
-                    if comment:
-                        comments_temp[date] = comment
-                
-                st.write("---")
-                if st.form_submit_button("投票する", type="primary"):
-                    data["votes"][user_name] = answers
-                    data["comments"][user_name] = comments_temp
-                    st.success(f"{user_name}さんの投票を受け付けました！")
-                    st.rerun()
+                st.success(f"{user_name}さんの投票を受け付けました！")
+                st.rerun()
 
 # --- タブ3: 結果発表 ---
 with tab3:
     st.header("集計結果 🏆")
     
-    if not data["dates"] or not data["votes"]:
+    if not data.date_ids or not data.votes:
         st.info("データなし")
     else:
-        raw_df, ranked_df, top_dates = calculate_best_date()
+        # 1位タイは投票のたびに更新している順位の先頭から取る（生の投票は読み直さない）
+        top_dates = data.top_dates()
         
         if top_dates:
-            top_score = ranked_df.iloc[0]["合計"]
+            top_score = top_dates[0][1]
             st.success(f"🎉 候補日は **{len(top_dates)}つ** あります！（スコア: {int(top_score)}点）")
             
-            for d in top_dates:
-                ng_ppl = ranked_df.loc[d, "NGの人"]
+            for d, _, ng_ppl in top_dates:
                 if ng_ppl:
                     st.warning(f"👑 **{d}** （NG: {ng_ppl}）")
                 else:
                     st.balloons()
                     st.success(f"👑 **{d}** （全員参加可能！）")
 
+            # 条件つきの候補日選び（必須メンバー・最低人数・🕒を避ける）
+            st.write("---")
+            st.subheader("🧩 条件を指定して探す")
+            cc1, cc2, cc3 = st.columns([2, 1, 1])
+            must_members = cc1.multiselect("必ず参加してほしい人", data.users, key="must_members")
+            quorum = cc2.number_input("最低人数", min_value=0, max_value=len(data.users), value=0, key="quorum")
+            avoid_conditional = cc3.checkbox("🕒条件付が少ない日を優先", key="avoid_conditional")
+            best, blocked = schedule_logic.rank_with_constraints(data, must_members, quorum, avoid_conditional, k=5)
+            if best:
+                st.dataframe(pd.DataFrame(best), hide_index=True, use_container_width=True)
+            else:
+                st.warning("条件を満たす候補日がありません")
+            if blocked and (must_members or quorum):
+                with st.expander(f"条件を満たさない候補日（{len(blocked)}件）と理由"):
+                    st.dataframe(pd.DataFrame(blocked, columns=["日程", "理由"]), hide_index=True, use_container_width=True)
+
             # 詳細表
             st.write("---")
             st.subheader("📊 詳細ランキング表")
-            users = list(data["votes"].keys())
-            display_cols = ["合計", "NGの人"] + users
-            st.dataframe(
-                ranked_df[display_cols].style.highlight_max(axis=0, subset=["合計"], color="#fffd75")
-            )
+            # 集計の版ごとに1回だけ作った表を、ページと表示する投票者の列で切り出して出す
+            results = schedule_logic.results_table(data)
+            rc1, rc2, rc3 = st.columns([3, 1, 1])
+            shown_voters = rc1.multiselect("表示する投票者", data.users, default=data.users[:10])
+            page_size = rc2.selectbox("1ページの件数", [10, 20, 50], index=1, key="page_size")
+            n_pages = max(1, -(-len(results) // page_size))
+            page = rc3.number_input("ページ", min_value=1, max_value=n_pages, value=1, key="results_page")
+            page_df = schedule_logic.results_page(results, page - 1, page_size, shown_voters)
+            st.dataframe(schedule_logic.highlight_top(page_df, top_score), hide_index=True)
+            st.caption(f"{len(results)}件中 {(page - 1) * page_size + 1}〜{min(page * page_size, len(results))}位（{page}/{n_pages}ページ）")
             
             # ★進化: 日付ごとのコメント表示
             st.write("---")
             st.subheader("💬 日程ごとの備考")
             
-            has_comment = False
-            # 全ユーザーのコメントを集約して、日付ごとに整理
-            for date in data["dates"]:
-                day_comments = []
-                for user in users:
-                    # そのユーザーのその日のコメントを取得
-                    if user in data["comments"] and date in data["comments"][user]:
-                        c = data["comments"][user][date]
-                        day_comments.append(f"**{user}**: {c}")
-                
-                # コメントがある日だけ表示
-                if day_comments:
-                    has_comment = True
-                    # 展開できるパネルで表示
-                    with st.expander(f"📍 {date}", expanded=True):
-                        for c in day_comments:
-                            st.write(f"- {c}")
+            # 投票時に作っておいた 日付 → コメント の索引から、コメントがある日だけを読む
+            dated_comments = data.comments_by_date()
+            for date, day_comments in dated_comments:
+                # 展開できるパネルで表示
+                with st.expander(f"📍 {date}", expanded=True):
+                    for user, c in day_comments.items():
+                        st.write(f"- **{user}**: {c}")
                             
-            if not has_comment:
+            if not dated_comments:
                 st.caption("コメントはありません")
 
         else:
-            st.warning("集計エラー")
\ No newline at end of file
+            st.warning("集計エラー")
+
+# --- タブ4: 時間帯で探す（30分刻みの空き時間から、続けて空いている時間帯を探す） ---
+with tab4:
+    st.header("⏰ 時間帯で探す")
+    grid = data.slot_grid
+
+    with st.expander("時間帯グリッドの設定", expanded=grid is None):
+        sc1, sc2, sc3 = st.columns(3)
+        slot_range = sc1.date_input("期間", value=[], min_value=datetime.date.today(), key="slot_range")
+        slot_options = list(range(schedule_slots.SLOTS_PER_DAY + 1))
+        first_slot = sc2.selectbox("何時から", slot_options[:-1], index=18, format_func=schedule_slots.slot_label)
+        last_slot = sc3.selectbox("何時まで", slot_options[1:], index=45, format_func=schedule_slots.slot_label)
+        if len(slot_range) == 2 and first_slot < last_slot:
+            if st.button("時間帯グリッドを作成 ⏰"):
+                n_days = (slot_range[1] - slot_range[0]).days + 1
+                days = [str(slot_range[0] + datetime.timedelta(days=i)) for i in range(n_days)]
+                with store.editing(event_id) as data:
+                    data.slot_grid = schedule_slots.SlotGrid(days, first_slot, last_slot)
+                st.rerun()
+
+    if grid is None:
+        st.info("期間と時間帯を決めてグリッドを作成してください。")
+    else:
+        slot_user = st.text_input("あなたの名前", key="slot_user")
+        if slot_user:
+            st.caption("空いている時間にチェックを入れてください（30分刻み）")
+            day_columns = {c: st.column_config.CheckboxColumn(c, width="small") for c in grid.to_frame(slot_user).columns}
+            edited_slots = st.data_editor(
+                grid.to_frame(slot_user),
+                column_config=day_columns,
+                use_container_width=True,
+                key=f"slot_grid_{slot_user}_{len(grid.days)}_{grid.start_slot}_{grid.end_slot}",
+            )
+            if st.button("空き時間を登録", type="primary"):
+                with store.editing(event_id) as data:
+                    data.slot_grid.set_from_frame(slot_user, edited_slots)
+                st.success(f"{slot_user}さんの空き時間を登録しました！")
+
+        st.write("---")
+        st.subheader("🔍 続けて空いている時間帯")
+        wc1, wc2 = st.columns(2)
+        length = wc1.selectbox("長さ", list(range(1, 17)), index=3, format_func=schedule_slots.duration_label)
+        min_people = wc2.number_input("最低人数", min_value=1, value=1, key="slot_min_people")
+        windows = grid.best_windows(length, k=10, min_people=min_people)
+        if windows.empty:
+            st.caption("条件に合う時間帯はまだありません")
+        else:
+            st.dataframe(windows, hide_index=True, use_container_width=True)
@@ -4,6 +4,12 @@ import datetime
 import gspread
 import json
 import os
+import gsheet_emulator
+import sheets_scheduler
+import schedule_logic
+import schedule_sheet_store
+import schedule_sheet_index
+from schedule_poll import Poll
 from oauth2client.service_account import ServiceAccountCredentials
 
 # ==========================================
@@ -17,7 +23,11 @@ SPREADSHEET_KEY = '1-8cu7x-zC41ot512uYHL0UhD7hxdfnr0zyQ1H3BrlmI'
 # 1. Googleスプレッドシート接続機能
 # ==========================================
 @st.cache_resource
-def get_sheet():
+def get_spreadsheet():
+    # オフライン試験・ベンチマーク用のローカル代替
+    if gsheet_emulator.is_enabled():
+        return sheets_scheduler.open_by_key(gsheet_emulator.get_client(), SPREADSHEET_KEY)
+
     scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
     
     # PCにあるか確認
@@ -32,94 +42,221 @@ def get_sheet():
         st.stop()
             
     client = gspread.authorize(creds)
-    return client.open_by_key(SPREADSHEET_KEY).sheet1
+    # シート操作はすべてクォータ管理付きのスケジューラを通す
+    return sheets_scheduler.open_by_key(client, SPREADSHEET_KEY)
+
+# イベントはそれぞれ自分のワークシートに入れ、「イベント一覧」シートで ID・タイトル・状態 を管理する（schedule_sheet_index.py）
+@st.cache_resource
+def event_index():
+    return schedule_sheet_index.EventIndex(get_spreadsheet())
+
+def get_sheet():
+    """いま開いているイベント（URL の ?event=<ID>）のワークシートだけを開く"""
+    return event_index().open_event(st.session_state.event_id)
+
+# シートは 1行目がイベント情報、2行目から投票者1人1行（schedule_sheet_store.py）
+# D1 の更新回数は書き込みのたびに上がるので、表示側はこれだけを時々読んで、変わった時だけ全体を読み直す
+REFRESH_SECONDS = 5
+# タイトル・候補日の編集は、入力が止まってからこの秒数でまとめて1回だけ書く
+SAVE_DELAY_SECONDS = 2
+
+@st.cache_resource(max_entries=100)
+def event_cache(event_id):
+    """読み込んだイベントを更新回数ごとに全セッションで共有する（同時の読み込みは1回にまとまる）"""
+    return schedule_sheet_store.EventCache(event_index().open_event(event_id))
 
-def load_data_from_sheet():
+def load_data_from_sheet(min_revision=None):
+    """更新回数が min_revision 以上の (Poll, 更新回数, 版) を返す。共有の Poll なので書き換える時は editable_data() を使う"""
     try:
-        sheet = get_sheet()
-        raw_data = sheet.acell('A1').value
-        if raw_data:
-            return json.loads(raw_data)
+        # A1 に全体の JSON を入れていた旧形式は、ここで一度だけ行ごとの配置に書き換わる
+        return event_cache(st.session_state.event_id).get(min_revision)
     except Exception as e:
         print(f"Log: {e}")
     
-    return {
-        "title": "未定のイベント",
-        "dates": [],       
-        "votes": {},       
-        "comments": {}     
-    }
+    return Poll(), None, None
+
+@st.cache_data(ttl=REFRESH_SECONDS, show_spinner=False)
+def current_revision(event_id):
+    """全セッションで共有するので、見ている人が増えても D1 の読み込みはイベントごとに数秒に1回"""
+    try:
+        return schedule_sheet_store.read_revision(event_index().open_event(event_id))
+    except Exception as e:
+        print(f"Log: {e}")
+    return None
+
+@st.cache_data(ttl=REFRESH_SECONDS, show_spinner=False)
+def list_events(include_archived):
+    """一覧シートだけを読む（各イベントのシートは開かない）"""
+    return event_index().list_events(include_archived)
+
+def set_data(poll, revision, version):
+    old = st.session_state.get("schedule_data")
+    if old is not None and old.title != poll.title:
+        # 他の画面でタイトルが変わっていたら、タイトル欄をキーごと作り直して新しい値を出す
+        st.session_state.title_generation = st.session_state.get("title_generation", 0) + 1
+    st.session_state.schedule_data = poll
+    st.session_state.schedule_revision = revision
+    # タイトル・候補日は、この版を読んだ画面の編集として書く（他の画面で先に変わっていたら書かない）
+    st.session_state.schedule_version = version
+    if 'meta_writer' in st.session_state:
+        st.session_state.meta_writer.rebase(version)
+
+def editable_data():
+    """書き換える前に呼ぶ。他のセッションと共有している Poll なら自分用の複製に差し替える"""
+    poll = event_cache(st.session_state.event_id).editable(st.session_state.schedule_data)
+    st.session_state.schedule_data = poll
+    return poll
+
+def meta_writer():
+    """このセッションのタイトル・候補日の書き込み待ち（schedule_sheet_store.MetaWriteBehind）"""
+    if 'meta_writer' not in st.session_state:
+        event_id = st.session_state.event_id
+        # 書けたら一覧のタイトル・更新日時も直す
+        st.session_state.meta_writer = schedule_sheet_store.MetaWriteBehind(
+            get_sheet(), st.session_state.get("schedule_version"), SAVE_DELAY_SECONDS, on_saved=lambda title: event_index().touch(event_id, title=title))
+    return st.session_state.meta_writer
+
+def refresh_if_changed():
+    """更新回数が手元より進んでいた時だけ読み直す"""
+    if meta_writer().has_pending:
+        # 書き込み待ちの編集がある間は読み直さない（手元の編集が古い内容に戻ってしまうので）
+        return False
+    revision = current_revision(st.session_state.event_id)
+    known = st.session_state.schedule_revision
+    if revision is None or (known is not None and revision <= known):
+        return False
+    set_data(*load_data_from_sheet(revision))
+    return True
 
 def save_data_to_sheet(data):
+    """投票も含めて全体を書き直す（候補日を作り直した時）"""
+    try:
+        # 書き込み待ちのタイトル・候補日は、これから書く内容の方が新しいので捨てる
+        meta_writer().discard()
+        before, after, version = schedule_sheet_store.save_all(get_sheet(), data)
+        event_index().touch(st.session_state.event_id, title=data.title)
+        # 手元で読んだ後に他の書き込みが無ければ、手元の内容がそのまま最新
+        st.session_state.schedule_revision = after if before == st.session_state.schedule_revision else None
+        st.session_state.schedule_version = version
+        meta_writer().rebase(version)
+    except Exception as e:
+        st.error(f"保存エラー: {e}")
+
+def submit_vote_to_sheet(user_name, score_changes, comment_changes):
+    """最新の内容に変わったセルだけを重ね、自分の行だけを書く。同時に書かれていたら読み直して再試行する"""
     try:
-        sheet = get_sheet()
-        json_str = json.dumps(data, ensure_ascii=False)
-        sheet.update_acell('A1', json_str)
+        # 候補日の編集が書き込み待ちなら先に書く（投票はシート上の候補日に対して重ねるので）
+        meta_writer().flush()
+        before, after, version, applied = schedule_sheet_store.submit_vote(get_sheet(), user_name, score_changes, comment_changes)
+        if before == st.session_state.schedule_revision:
+            # 手元で読んだ後に他の書き込みが無ければ、手元の内容に同じ変更を重ねたものが最新。
+            # 読み込まずに、他のセッションも使えるように共有する
+            poll = editable_data()
+            poll.apply_vote_changes(user_name, *applied)
+            event_cache(st.session_state.event_id).offer(poll, after, version)
+            set_data(poll, after, version)
+        else:
+            set_data(*load_data_from_sheet(after))
+        # 一覧の更新日時は、同じイベントなら1分に1回まで
+        event_index().touch(st.session_state.event_id)
+        return True
     except Exception as e:
         st.error(f"保存エラー: {e}")
+    return False
 
 # ==========================================
 # 2. アプリ設定
 # ==========================================
 st.set_page_config(page_title="日程調整AI (クラウド版)", page_icon="☁️", layout="wide")
 
-if 'schedule_data' not in st.session_state:
-    with st.spinner('クラウドからデータを読み込んでいます...'):
-        st.session_state.schedule_data = load_data_from_sheet()
+def open_event(event_id):
+    if event_id is None:
+        del st.query_params["event"]
+    else:
+        st.query_params["event"] = event_id
+    st.rerun()
 
-data = st.session_state.schedule_data
+# --- イベント一覧（URL にイベントIDが無い・見つからない時） ---
+def show_event_list():
+    st.title("☁️ 日程調整AI (Live Sync)")
+    st.subheader("イベント一覧")
+    include_archived = st.toggle("アーカイブ済みも表示")
+    events = list_events(include_archived)
+    if not events:
+        st.info("イベントはまだありません。下から作成してください。")
+    for event in events:
+        e1, e2, e3, e4 = st.columns([4, 2, 1, 1])
+        e1.write(f"**{event['タイトル']}**")
+        e2.caption(f"{event['状態']}・更新 {event['更新日時']}")
+        if e3.button("開く", key=f"open_{event['ID']}"):
+            open_event(event['ID'])
+        archived = event['状態'] == schedule_sheet_index.STATUS_ARCHIVED
+        if e4.button("戻す" if archived else "アーカイブ", key=f"archive_{event['ID']}"):
+            status = schedule_sheet_index.STATUS_OPEN if archived else schedule_sheet_index.STATUS_ARCHIVED
+            event_index().set_status(event['ID'], status)
+            list_events.clear()
+            st.rerun()
 
-# ==========================================
-# 3. ロジック関数
-# ==========================================
-def calculate_best_date():
-    if not data["dates"] or not data["votes"]:
-        return None, None, []
+    st.write("---")
+    with st.form("new_event"):
+        new_event_title = st.text_input("新しいイベント名", Poll().title)
+        if st.form_submit_button("イベントを作成 ➕", type="primary"):
+            new_event_id = event_index().create_event(new_event_title)
+            list_events.clear()
+            open_event(new_event_id)
 
-    df = pd.DataFrame(index=data["dates"])
-    users = list(data["votes"].keys())
-    
-    for user in users:
-        user_votes = data["votes"][user]
-        df[user] = df.index.map(lambda d: user_votes.get(d, 0))
+# イベントは URL の ?event=<ID> で選び、そのイベントのワークシートだけを読む
+event_id = st.query_params.get("event")
+if st.session_state.get("event_id") != event_id:
+    # 別のイベントに移ったら、前のイベントの書き込み待ちを書いてから手元の状態を捨てる
+    if 'meta_writer' in st.session_state:
+        st.session_state.meta_writer.flush()
+    for key in ["schedule_data", "schedule_revision", "schedule_version", "meta_writer", "title_generation", "shown_voters"]:
+        st.session_state.pop(key, None)
+    st.session_state.event_id = event_id
 
-    df["合計"] = df[users].sum(axis=1)
-    
-    def get_ng_names(row):
-        ng_list = [u for u in users if row[u] == 0]
-        return ", ".join(ng_list) if ng_list else ""
+if event_index().open_event(event_id) is None:
+    if event_id:
+        st.warning("イベントが見つかりません。一覧から選んでください。")
+    show_event_list()
+    st.stop()
 
-    df["NGの人"] = df.apply(get_ng_names, axis=1)
-    df["_ng_count"] = (df[users] == 0).sum(axis=1)
-    
-    df_sorted = df.sort_values(by=["合計", "_ng_count"], ascending=[False, True])
-    df_sorted = df_sorted.drop(columns=["_ng_count"])
-    
-    if not df_sorted.empty:
-        max_score = df_sorted["合計"].iloc[0]
-        top_dates = df_sorted[df_sorted["合計"] == max_score].index.tolist()
-    else:
-        top_dates = []
+if 'schedule_data' not in st.session_state:
+    with st.spinner('クラウドからデータを読み込んでいます...'):
+        set_data(*load_data_from_sheet(current_revision(event_id)))
 
-    return df, df_sorted, top_dates
+data = st.session_state.schedule_data
 
 # ==========================================
-# 4. UI構築
+# 3. UI構築
 # ==========================================
 st.title("☁️ 日程調整AI (Live Sync)")
 st.caption(f"Saving to Spreadsheet ID: ...{SPREADSHEET_KEY[-6:]}")
 
 tab1, tab2, tab3 = st.tabs(["① イベント作成", "② 投票入力", "③ 結果発表"])
 
+# --- 他の人の投票の自動反映（更新回数が進んだ時だけ読み直す部分更新） ---
+@st.fragment(run_every=REFRESH_SECONDS)
+def live_vote_status():
+    refresh_if_changed()
+    st.caption(f"🟢 {len(st.session_state.schedule_data.users)}人が投票済み（{REFRESH_SECONDS}秒ごとに自動で確認）")
+
 # --- タブ1: イベント作成 ---
 with tab1:
     c1, c2 = st.columns([2, 1])
-    new_title = c1.text_input("イベント名", data["title"])
-    
-    if new_title != data["title"]:
-        data["title"] = new_title
-        save_data_to_sheet(data)
-        st.toast("タイトルを保存しました")
+    c2.caption("🔗 このページのURL（?event=...）を共有すると、同じイベントに投票できます")
+    c2.code(f"?event={event_id}", language="text")
+    if c2.button("← イベント一覧へ"):
+        open_event(None)
+    # 編集はためておき、入力が止まってから1回だけ書く
+    def on_title_change(key):
+        event = editable_data()
+        event.title = st.session_state[key]
+        meta_writer().submit(event)
+
+    # キーを固定して、値が変わっても同じ入力欄のままにする（連続した編集が1つおきに捨てられないように）
+    title_key = f"event_title_{st.session_state.get('title_generation', 0)}"
+    c1.text_input("イベント名", data.title, key=title_key, on_change=on_title_change, args=(title_key,))
 
     st.subheader("候補日の自動生成")
     col_d1, col_d2, col_d3 = st.columns(3)
@@ -144,90 +281,135 @@ with tab1:
                     generated_dates.append(date_str)
                 curr += datetime.timedelta(days=1)
             
-            data["dates"] = generated_dates
-            data["votes"] = {} 
-            data["comments"] = {}
+            data = editable_data()
+            data.set_dates(generated_dates, reset=True)
             save_data_to_sheet(data)
             st.success("作成＆保存しました！")
             st.rerun()
 
     st.write("---")
     st.caption("👇 手動編集エリア")
-    current_text = "\n".join(data["dates"])
+    current_text = "\n".join(data.dates)
     edited_text = st.text_area("候補日一覧", value=current_text, height=150)
+    edited_dates = [d.strip() for d in edited_text.split('\n') if d.strip()]
+    if edited_dates != data.dates:
+        # 残した候補日は同じIDのままなので、投票は消えない
+        data = editable_data()
+        data.set_dates(edited_dates)
+        meta_writer().submit(data)
     if st.button("リスト保存"):
-        data["dates"] = [d.strip() for d in edited_text.split('\n') if d.strip()]
-        save_data_to_sheet(data)
-        st.success("保存しました！")
+        # 待たずに今すぐ書く
+        meta_writer().flush()
+        if meta_writer().status == 'saved':
+            st.success("保存しました！")
+
+    # --- 保存状況（書き込み待ちの間だけ1秒ごとに部分更新） ---
+    was_pending = meta_writer().status != 'saved'
+
+    @st.fragment(run_every=1 if was_pending else None)
+    def show_save_status():
+        writer = meta_writer()
+        if writer.status == 'unsaved':
+            st.caption("✏️ 未保存の変更があります（入力が止まると自動で保存します）")
+        elif writer.status == 'saving':
+            st.caption("⏳ 保存中...")
+        elif writer.status == 'error':
+            st.error(f"❌ 保存エラー: {writer.error}（「リスト保存」でもう一度保存できます）")
+        elif writer.status == 'conflict':
+            st.warning("⚠️ 他の画面でタイトル・候補日が先に変更されていたため、この変更は保存しませんでした。最新の内容を読み込んでから編集し直してください")
+        else:
+            st.caption("✅ すべての変更を保存しました")
+            # 書き込み待ちが無くなったら、1秒ごとの更新を止める
+            if was_pending:
+                st.rerun()
+
+    show_save_status()
 
 # --- タブ2: 投票入力 ---
 with tab2:
-    st.header(f"「{data['title']}」への投票")
+    st.header(f"「{data.title}」への投票")
     
-    if not data["dates"]:
+    if not data.date_ids:
         st.warning("候補日がありません。タブ①で作成してください。")
     else:
         st.info("💡 **凡例**: 🤩参加(3点) / 🤔未定(2点) / 🕒条件付(1点) / 🙅不可(0点)")
         
-        if st.button("🔄 他の人の投票を読み込む"):
-            st.session_state.schedule_data = load_data_from_sheet()
-            st.rerun()
+        live_vote_status()
 
         user_name = st.text_input("あなたの名前")
         
         if user_name:
             st.write("---")
-            with st.form("vote_form"):
-                answers = {}
-                comments_temp = {}
-                options = ["🤩 参加", "🤔 未定", "🕒 条件", "🙅 不可"]
-                
-                h1, h2, h3 = st.columns([1.5, 3, 2])
-                h1.caption("日程")
-                h2.caption("回答")
-                h3.caption("備考 (任意)")
-                
-                for date in data["dates"]:
-                    c1, c2, c3 = st.columns([1.5, 3, 2]) 
-                    c1.markdown(f"**{date}**")
-                    choice = c2.radio(f"{date}", options, horizontal=True, key=f"radio_{date}", label_visibility="collapsed")
-                    comment = c3.text_input(f"comment_{date}", placeholder="遅れます etc.", label_visibility="collapsed", key=f"comment_{date}")
-                    
-                    if "🤩" in choice: score = 3
-                    elif "🤔" in choice: score = 2
-                    elif "🕒" in choice: score = 1
-                    else: score = 0
-                    answers[date] = score
-                    if comment: comments_temp[date] = comment
-                
-                st.write("---")
-                if st.form_submit_button("投票する & 保存", type="primary"):
-                    current_cloud_data = load_data_from_sheet()
-                    current_cloud_data["votes"][user_name] = answers
-                    if "comments" not in current_cloud_data: current_cloud_data["comments"] = {}
-                    if user_name not in current_cloud_data["comments"]: current_cloud_data["comments"][user_name] = {}
-                    current_cloud_data["comments"][user_name] = comments_temp
-                    
-                    save_data_to_sheet(current_cloud_data)
-                    st.session_state.schedule_data = current_cloud_data
+            # 前回の回答を初期値にして、候補日ごとの 回答・備考 を1つの表で編集する
+            prev_answers = data.answers(user_name)
+            prev_comments = data.user_comments(user_name)
+            grid_key = f"vote_grid_{user_name}"
+            grid_source = (data.dates, prev_answers, prev_comments)
+            grid = st.session_state.get(grid_key)
+            # 候補日や保存済みの回答が変わった時だけ表を作り直す（キーを変えて編集内容も捨てる）
+            if grid is None or grid["source"] != grid_source:
+                grid = st.session_state[grid_key] = {
+                    "source": grid_source,
+                    "base": schedule_logic.vote_grid(data.dates, prev_answers, prev_comments),
+                    "version": grid["version"] + 1 if grid else 0,
+                }
+
+            edited_grid = st.data_editor(
+                grid["base"],
+                key=f"{grid_key}_{grid['version']}",
+                hide_index=True,
+                use_container_width=True,
+                disabled=["日程"],
+                column_config={
+                    "日程": st.column_config.TextColumn("日程"),
+                    "回答": st.column_config.SelectboxColumn("回答", options=schedule_logic.SCORE_OPTIONS, required=True),
+                    "備考": st.column_config.TextColumn("備考 (任意)", help="遅れます etc."),
+                },
+            )
+
+            # 一括入力（今の表の内容に上書きして、表を作り直す）
+            b1, b2, b3 = st.columns(3)
+            bulk = None
+            if b1.button("土日を全部 🤩参加"):
+                bulk = (schedule_logic.SCORE_OPTIONS[0], True)
+            if b2.button("全部 🤩参加"):
+                bulk = (schedule_logic.SCORE_OPTIONS[0], False)
+            if b3.button("全部 🙅不可"):
+                bulk = (schedule_logic.SCORE_OPTIONS[3], False)
+            if bulk:
+                grid["base"] = schedule_logic.fill_answers(edited_grid, *bulk)
+                grid["version"] += 1
+                st.rerun()
+
+            # 前回から変わったセルだけを送る
+            score_changes, comment_changes = schedule_logic.grid_changes(edited_grid, prev_answers, prev_comments)
+            n_changes = len(set(score_changes) | set(comment_changes))
+            st.caption(f"変更あり: {n_changes}日分" if n_changes else "前回の回答から変更はありません")
+
+            st.write("---")
+            if st.button("投票する & 保存", type="primary", disabled=not n_changes):
+                if submit_vote_to_sheet(user_name, score_changes, comment_changes):
                     st.success(f"{user_name}さんの投票をクラウドに保存しました！")
                     st.rerun()
 
-# --- タブ3: 結果発表 ---
-with tab3:
+# --- タブ3: 結果発表（数秒ごとにこの部分だけ再実行し、更新があった時だけ読み直して集計し直す） ---
+@st.fragment(run_every=REFRESH_SECONDS)
+def live_results():
     st.header("集計結果 🏆")
-    
-    if st.button("🔄 最新の集計を見る"):
-        st.session_state.schedule_data = load_data_from_sheet()
-        st.rerun()
+    refresh_if_changed()
+    data = st.session_state.schedule_data
+    # 風船は集計が変わった時だけ（自動更新のたびには飛ばさない）
+    celebrate = st.session_state.get("celebrated_revision", -1) != st.session_state.schedule_revision
+    st.session_state.celebrated_revision = st.session_state.schedule_revision
 
-    if not data["dates"] or not data["votes"]:
+    if not data.date_ids or not data.votes:
         st.info("データなし")
     else:
-        raw_df, ranked_df, top_dates = calculate_best_date()
+        # 1位タイは投票のたびに更新している順位の先頭から取る（生の投票は読み直さない）
+        top_dates = data.top_dates()
         
         if top_dates:
-            top_score = ranked_df.iloc[0]["合計"]
+            top_score = top_dates[0][1]
             st.success(f"🎉 最適な候補日は **{len(top_dates)}つ** あります！（スコア: {int(top_score)}点）")
             
             # --- LINE用テキスト出力機能 (改) ---
@@ -235,21 +417,21 @@ with tab3:
             st.subheader("📋 LINE連絡用コピー")
             
             # テキスト生成ロジック
-            clip_text = f"【{data['title']} 日程調整の結果 🗓️】\n\n"
+            clip_text = f"【{data.title} 日程調整の結果 🗓️】\n\n"
             
             if len(top_dates) == 1:
                 clip_text += "🎉 日程決定！\n"
-                clip_text += f"📅 {top_dates[0]}\n"
+                clip_text += f"📅 {top_dates[0][0]}\n"
             else:
                 clip_text += f"🎉 候補日が{len(top_dates)}つあります！\n"
                 clip_text += "以下の日程が一番人気です👇\n"
-                for d in top_dates:
+                for d, _, _ in top_dates:
                     clip_text += f"・ {d}\n"
 
             clip_text += f"\n📊 参加スコア: {int(top_score)}点\n"
             
             # NG情報の表示（代表して最初の日付のNGを表示）
-            ng_name = ranked_df.loc[top_dates[0], "NGの人"]
+            ng_name = top_dates[0][2]
             if ng_name:
                 clip_text += f"⚠️ NG: {ng_name}\n"
             else:
@@ -263,33 +445,58 @@ with tab3:
             # ---------------------------
 
             # 画面上の風船演出
-            for d in top_dates:
-                ng_ppl = ranked_df.loc[d, "NGの人"]
+            for d, _, ng_ppl in top_dates:
                 if ng_ppl:
                     st.warning(f"👑 **{d}** （NG: {ng_ppl}）")
                 else:
-                    st.balloons()
+                    if celebrate:
+                        st.balloons()
                     st.success(f"👑 **{d}** （全員参加可能！）")
 
+            # 条件つきの候補日選び（必須メンバー・最低人数・🕒を避ける）
+            st.write("---")
+            st.subheader("🧩 条件を指定して探す")
+            cc1, cc2, cc3 = st.columns([2, 1, 1])
+            must_members = cc1.multiselect("必ず参加してほしい人", data.users, key="must_members")
+            quorum = cc2.number_input("最低人数", min_value=0, max_value=len(data.users), value=0, key="quorum")
+            avoid_conditional = cc3.checkbox("🕒条件付が少ない日を優先", key="avoid_conditional")
+            best, blocked = schedule_logic.rank_with_constraints(data, must_members, quorum, avoid_conditional, k=5)
+            if best:
+                st.dataframe(pd.DataFrame(best), hide_index=True, use_container_width=True)
+            else:
+                st.warning("条件を満たす候補日がありません")
+            if blocked and (must_members or quorum):
+                with st.expander(f"条件を満たさない候補日（{len(blocked)}件）と理由"):
+                    st.dataframe(pd.DataFrame(blocked, columns=["日程", "理由"]), hide_index=True, use_container_width=True)
+
             st.write("---")
             st.subheader("📊 詳細ランキング表")
-            users = list(data["votes"].keys())
-            display_cols = ["合計", "NGの人"] + users
-            st.dataframe(ranked_df[display_cols].style.highlight_max(axis=0, subset=["合計"], color="#fffd75"))
+            # 集計の版ごとに1回だけ作った表を、ページと表示する投票者の列で切り出して出す
+            results = schedule_logic.results_table(data)
+            rc1, rc2, rc3 = st.columns([3, 1, 1])
+            # 選んだ投票者はセッションに残す（投票・自動更新のたびに最初の10人に戻らないように）。
+            # 最初は先頭の10人、その後に消えた投票者は選択から外す
+            if "shown_voters" not in st.session_state:
+                st.session_state.shown_voters = data.users[:10]
+            else:
+                st.session_state.shown_voters = [u for u in st.session_state.shown_voters if u in data.votes]
+            shown_voters = rc1.multiselect("表示する投票者", data.users, key="shown_voters")
+            page_size = rc2.selectbox("1ページの件数", [10, 20, 50], index=1, key="page_size")
+            n_pages = max(1, -(-len(results) // page_size))
+            page = rc3.number_input("ページ", min_value=1, max_value=n_pages, value=1, key="results_page")
+            page_df = schedule_logic.results_page(results, page - 1, page_size, shown_voters)
+            st.dataframe(schedule_logic.highlight_top(page_df, top_score), hide_index=True)
+            st.caption(f"{len(results)}件中 {(page - 1) * page_size + 1}〜{min(page * page_size, len(results))}位（{page}/{n_pages}ページ）")
             
             st.write("---")
             st.subheader("💬 日程ごとの備考")
-            has_comment = False
-            for date in data["dates"]:
-                day_comments = []
-                for user in users:
-                    if user in data["comments"] and date in data["comments"][user]:
-                        c = data["comments"][user][date]
-                        day_comments.append(f"**{user}**: {c}")
-                if day_comments:
-                    has_comment = True
-                    with st.expander(f"📍 {date}", expanded=True):
-                        for c in day_comments: st.write(f"- {c}")
-            if not has_comment: st.caption("コメントはありません")
+            dated_comments = data.comments_by_date()
+            for date, day_comments in dated_comments:
+                with st.expander(f"📍 {date}", expanded=True):
+                    for user, c in day_comments.items(): st.write(f"- **{user}**: {c}")
+            if not dated_comments: st.caption("コメントはありません")
         else:
-            st.warning("集計エラー")
\ No newline at end of file
+            st.warning("集計エラー")
+
+with tab3:
+    live_results()
@@ -0,0 +1,227 @@
+import re
+import heapq
+import numpy as np
+import pandas as pd
+
+# ==========================================
+# 日程調整の集計（候補日 × 投票者 の点数行列）
+# ==========================================
+# 投票を 候補日 × 投票者 の int8 行列（schedule_poll.Poll.score_matrix）にまとめ、
+# 詳細表の合計・NGの人を配列演算で求める。順位は Poll が投票のたびに差分で更新している。
+# schedule.py / schedule_gsheet.py の両方から使う。
+# 点数: 3=参加 / 2=未定 / 1=条件付 / 0=不可（未回答も 0 として扱う）
+
+
+def ng_names(matrix, users):
+    """候補日ごとの NG の人（0点の人）を 'A, B' の形で返す"""
+    names = np.asarray(users, dtype=object)
+    date_idx, user_idx = np.nonzero(matrix == 0)
+    result = np.full(matrix.shape[0], "", dtype=object)
+    if len(date_idx):
+        # nonzero は行順に並ぶので、候補日ごとの区切り位置で分割する
+        bounds = np.flatnonzero(np.diff(date_idx)) + 1
+        for rows, cols in zip(np.split(date_idx, bounds), np.split(user_idx, bounds)):
+            result[rows[0]] = ", ".join(names[cols])
+    return result
+
+
+def score_table(dates, matrix, users):
+    """候補日ごとの 各投票者の点数・合計・NGの人 の表"""
+    df = pd.DataFrame(matrix.astype(np.int64), index=list(dates), columns=users)
+    df["合計"] = matrix.sum(axis=1, dtype=np.int32)
+    df["NGの人"] = ng_names(matrix, users)
+    return df
+
+
+def calculate_best_date(poll):
+    """(集計表, 順位順の集計表, 1位タイの候補日) を返す。poll は schedule_poll.Poll
+
+    順位（合計の降順、同点は NG の少ない順、さらに同じなら候補日順）は poll が投票のたびに
+    差分更新しているので、ここでは並べ替えずにその順に並べるだけ。
+    """
+    if not poll.date_ids or not poll.votes:
+        return None, None, []
+    matrix, users = poll.score_matrix()
+    df = score_table(poll.dates, matrix, users)
+    df_sorted = df.iloc[[poll.position[i] for i in poll.ranked_ids()]]
+    top_dates = [label for label, _, _ in poll.top_dates()]
+    return df, df_sorted, top_dates
+
+
+# --- 詳細ランキング表（集計の版ごとに1回だけ作り、ページ単位で表示する） ---
+def results_table(poll):
+    """順位順の詳細表（順位・日程・合計・NGの人・各投票者）。poll.version が変わった時だけ作り直す"""
+    table = poll.view_cache.get("results")
+    if table is None:
+        _, ranked_df, _ = calculate_best_date(poll)
+        table = ranked_df.rename_axis("日程").reset_index()
+        table.insert(0, "順位", np.arange(1, len(table) + 1))
+        poll.view_cache["results"] = table
+    return table
+
+
+def results_page(table, page, page_size, voters):
+    """表示する投票者の列だけを残した page ページ目（0始まり）"""
+    columns = ["順位", "日程", "合計", "NGの人"] + list(voters)
+    return table.iloc[page * page_size:(page + 1) * page_size][columns]
+
+
+def highlight_top(page_df, top_score, color="#fffd75"):
+    """1位タイの合計セルだけ色をつける（表示中のページにだけ Styler をかける）"""
+    return page_df.style.map(lambda v: f"background-color: {color}" if v == top_score else "", subset=["合計"])
+
+
+# --- 条件つきの候補日選び（候補日ごとの投票者ビット集合） ---
+def availability_bitsets(matrix):
+    """候補日ごとに「参加できる（1点以上）」「🕒条件付（1点）」の投票者を int のビット集合で返す
+
+    投票者 j は下から j 番目のビット。
+    """
+    def to_ints(mask):
+        packed = np.packbits(mask, axis=1, bitorder='little')
+        return [int.from_bytes(row.tobytes(), 'little') for row in packed]
+    return to_ints(matrix > 0), to_ints(matrix == 1)
+
+
+def _names(bits, users):
+    return [users[j] for j in range(bits.bit_length()) if bits >> j & 1]
+
+
+def rank_with_constraints(poll, must=(), quorum=0, avoid_conditional=False, k=5):
+    """条件を満たす候補日の上位 k 件と、満たさない候補日の理由を返す
+
+    must: 必ず参加（NGでない）してほしい人 / quorum: 参加できる人数の下限 /
+    avoid_conditional: 🕒条件付 の人が少ない日を優先する
+    戻り値: ([{日程, 合計, 参加可能, 条件付}, ...], [(日程, 理由), ...])
+    """
+    if not poll.date_ids or not poll.votes:
+        return [], []
+    matrix, users = poll.score_matrix()
+    available, conditional = availability_bitsets(matrix)
+    bit = {u: 1 << j for j, u in enumerate(users)}
+    must_bits = 0
+    for u in must:
+        must_bits |= bit.get(u, 0)
+    totals = matrix.sum(axis=1, dtype=np.int32)
+
+    candidates = []
+    blocked = []
+    for pos, date in enumerate(poll.dates):
+        missing = must_bits & ~available[pos]
+        n_available = available[pos].bit_count()
+        reasons = []
+        if missing:
+            reasons.append("必須メンバーがNG: " + ", ".join(_names(missing, users)))
+        if n_available < quorum:
+            reasons.append(f"人数不足: {n_available}人 / {quorum}人")
+        if reasons:
+            blocked.append((date, " / ".join(reasons)))
+            continue
+        n_conditional = conditional[pos].bit_count()
+        # 🕒を避ける時は条件付の人数を最優先、あとは 合計の降順 → 参加可能人数の降順 → 候補日順
+        key = (n_conditional if avoid_conditional else 0, -int(totals[pos]), -n_available, pos)
+        candidates.append((key, date, int(totals[pos]), n_available, n_conditional))
+
+    best = heapq.nsmallest(k, candidates)
+    return [
+        {"日程": date, "合計": total, "参加可能": n_available, "条件付": n_conditional}
+        for _, date, total, n_available, n_conditional in best
+    ], blocked
+
+
+# --- 投票入力の表（候補日ごとの 回答・備考 を1つの表で編集する） ---
+SCORE_OPTIONS = ["🤩 参加", "🤔 未定", "🕒 条件", "🙅 不可"]
+OPTION_SCORES = {option: 3 - i for i, option in enumerate(SCORE_OPTIONS)}
+WEEKEND_PATTERN = re.compile(r'\((土|日)\)')
+
+
+def score_option(score):
+    return SCORE_OPTIONS[3 - int(score)]
+
+
+def is_weekend(date):
+    """'3/14(土) 19:00〜' のような候補日が土日かどうか"""
+    return WEEKEND_PATTERN.search(date) is not None
+
+
+def vote_grid(dates, answers, comments):
+    """前回の回答を初期値にした投票表を作る（未回答の日は 参加）"""
+    return pd.DataFrame({
+        "日程": list(dates),
+        "回答": [score_option(answers.get(d, 3)) for d in dates],
+        "備考": [comments.get(d, "") for d in dates],
+    })
+
+
+def fill_answers(grid, option, weekend_only=False):
+    """一括入力: 全候補日（または土日だけ）の回答を option にした表を返す"""
+    grid = grid.copy()
+    mask = grid["日程"].map(is_weekend) if weekend_only else slice(None)
+    grid.loc[mask, "回答"] = option
+    return grid
+
+
+def grid_changes(grid, answers, comments):
+    """前回の回答から変わったセルだけを ({日付: 点数}, {日付: 備考}) で返す。備考の '' は削除"""
+    score_changes = {}
+    comment_changes = {}
+    for date, option, comment in zip(grid["日程"], grid["回答"], grid["備考"]):
+        score = OPTION_SCORES.get(option, 0)
+        if answers.get(date) != score:
+            score_changes[date] = score
+        comment = comment.strip() if isinstance(comment, str) else ""
+        if comments.get(date, "") != comment:
+            comment_changes[date] = comment
+    return score_changes, comment_changes
+
+
+def _calculate_best_date_pandas(data):
+    """以前の実装（ベンチマークと結果の照合用）"""
+    df = pd.DataFrame(index=data["dates"])
+    users = list(data["votes"].keys())
+    for user in users:
+        user_votes = data["votes"][user]
+        df[user] = df.index.map(lambda d: user_votes.get(d, 0))
+    df["合計"] = df[users].sum(axis=1)
+
+    def get_ng_names(row):
+        ng_list = [u for u in users if row[u] == 0]
+        return ", ".join(ng_list) if ng_list else ""
+
+    df["NGの人"] = df.apply(get_ng_names, axis=1)
+    df["_ng_count"] = (df[users] == 0).sum(axis=1)
+    df_sorted = df.sort_values(by=["合計", "_ng_count"], ascending=[False, True]).drop(columns=["_ng_count"])
+    max_score = df_sorted["合計"].iloc[0]
+    return df, df_sorted, df_sorted[df_sorted["合計"] == max_score].index.tolist()
+
+
+if __name__ == "__main__":
+    import time
+    import warnings
+    from schedule_poll import Poll
+
+    # 簡易ベンチマーク: 投票者 1000人 × 候補日 365日
+    rng = np.random.default_rng(0)
+    dates = [f"日程{i}" for i in range(365)]
+    scores = rng.choice([0, 1, 2, 3], size=(1000, len(dates)), p=[0.1, 0.2, 0.3, 0.4])
+    data = {
+        "dates": dates,
+        "votes": {f"user{u}": dict(zip(dates, map(int, scores[u]))) for u in range(1000)},
+        "comments": {},
+    }
+
+    poll = Poll.from_dict(data)
+    t0 = time.perf_counter()
+    _, new_sorted, new_top = calculate_best_date(poll)
+    t1 = time.perf_counter()
+    with warnings.catch_warnings():
+        # 列を1本ずつ足す旧実装は PerformanceWarning が大量に出る
+        warnings.simplefilter("ignore")
+        _, old_sorted, old_top = _calculate_best_date_pandas(data)
+    t2 = time.perf_counter()
+
+    assert new_top == old_top
+    assert new_sorted.index.tolist() == old_sorted.index.tolist()
+    assert new_sorted["NGの人"].tolist() == old_sorted["NGの人"].tolist()
+    assert new_sorted["合計"].tolist() == old_sorted["合計"].tolist()
+    print(f"行列版: {(t1 - t0) * 1000:.1f}ms / pandas版: {(t2 - t1) * 1000:.1f}ms")
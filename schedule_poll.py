@@ -0,0 +1,374 @@
+import base64
+import bisect
+import numpy as np
+from schedule_slots import SlotGrid
+
+# ==========================================
+# 日程調整データの保存形式（候補日ID + 2bit 詰めの回答）
+# ==========================================
+# 候補日は 表示文字列 ではなく、変わらない整数ID で管理する。
+# 各投票者の回答は「候補日ID番目の2bit」に点数(0〜3)を詰めたバイト列と、
+# 答えた候補日IDのビットを立てた整数（回答済みの印）で持つ。点数は4通りとも使うので、
+# 未回答は点数とは別に印で区別する（3日目だけ答えた人の1・2日目は未回答のまま）。
+# 備考は書かれた日だけを {候補日ID: コメント} で持つ。
+# 候補日リストを編集しても、同じ表示文字列の日はIDを引き継ぐので投票が消えない。
+#
+# 保存形式（version 3）:
+#   {"version": 3, "title": ..., "next_id": 3,
+#    "dates": [[0, "3/14(土) 19:00〜"], [2, "3/21(土) 19:00〜"]],
+#    "votes": {"ユーザー": ["0x4", "base64"]},   # 回答済みの印（16進）, 点数
+#    "comments": {"ユーザー": {"2": "遅れます"}}}
+# version 2 までは回答済みの印の代わりに「先頭から何個の候補日IDに答えたか」の数を持っていた（読み込みはどちらも可）
+
+FORMAT_VERSION = 3
+DEFAULT_TITLE = "未定のイベント"
+
+
+def pack_scores(scores):
+    """点数の配列（0〜3）を 1バイト4日分 に詰める"""
+    scores = np.asarray(scores, dtype=np.uint8)
+    padded = np.zeros(-(-len(scores) // 4) * 4, dtype=np.uint8)
+    padded[:len(scores)] = scores
+    quads = padded.reshape(-1, 4)
+    return (quads[:, 0] | (quads[:, 1] << 2) | (quads[:, 2] << 4) | (quads[:, 3] << 6)).tobytes()
+
+
+def answered_mask(value):
+    """保存された回答済みの印を整数にする。"0x.." は候補日IDごとのビット、数は version 2 までの「先頭から n 個」"""
+    if isinstance(value, str) and value.startswith("0x"):
+        return int(value, 16)
+    return (1 << int(value or 0)) - 1
+
+
+def unpack_scores(packed, n):
+    """pack_scores の逆。長さ n の点数配列を返す"""
+    b = np.frombuffer(packed, dtype=np.uint8)
+    scores = np.stack([b & 3, (b >> 2) & 3, (b >> 4) & 3, b >> 6], axis=1).reshape(-1)
+    out = np.zeros(n, dtype=np.uint8)
+    m = min(n, len(scores))
+    out[:m] = scores[:m]
+    return out
+
+
+class Poll:
+    def __init__(self, title=DEFAULT_TITLE):
+        self.title = title
+        self.date_ids = []  # 表示順の候補日ID
+        self.position = {}  # 候補日ID → 表示順
+        self.labels = {}    # 候補日ID → 表示文字列
+        self.next_id = 0
+        self.votes = {}     # ユーザー → (回答済みの印, 2bit 詰めの bytes)。未回答の候補日の点数は 0 のまま
+        self.comments = {}  # ユーザー → {候補日ID: コメント}
+        self.slot_grid = None  # 時間帯モードの空き時間グリッド（schedule_slots.SlotGrid、使う時だけ）
+        # 結果表示用の逆引き（候補日ID → {ユーザー: コメント}）。保存はせず、投票・候補日の編集のたびに更新する
+        self.comment_index = {}
+        # 集計も投票のたびに差分で更新する（候補日IDで引く配列）。未回答は 0点 = NG として数える
+        self.totals = np.zeros(0, dtype=np.int32)
+        self.ng_counts = np.zeros(0, dtype=np.int32)
+        # 順位: (-合計, NG数, 表示順, 候補日ID) の昇順リスト
+        self.ranking = []
+        self._rank_keys = {}
+        # 集計の版。投票・候補日の編集のたびに上がり、表示用に作った表（view_cache）も捨てる
+        self.version = 0
+        self.view_cache = {}
+
+    def _changed(self):
+        self.version += 1
+        self.view_cache = {}
+
+    # --- 候補日 ---
+    @property
+    def dates(self):
+        return [self.labels[i] for i in self.date_ids]
+
+    @property
+    def users(self):
+        return list(self.votes.keys())
+
+    def set_dates(self, labels, reset=False):
+        """候補日リストを差し替える。同じ表示文字列の日は元のIDを引き継ぐ（reset=True なら投票も消す）"""
+        if reset:
+            self.labels, self.date_ids = {}, []
+            self.votes, self.comments, self.comment_index = {}, {}, {}
+            self.totals[:] = 0
+            self.ng_counts[:] = 0
+        existing = {}
+        for date_id in self.date_ids:
+            existing.setdefault(self.labels[date_id], []).append(date_id)
+        date_ids = []
+        for label in labels:
+            reuse = existing.get(label)
+            if reuse:
+                date_ids.append(reuse.pop(0))
+            else:
+                date_ids.append(self.next_id)
+                self.labels[self.next_id] = label
+                self.next_id += 1
+        # 消えた候補日の表示文字列と備考は捨てる。IDは再利用しないので、回答のビットが残っていても集計には出ない
+        self.labels = {i: self.labels[i] for i in date_ids}
+        self.date_ids = date_ids
+        self.position = {i: pos for pos, i in enumerate(date_ids)}
+        for user in list(self.comments):
+            kept = {i: c for i, c in self.comments[user].items() if i in self.labels}
+            if kept:
+                self.comments[user] = kept
+            else:
+                del self.comments[user]
+        for date_id in [i for i in self.comment_index if i not in self.labels]:
+            del self.comment_index[date_id]
+        # 表示順が変わるので順位は並べ直す（候補日の編集はまれなので全体を作り直す）
+        self._grow_tally()
+        self._rebuild_ranking()
+        self._changed()
+
+    # --- 投票 ---
+    def answers(self, user):
+        """{表示文字列: 点数} を返す。まだ回答していない候補日は含めない"""
+        if user not in self.votes:
+            return {}
+        answered, packed = self.votes[user]
+        scores = unpack_scores(packed, answered.bit_length())
+        return {self.labels[i]: int(scores[i]) for i in self.date_ids if answered >> i & 1}
+
+    def user_comments(self, user):
+        """{表示文字列: コメント} を返す"""
+        return {self.labels[i]: c for i, c in self.comments.get(user, {}).items() if i in self.labels}
+
+    def apply_vote_changes(self, user, score_changes, comment_changes):
+        """{表示文字列: 点数} / {表示文字列: コメント}（'' は削除）の変わったセルだけを反映する"""
+        ids = {label: i for i, label in self.labels.items()}
+        is_new = user not in self.votes
+        answered, packed = self.votes.get(user, (0, b""))
+        old_scores = unpack_scores(packed, self.next_id)
+        scores = old_scores.copy()
+        # 今回答えた候補日にだけ印をつける（答えていない日・後から足された日は未回答のまま）
+        for label, score in score_changes.items():
+            scores[ids[label]] = score
+            answered |= 1 << ids[label]
+        self.votes[user] = (answered, pack_scores(scores[:answered.bit_length()]))
+        self._update_tally(old_scores, scores, is_new)
+
+        user_comments = self.comments.setdefault(user, {})
+        for label, comment in comment_changes.items():
+            date_id = ids[label]
+            if comment:
+                user_comments[date_id] = comment
+                self.comment_index.setdefault(date_id, {})[user] = comment
+            else:
+                user_comments.pop(date_id, None)
+                day = self.comment_index.get(date_id, {})
+                day.pop(user, None)
+                if not day:
+                    self.comment_index.pop(date_id, None)
+        if not user_comments:
+            del self.comments[user]
+        self._changed()
+
+    # --- 集計（差分更新） ---
+    def _grow_tally(self):
+        """候補日IDが増えた分の集計欄を足す。新しい候補日は全員未回答（NG）から始まる"""
+        grow = self.next_id - len(self.totals)
+        if grow > 0:
+            self.totals = np.concatenate([self.totals, np.zeros(grow, dtype=np.int32)])
+            self.ng_counts = np.concatenate([self.ng_counts, np.full(grow, len(self.votes), dtype=np.int32)])
+
+    def _rank_key(self, date_id):
+        return (-int(self.totals[date_id]), int(self.ng_counts[date_id]), self.position[date_id], date_id)
+
+    def _rebuild_ranking(self):
+        self._rank_keys = {i: self._rank_key(i) for i in self.date_ids}
+        self.ranking = sorted(self._rank_keys.values())
+
+    def _update_tally(self, old_scores, new_scores, is_new):
+        """1人分の回答の変化（候補日ID順の点数配列）を合計・NG数・順位に反映する"""
+        self._grow_tally()
+        if is_new:
+            # 新しい投票者は「全候補日 0点」からの変更として数える
+            self.ng_counts += 1
+        changed = np.flatnonzero(old_scores != new_scores)
+        self.totals[changed] += new_scores[changed].astype(np.int32) - old_scores[changed]
+        self.ng_counts[changed] += (new_scores[changed] == 0).astype(np.int32) - (old_scores[changed] == 0)
+
+        moved = self.date_ids if is_new else [i for i in changed.tolist() if i in self.position]
+        if len(moved) * 8 > len(self.ranking):
+            # 大半の候補日が動いた時は並べ直した方が速い
+            self._rebuild_ranking()
+            return
+        for date_id in moved:
+            old_key = self._rank_keys[date_id]
+            del self.ranking[bisect.bisect_left(self.ranking, old_key)]
+            new_key = self._rank_key(date_id)
+            bisect.insort(self.ranking, new_key)
+            self._rank_keys[date_id] = new_key
+
+    def _rebuild_tally(self):
+        """生の回答から集計を全部作り直す（読み込み時と照合用）"""
+        self.totals = np.zeros(self.next_id, dtype=np.int32)
+        self.ng_counts = np.zeros(self.next_id, dtype=np.int32)
+        if self.date_ids and self.votes:
+            matrix, _ = self.score_matrix()
+            ids = np.asarray(self.date_ids, dtype=np.int64)
+            self.totals[ids] = matrix.sum(axis=1, dtype=np.int32)
+            self.ng_counts[ids] = (matrix == 0).sum(axis=1)
+        self._rebuild_ranking()
+
+    def ng_users(self, date_id):
+        """その候補日が 0点（未回答を含む）の投票者。1列分だけ詰めたビットから読む"""
+        byte, shift = divmod(date_id, 4)
+        return [u for u, (answered, packed) in self.votes.items()
+                if not answered >> date_id & 1 or (packed[byte] >> (shift * 2)) & 3 == 0]
+
+    def top_dates(self):
+        """1位タイの候補日を [(表示文字列, 合計, NGの人), ...] で返す。順位リストの先頭だけを見る"""
+        if not self.ranking or not self.votes:
+            return []
+        best = self.ranking[0][0]
+        result = []
+        for key in self.ranking:
+            if key[0] != best:
+                break
+            date_id = key[3]
+            result.append((self.labels[date_id], -best, ", ".join(self.ng_users(date_id))))
+        return result
+
+    def ranked_ids(self):
+        return [key[3] for key in self.ranking]
+
+    def comments_by_date(self):
+        """備考のある候補日だけを候補日順に [(表示文字列, {ユーザー: コメント}), ...] で返す"""
+        return [(self.labels[i], self.comment_index[i]) for i in sorted(self.comment_index, key=self.position.get)]
+
+    def score_matrix(self):
+        """(行列[候補日, 投票者] int8, 投票者リスト) を返す。未回答は 0"""
+        users = self.users
+        width = -(-self.next_id // 4)
+        buf = np.zeros((len(users), width), dtype=np.uint8)
+        for row, user in enumerate(users):
+            _, packed = self.votes[user]
+            # 未回答の候補日は 0 点のまま詰めてある（回答後に増えた候補日は詰めたビットの外なので 0）
+            b = np.frombuffer(packed, dtype=np.uint8)[:width]
+            buf[row, :len(b)] = b
+        scores = np.stack([buf & 3, (buf >> 2) & 3, (buf >> 4) & 3, buf >> 6], axis=2).reshape(len(users), -1)
+        ids = np.asarray(self.date_ids, dtype=np.int64)
+        return scores[:, ids].T.astype(np.int8), users
+
+    # --- 保存形式との変換 ---
+    def to_dict(self):
+        return {
+            "version": FORMAT_VERSION,
+            "title": self.title,
+            "next_id": self.next_id,
+            "dates": [[i, self.labels[i]] for i in self.date_ids],
+            "votes": {u: [hex(a), base64.b64encode(p).decode('ascii')] for u, (a, p) in self.votes.items()},
+            "comments": {u: {str(i): c for i, c in cs.items()} for u, cs in self.comments.items()},
+            "slots": self.slot_grid.to_dict() if self.slot_grid else None,
+        }
+
+    @classmethod
+    def from_dict(cls, raw):
+        """保存データから復元する。表示文字列をキーにした旧形式（version なし）はここで移行する"""
+        if raw.get("version") not in (2, FORMAT_VERSION):
+            return cls._from_legacy(raw)
+        poll = cls(raw.get("title", DEFAULT_TITLE))
+        poll.next_id = int(raw["next_id"])
+        poll.date_ids = [int(i) for i, _ in raw["dates"]]
+        poll.labels = {int(i): label for i, label in raw["dates"]}
+        poll.position = {i: pos for pos, i in enumerate(poll.date_ids)}
+        poll.votes = {u: (answered_mask(a), base64.b64decode(p)) for u, (a, p) in raw.get("votes", {}).items()}
+        poll.comments = {u: {int(i): c for i, c in cs.items()} for u, cs in raw.get("comments", {}).items()}
+        if raw.get("slots"):
+            poll.slot_grid = SlotGrid.from_dict(raw["slots"])
+        for user, user_comments in poll.comments.items():
+            for date_id, comment in user_comments.items():
+                poll.comment_index.setdefault(date_id, {})[user] = comment
+        poll._rebuild_tally()
+        return poll
+
+    @classmethod
+    def _from_legacy(cls, raw):
+        """{"dates": [表示文字列], "votes": {ユーザー: {表示文字列: 点数}}, "comments": {...}} からの移行"""
+        poll = cls(raw.get("title", DEFAULT_TITLE))
+        poll.set_dates(raw.get("dates", []))
+        known = set(poll.labels.values())
+        for user, user_votes in raw.get("votes", {}).items():
+            # 候補日リストの編集で孤立していた回答は移行しない
+            poll.apply_vote_changes(
+                user,
+                {d: s for d, s in user_votes.items() if d in known},
+                {d: c for d, c in raw.get("comments", {}).get(user, {}).items() if d in known and c},
+            )
+        return poll
+
+
+if __name__ == "__main__":
+    import json
+    import tracemalloc
+
+    # 大きな投票（投票者 1000人 × 候補日 365日、備考は 2% 程度）での保存サイズとメモリの比較
+    rng = np.random.default_rng(0)
+    dates = [f"{1 + d // 28}/{1 + d % 28}(土) 19:00〜" for d in range(365)]
+    scores = rng.integers(0, 4, size=(1000, len(dates)))
+    legacy = {"title": "ベンチマーク", "dates": dates, "votes": {}, "comments": {}}
+    for u in range(1000):
+        legacy["votes"][f"user{u}"] = dict(zip(dates, map(int, scores[u])))
+        legacy["comments"][f"user{u}"] = {d: "遅れます" for d in dates if rng.random() < 0.02}
+
+    tracemalloc.start()
+    legacy_copy = json.loads(json.dumps(legacy, ensure_ascii=False))
+    legacy_mem = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    poll = Poll.from_dict(legacy)
+    tracemalloc.start()
+    compact = Poll.from_dict(json.loads(json.dumps(poll.to_dict(), ensure_ascii=False)))
+    compact_mem = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    legacy_size = len(json.dumps(legacy, ensure_ascii=False).encode('utf-8'))
+    compact_size = len(json.dumps(poll.to_dict(), ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+    assert all(compact.answers(f"user{u}") == legacy["votes"][f"user{u}"] for u in range(0, 1000, 97))
+    print(f"JSON: 旧形式 {legacy_size / 1024:,.0f}KB / 新形式 {compact_size / 1024:,.0f}KB")
+    print(f"メモリ: 旧形式 {legacy_mem / 1024:,.0f}KB / 新形式 {compact_mem / 1024:,.0f}KB")
+
+    # 差分更新した集計と、生の回答からの全集計の照合（再投票・候補日の追加削除を混ぜる）
+    def tally_snapshot(p):
+        return p.totals[p.date_ids].tolist(), p.ng_counts[p.date_ids].tolist(), list(p.ranking)
+
+    poll = Poll()
+    poll.set_dates([f"候補{i}" for i in range(40)])
+    for step in range(2000):
+        op = rng.random()
+        if op < 0.02:
+            labels = [d for d in poll.dates if rng.random() > 0.05] + [f"追加{step}-{j}" for j in range(3)]
+            poll.set_dates(list(rng.permutation(labels)))
+        else:
+            user = f"user{rng.integers(0, 60)}"
+            dates_now = poll.dates
+            k = int(rng.integers(1, len(dates_now) + 1))
+            picked = rng.choice(len(dates_now), size=k, replace=False)
+            poll.apply_vote_changes(user, {dates_now[i]: int(rng.integers(0, 4)) for i in picked}, {})
+        if step % 50 == 0 or step == 1999:
+            incremental = tally_snapshot(poll)
+            poll_full = Poll.from_dict(poll.to_dict())
+            assert incremental == tally_snapshot(poll_full), f"集計がずれました (step {step})"
+    print(f"差分集計と全集計が一致: 投票者 {len(poll.votes)}人 / 候補日 {len(poll.date_ids)}日")
+
+    # 備考だけ・一部の日だけの投票では、答えていない候補日（間の日・後から足した日も）は未回答のまま
+    poll = Poll()
+    poll.set_dates(["3/14", "3/21"])
+    poll.apply_vote_changes("A", {"3/14": 3}, {})
+    poll.set_dates(["3/14", "3/21", "3/28"])
+    poll.apply_vote_changes("A", {}, {"3/28": "遅れます"})
+    assert poll.answers("A") == {"3/14": 3}
+    poll.apply_vote_changes("A", {"3/28": 2}, {})
+    poll.apply_vote_changes("B", {"3/28": 1}, {})
+    assert poll.answers("A") == {"3/14": 3, "3/28": 2} and poll.answers("B") == {"3/28": 1}
+    restored = Poll.from_dict(json.loads(json.dumps(poll.to_dict())))
+    assert restored.answers("A") == poll.answers("A") and restored.answers("B") == {"3/28": 1}
+    assert poll.totals[poll.date_ids].tolist() == restored.totals[poll.date_ids].tolist() == [3, 0, 3]
+    assert poll.ng_users(poll.date_ids[1]) == ["A", "B"] and poll.ng_users(poll.date_ids[0]) == ["B"]
+
+    # version 2 の「先頭から n 個に回答済み」もそのまま読める
+    old = {"version": 2, "title": "旧", "next_id": 3, "dates": [[0, "3/14"], [1, "3/21"], [2, "3/28"]],
+           "votes": {"A": [2, base64.b64encode(pack_scores([3, 0])).decode('ascii')]}, "comments": {}}
+    assert Poll.from_dict(old).answers("A") == {"3/14": 3, "3/21": 0}
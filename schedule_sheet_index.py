@@ -0,0 +1,188 @@
+import time
+import datetime
+import secrets
+import threading
+from gspread.exceptions import WorksheetNotFound
+import schedule_sheet_store
+from schedule_poll import Poll
+from schedule_store import valid_event_id
+
+# ==========================================
+# 1つのスプレッドシートに複数のイベント（イベントごとにワークシート + 一覧）
+# ==========================================
+# イベントはそれぞれ「イベントID」という名前のワークシートに schedule_sheet_store の配置で入れる。
+# 「イベント一覧」シートに ID・タイトル・状態・更新日時 を1行ずつ持つので、一覧の表示やアーカイブは
+# 各イベントのシートを開かずにこの1枚だけで済む。イベントを開く時は URL の ID のシートだけを読む。
+# 開けるのは一覧に載っている ID だけ（?event=Sheet1 のように一覧に無いシート名では開かない）。
+# 見つからなかった ID は少しの間覚えておき、同じ ID で開き直すたびに一覧を読まないようにする。
+# 以前の1件だけの運用（最初のシートにイベント）は、一覧を作る時に新しいIDのシートへ写して一覧に載せる。
+
+INDEX_TITLE = "イベント一覧"
+INDEX_HEADER = ["ID", "タイトル", "状態", "更新日時"]
+STATUS_OPEN = "募集中"
+STATUS_ARCHIVED = "アーカイブ"
+# 投票のたびに一覧の更新日時を書くとクォータを食うので、同じイベントは間隔をあける
+TOUCH_INTERVAL_SECONDS = 60
+# 見つからなかった ID を覚えておく秒数と件数（別のプロセスで作られたイベントも、この秒数たてば開ける）
+MISS_RECHECK_SECONDS = 30
+MAX_MISSES = 1000
+
+
+def _now():
+    return datetime.datetime.now().strftime('%Y-%m-%d %H:%M')
+
+
+class EventIndex:
+    def __init__(self, sh):
+        self.sh = sh
+        self._index_ws = None
+        self._worksheets = {}   # イベントID → ワークシート（一度開いたものは覚えておく）
+        self._touched = {}      # イベントID → 最後に一覧の更新日時を書いた時刻
+        self._missing = {}      # 見つからなかったイベントID → 確かめた時刻
+        self._lock = threading.RLock()
+
+    # --- 一覧シート ---
+    def index_sheet(self):
+        with self._lock:
+            if self._index_ws is None:
+                try:
+                    self._index_ws = self.sh.worksheet(INDEX_TITLE)
+                except WorksheetNotFound:
+                    self._index_ws = self.sh.add_worksheet(title=INDEX_TITLE, rows="100", cols=str(len(INDEX_HEADER)))
+                    self._index_ws.append_row(INDEX_HEADER, value_input_option='RAW')
+                    self._import_first_sheet()
+            return self._index_ws
+
+    def _import_first_sheet(self):
+        """1件だけの運用だった時の最初のシート（A1 の JSON / 行ごとの配置）を、新しいIDのイベントとして一覧に載せる"""
+        first = self.sh.sheet1
+        if first.title == INDEX_TITLE:
+            return
+        kind, poll, _, _, _ = schedule_sheet_store.parse_rows(first.get_all_values())
+        if kind == 'empty':
+            return
+        # 元のシートはそのまま残す（写した後も消さない）
+        self.create_event(poll.title, poll)
+
+    def list_events(self, include_archived=False):
+        """[{"ID", "タイトル", "状態", "更新日時"}, ...] を更新日時の新しい順で返す。一覧シートだけを読む"""
+        rows = self.index_sheet().get_all_values()[1:]
+        events = [dict(zip(INDEX_HEADER, row + [""] * (len(INDEX_HEADER) - len(row)))) for row in rows if row and row[0]]
+        if not include_archived:
+            events = [e for e in events if e["状態"] != STATUS_ARCHIVED]
+        return sorted(events, key=lambda e: e["更新日時"], reverse=True)
+
+    def _find_row(self, event_id):
+        ids = self.index_sheet().col_values(1)
+        return ids.index(event_id) + 1 if event_id in ids[1:] else None
+
+    def _update_row(self, event_id, fields):
+        with self._lock:
+            at = self._find_row(event_id)
+            if at is None:
+                raise KeyError(event_id)
+            data = [{"range": f"{chr(ord('A') + INDEX_HEADER.index(name))}{at}", "values": [[value]]} for name, value in fields.items()]
+            self.index_sheet().batch_update(data, value_input_option='RAW')
+
+    # --- イベント ---
+    def create_event(self, title, poll=None):
+        """新しいイベントのシートを作って一覧に載せ、イベントIDを返す"""
+        poll = poll or Poll(title)
+        with self._lock:
+            index = self.index_sheet()
+            while True:
+                event_id = secrets.token_urlsafe(8)
+                if valid_event_id(event_id):
+                    break
+            ws = self.sh.add_worksheet(title=event_id, rows="100", cols=str(schedule_sheet_store.VOTER_COLUMNS))
+            schedule_sheet_store.save_all(ws, poll)
+            index.append_row([event_id, poll.title, STATUS_OPEN, _now()], value_input_option='RAW')
+            self._worksheets[event_id] = ws
+            self._touched[event_id] = time.monotonic()
+            self._missing.pop(event_id, None)
+        return event_id
+
+    def open_event(self, event_id):
+        """一覧に載っているイベントのワークシートだけを開く。無い ID なら None"""
+        if not valid_event_id(event_id):
+            return None
+        with self._lock:
+            ws = self._worksheets.get(event_id)
+            if ws is not None:
+                return ws
+            now = time.monotonic()
+            if now - self._missing.get(event_id, -MISS_RECHECK_SECONDS) < MISS_RECHECK_SECONDS:
+                return None
+            try:
+                if self._find_row(event_id) is None:
+                    raise WorksheetNotFound(event_id)
+                ws = self._worksheets[event_id] = self.sh.worksheet(event_id)
+            except WorksheetNotFound:
+                self._missing.pop(event_id, None)
+                self._missing[event_id] = now
+                if len(self._missing) > MAX_MISSES:
+                    del self._missing[next(iter(self._missing))]
+                return None
+            self._missing.pop(event_id, None)
+            return ws
+
+    def touch(self, event_id, title=None, force=False):
+        """一覧の更新日時（タイトルが変わった時はタイトルも）を書く。投票では間隔をあけて間引く"""
+        now = time.monotonic()
+        with self._lock:
+            if not force and title is None and now - self._touched.get(event_id, -TOUCH_INTERVAL_SECONDS) < TOUCH_INTERVAL_SECONDS:
+                return False
+            self._touched[event_id] = now
+        fields = {"更新日時": _now()}
+        if title is not None:
+            fields["タイトル"] = title
+        self._update_row(event_id, fields)
+        return True
+
+    def set_status(self, event_id, status):
+        """アーカイブ / 募集中に戻す。イベントのシートは開かない"""
+        self._update_row(event_id, {"状態": status, "更新日時": _now()})
+
+
+if __name__ == "__main__":
+    import os
+    os.environ.setdefault('GSHEET_EMULATOR_LATENCY', '0')
+    import gsheet_emulator
+
+    # 以前の1件だけのシートを取り込み、イベントを増やしてアーカイブする。一覧の表示は一覧シートだけを読む
+    client = gsheet_emulator.EmulatorClient(latency=0)
+    sh = client.open_by_key('events')
+    old = Poll("以前のイベント")
+    old.set_dates(["3/14(土) 19:00〜"])
+    old.apply_vote_changes("A", {"3/14(土) 19:00〜": 3}, {})
+    schedule_sheet_store.save_all(sh.sheet1, old)
+
+    index = EventIndex(sh)
+    imported = index.list_events()
+    assert [e["タイトル"] for e in imported] == ["以前のイベント"]
+    assert schedule_sheet_store.load_poll(index.open_event(imported[0]["ID"])).answers("A") == {"3/14(土) 19:00〜": 3}
+
+    ids = [index.create_event(f"イベント{i}") for i in range(30)]
+    index.set_status(ids[0], STATUS_ARCHIVED)
+    index.touch(ids[1], title="名前を変えたイベント")
+
+    client.reset_stats()
+    fresh = EventIndex(sh)
+    listed = fresh.list_events()
+    assert len(listed) == 30 and ids[0] not in {e["ID"] for e in listed}
+    assert len(fresh.list_events(include_archived=True)) == 31
+    assert "名前を変えたイベント" in {e["タイトル"] for e in listed}
+    list_reads = dict(client.stats)
+
+    client.reset_stats()
+    ws = fresh.open_event(ids[5])
+    poll = schedule_sheet_store.load_poll(ws)
+    open_reads = dict(client.stats)
+    assert poll.title == "イベント5" and fresh.open_event("nonexistent") is None
+    # 一覧に無いシート（以前の1件だけの運用の最初のシート）は ID として開けない
+    assert fresh.open_event(sh.sheet1.title) is None
+    # 見つからなかった ID は覚えておき、開き直しても一覧もシートも読まない
+    before = dict(client.stats)
+    assert all(fresh.open_event("nonexistent") is None for _ in range(10))
+    assert dict(client.stats) == before
+    print(f"イベント {len(ids) + 1}件 / 一覧の表示: {list_reads} / 1件を開く: {open_reads}")
@@ -0,0 +1,650 @@
+import json
+import time
+import random
+import copy
+import atexit
+import base64
+import weakref
+import threading
+from collections import Counter
+from schedule_poll import Poll
+
+# ==========================================
+# 日程調整データのシート配置（1行目にイベント情報、2行目から投票者1人1行）
+# ==========================================
+# 以前は A1 の1セルにイベント全体の JSON を入れていたため、投票のたびに全員分を読み書きし、
+# 1セル 50,000 文字の上限で大きな投票は保存できなかった。今は次の配置にして、投票はその人の行だけを書く。
+#   1行目 : "#schedule" | イベント情報 {"version", "title", "next_id", "dates", "slots"}（schedule_poll の保存形式） | 版 | 更新回数
+#   2行目〜: 名前 | 回答済みの印（"0x.."、古い行は回答済みの候補日ID数） | 回答（2bit 詰めの base64） | 備考 {"候補日ID": コメント} | 行の版
+# A1 が "{" で始まる旧形式は、最初に読んだ時に一度だけこの配置に書き換える。
+#
+# C1 の「版」はイベント情報（タイトル・候補日）を書くたびに、各行の「行の版」はその人の行を書くたびに1つ上がる。
+# 投票は「読んだ時の 版 と 自分の行の版 のままなら書く」（比較して交換）。他の人の投票とはぶつからず、
+# 候補日の編集や同じ人の別の画面からの投票と重なった時だけ、読み直して自分の変更を重ね直し、間をあけて再試行する。
+# タイトル・候補日の書き込みも「画面で読んだ時の 版 のままなら書く」。変わっていれば書かずに VersionConflict にする
+# （候補日の一覧は丸ごと置き換えるので、投票のように重ね直すことはできない）。
+# Sheets API には条件付きの書き込みが無いので、比較から書き込みまではロック（_sheet_lock）で1つずつ行う。
+# このロックはプロセスの中でしか効かない。比較が守られるのは Streamlit サーバーが1プロセスで全セッションを
+# 動かしている時だけで、サーバーを複数台・複数プロセスに増やした構成では、比較と書き込みの間に
+# 別プロセスの書き込みが入って上書きしうるので安全ではない。新しい投票者の行は、ロックの中で読んだ
+# A列の最後の名前の次の行に書く。
+# 投票で読むのは 1行目 と A列、その人の行だけ（他の人の行は読まない）。
+#
+# D1 の「更新回数」はどの書き込みでも1つ上がる。表示側はこの1セルだけを時々読み、変わった時だけ全体を読み直す。
+#
+# タイトル・候補日の編集は MetaWriteBehind にためて、最後の編集から少し待ってまとめて1回だけ書く。
+#
+# 読み込んだイベント（集計済みの Poll）は EventCache で更新回数ごとに1つだけ持ち、全セッションで共有する。
+# 同時に来た読み込みは1回にまとめるので、見ている人が増えてもシートの読み込み回数は変わらない。
+# 共有の Poll は読むだけにし、書き換える時は editable() で自分用の複製にする。
+
+META_MARKER = '#schedule'
+VOTER_COLUMNS = 5
+MAX_ATTEMPTS = 8
+BASE_DELAY = 0.1
+MAX_DELAY = 2.0
+SAVE_DELAY = 2.0
+
+# シート（ブックID, シートID）ごとのロック。誰も使っていないロックは消える
+_locks = weakref.WeakValueDictionary()
+_locks_guard = threading.Lock()
+_metrics = Counter()
+
+
+class VersionConflict(Exception):
+    """再試行しても、読んだ版のまま書き込めなかった"""
+
+
+def metrics():
+    with _locks_guard:
+        return dict(_metrics)
+
+
+def _count(name, n=1):
+    with _locks_guard:
+        _metrics[name] += n
+
+
+class _SheetLock:
+    """with で使うロック（threading.Lock は弱参照できないので包む）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self._lock.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self._lock.release()
+
+
+def _sheet_lock(ws):
+    # gspread はシートを開くたびに別のオブジェクトを返すので、オブジェクトではなくシートの ID で引く
+    key = (ws.spreadsheet_id, ws.id)
+    with _locks_guard:
+        lock = _locks.get(key)
+        if lock is None:
+            lock = _locks[key] = _SheetLock()
+        return lock
+
+
+def _dumps(value):
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+
+
+def meta_json(poll):
+    raw = poll.to_dict()
+    del raw["votes"], raw["comments"]
+    return _dumps(raw)
+
+
+def meta_row(poll, version, revision):
+    """1行目 [目印, イベント情報JSON, 版, 更新回数]"""
+    return [META_MARKER, meta_json(poll), version, revision]
+
+
+def voter_row(poll, user, row_version):
+    """1人分の行 [名前, 回答済みの印, base64, 備考JSON, 行の版]"""
+    answered, packed = poll.votes[user]
+    comments = poll.comments.get(user)
+    return [user, hex(answered), base64.b64encode(packed).decode('ascii'),
+            _dumps({str(i): c for i, c in comments.items()}) if comments else "", row_version]
+
+
+def _int(value):
+    return int(value) if value not in (None, "") else 0
+
+
+def voter_positions(names, row_versions):
+    """A列・E列の値から {名前: (行番号, 行の版)} を作る。同じ人の行が重なった時は下の行（後から書いた方）を使う"""
+    positions = {}
+    for at, name in enumerate(names[1:], start=2):
+        if name:
+            positions[name] = (at, _int(row_versions[at - 1]) if at <= len(row_versions) else 0)
+    return positions
+
+
+def _voter_row_no(names, user):
+    """A列の値からその人の行番号を返す（無ければ None）。voter_positions と同じく下の行を使う"""
+    for at in range(len(names), 1, -1):
+        if names[at - 1] == user:
+            return at
+    return None
+
+
+def _column(values):
+    return [line[0] if line else "" for line in values]
+
+
+def parse_rows(values):
+    """get_all_values() の結果を (種類, Poll, 版, 更新回数, {名前: (行番号, 行の版)}) にする。種類は 'empty' / 'legacy' / 'rows'"""
+    if not values or not values[0] or not values[0][0]:
+        return 'empty', Poll(), 0, 0, {}
+    head = values[0][0]
+    if head.startswith('{'):
+        return 'legacy', Poll.from_dict(json.loads(head)), 0, 0, {}
+    if head != META_MARKER:
+        raise ValueError(f"日程調整のシートではありません (A1: {head[:20]!r})")
+    raw = json.loads(values[0][1])
+    first = values[0] + [""] * (4 - len(values[0]))
+    version, revision = _int(first[2]), _int(first[3])
+    lines = [line + [""] * (VOTER_COLUMNS - len(line)) for line in values]
+    positions = voter_positions([line[0] for line in lines], [line[4] for line in lines])
+    raw["votes"], raw["comments"] = {}, {}
+    for user, (at, _) in positions.items():
+        _, answered, packed, comments, _ = lines[at - 1][:VOTER_COLUMNS]
+        raw["votes"][user] = [answered, packed]
+        if comments:
+            raw["comments"][user] = json.loads(comments)
+    return 'rows', Poll.from_dict(raw), version, revision, positions
+
+
+def load_snapshot(ws):
+    """(Poll, 版, 更新回数, {名前: (行番号, 行の版)}) を読む。旧形式ならこの時に行ごとの配置へ書き換える"""
+    kind, poll, version, revision, positions = parse_rows(ws.get_all_values())
+    if kind == 'legacy':
+        save_all(ws, poll)
+        return load_snapshot(ws)
+    return poll, version, revision, positions
+
+
+def load_poll(ws):
+    return load_snapshot(ws)[0]
+
+
+def read_revision(ws):
+    """更新回数（D1）だけを読む。変わっていなければ読み直す必要はない"""
+    return _int(ws.acell('D1').value)
+
+
+def _head(values):
+    line = (values[0] if values else []) + ["", ""]
+    return _int(line[0]), _int(line[1])
+
+
+def _read_head(ws):
+    # 比較はロックの中だけで使う読み方にする（他の場所の読み込みと相乗りして古い値を掴まないように）
+    return _head(ws.get('C1:D1'))
+
+
+def save_all(ws, poll):
+    """全体を書き直す（旧形式からの移行と、候補日を作り直して投票を消した時）。
+    (書く前の更新回数, 書いた後の更新回数, 書いた後の版) を返す
+
+    消してから書くと、書き込みに失敗した時にシートが空になる（旧形式なら唯一の JSON が消える）。
+    今ある行の上に1回の update で上書きし、新しい行数を超える古い行も同じ呼び出しで空白にするので、
+    失敗した時はシートが書く前のまま残る。
+    """
+    with _sheet_lock(ws):
+        head, names = ws.batch_get(['C1:D1', 'A:A'])
+        version, revision = _head(head)
+        rows = [meta_row(poll, version + 1, revision + 1)] + [voter_row(poll, user, 1) for user in poll.users]
+        rows = [row + [""] * (VOTER_COLUMNS - len(row)) for row in rows]
+        rows += [[""] * VOTER_COLUMNS for _ in range(len(names) - len(rows))]
+        ws.update(range_name='A1', values=rows, value_input_option='RAW')
+    return revision, revision + 1, version + 1
+
+
+def save_meta(ws, poll, version):
+    """タイトル・候補日の変更。投票者の行はそのまま（候補日IDが変わらないので回答も有効なまま）。
+    version は poll を読んだ時の版。他で書き換えられていたら VersionConflict"""
+    return _write_meta(ws, meta_json(poll), version)
+
+
+def _write_meta(ws, meta, version):
+    """(書く前の更新回数, 書いた後の更新回数, 書いた後の版) を返す"""
+    with _sheet_lock(ws):
+        current_version, revision = _read_head(ws)
+        if current_version != version:
+            raise VersionConflict(f"読んだ後にタイトル・候補日が変更されています（版 {version} → {current_version}）")
+        ws.update(range_name='A1', values=[[META_MARKER, meta, version + 1, revision + 1]], value_input_option='RAW')
+    return revision, revision + 1, version + 1
+
+
+class MetaWriteBehind:
+    """タイトル・候補日の編集をためておき、最後の編集から delay 秒たったら最新の内容を1回だけ書く。
+    タイマーは画面とは別のスレッドで動くので、タブを閉じても書き込まれる（プロセス終了時は残りを書いてから終わる）。
+    version は画面で読んだイベントの版。書くたびに進み、読み直した時は rebase() で合わせる"""
+
+    def __init__(self, ws, version, delay=SAVE_DELAY, on_saved=None):
+        self.ws = ws
+        self.version = version
+        self.delay = delay
+        self.on_saved = on_saved  # 書けた後に タイトル を渡して呼ぶ（イベント一覧の更新など）
+        self.status = 'saved'   # 'saved' / 'unsaved' / 'saving' / 'error' / 'conflict'
+        self.error = None
+        self.writes = 0
+        self.edits = 0
+        self._pending = None    # 書く予定の (イベント情報JSON, タイトル)（最後の編集）
+        self._timer = None
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        _writers.add(self)
+
+    def submit(self, poll):
+        """編集を受け付ける。書き込みは待ち時間が延びるだけで、この場では API を呼ばない"""
+        meta = (meta_json(poll), poll.title)
+        with self._lock:
+            self._pending = meta
+            self.edits += 1
+            self.status = 'unsaved'
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = threading.Timer(self.delay, self.flush)
+            self._timer.start()
+
+    def rebase(self, version):
+        """画面で読み直した版に合わせる（書き込み待ちが無い時に読み直すので、ためている編集とはぶつからない）"""
+        with self._lock:
+            self.version = version
+
+    def discard(self):
+        """ためている編集を捨てる（全体を書き直す時など、より新しい内容で上書きする時）"""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+            self._pending, self._timer = None, None
+            if self.status == 'unsaved':
+                self.status = 'saved'
+
+    def flush(self):
+        """ためている編集があれば今すぐ書く"""
+        with self._write_lock:
+            with self._lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                meta, self._pending, self._timer = self._pending, None, None
+                if meta is None:
+                    return
+                self.status = 'saving'
+            try:
+                _, _, version = _write_meta(self.ws, meta[0], self.version)
+            except VersionConflict as e:
+                with self._lock:
+                    # 他の画面で先に変更されていた。上書きせずにこの編集は捨て、読み直してもらう
+                    self.status, self.error = 'conflict', e
+                return
+            except Exception as e:
+                with self._lock:
+                    # 書けなかった内容は、新しい編集が無ければ次の flush で書き直す
+                    if self._pending is None:
+                        self._pending = meta
+                    self.status, self.error = 'error', e
+                return
+            with self._lock:
+                self.version = version
+                self.writes += 1
+                self.error = None
+                self.status = 'unsaved' if self._pending is not None else 'saved'
+            if self.on_saved is not None:
+                try:
+                    self.on_saved(meta[1])
+                except Exception as e:
+                    # イベント情報は書けているので書き直さない（一覧のタイトル・更新日時が次の書き込みまで古いだけ）
+                    print(f"Log: {e}")
+
+    @property
+    def has_pending(self):
+        return self._pending is not None
+
+
+_writers = weakref.WeakSet()
+
+
+class EventCache:
+    """最後に読んだイベントを (更新回数, Poll) で持ち、全セッションで共有する"""
+
+    def __init__(self, ws):
+        self.ws = ws
+        self.revision = None
+        self.version = None
+        self.poll = None
+        self.stats = Counter()
+        self._fetching = None       # 読み込み中なら、終わった時に立つ threading.Event
+        self._shared = weakref.WeakSet()
+        self._lock = threading.Lock()
+
+    def _hand_out(self):
+        self._shared.add(self.poll)
+        return self.poll, self.revision, self.version
+
+    def get(self, min_revision=None):
+        """更新回数が min_revision 以上のイベントを (Poll, 更新回数, 版) で返す。足りなければ読み込む（None なら必ず読み込む）"""
+        while True:
+            with self._lock:
+                if self.poll is not None and min_revision is not None and self.revision >= min_revision:
+                    self.stats['hits'] += 1
+                    return self._hand_out()
+                fetching = self._fetching
+                if fetching is None:
+                    fetching = self._fetching = threading.Event()
+                    break
+                self.stats['coalesced'] += 1
+            # 読み込み中の人がいれば、それを待って結果を使う
+            fetching.wait()
+            with self._lock:
+                if self.poll is not None and (min_revision is None or self.revision >= min_revision):
+                    return self._hand_out()
+
+        try:
+            poll, version, revision, _ = load_snapshot(self.ws)
+            with self._lock:
+                self.stats['fetches'] += 1
+                if self.revision is None or revision >= self.revision:
+                    self.poll, self.revision, self.version = poll, revision, version
+                return self._hand_out()
+        finally:
+            with self._lock:
+                self._fetching = None
+            fetching.set()
+
+    def offer(self, poll, revision, version):
+        """書き込んだ直後の内容（更新回数がわかっているもの）を、読み込まずに共有する"""
+        if revision is None:
+            return
+        with self._lock:
+            if self.revision is None or revision > self.revision:
+                self.poll, self.revision, self.version = poll, revision, version
+                self._shared.add(poll)
+
+    def editable(self, poll):
+        """共有している Poll なら自分用の複製を返す（書き換えが他のセッションに見えないように）"""
+        with self._lock:
+            shared = poll in self._shared
+        if not shared:
+            return poll
+        copied = copy.deepcopy(poll)
+        copied.view_cache = {}
+        return copied
+
+
+@atexit.register
+def _flush_writers():
+    for writer in list(_writers):
+        writer.flush()
+
+
+def load_voter(ws, user):
+    """1行目とその人の行だけを読み、(その人の回答だけを持つ Poll, 版, 行番号, 行の版) を返す。行番号は新しい投票者なら None"""
+    meta, names = ws.batch_get(['A1:D1', 'A:A'])
+    first = (meta[0] if meta else []) + [""] * 4
+    if first[0] != META_MARKER:
+        # 旧形式（ここで行ごとの配置に書き換わる）か空のシート
+        poll, version, _, positions = load_snapshot(ws)
+        at, row_version = positions.get(user, (None, 0))
+        return poll, _int(version), at, row_version
+    raw = json.loads(first[1])
+    raw["votes"], raw["comments"] = {}, {}
+    at = _voter_row_no(_column(names), user)
+    row_version = 0
+    if at is not None:
+        line = (ws.get(f'A{at}:E{at}') or [[]])[0]
+        _, answered, packed, comments, row_version = (line + [""] * VOTER_COLUMNS)[:VOTER_COLUMNS]
+        raw["votes"][user] = [answered, packed]
+        if comments:
+            raw["comments"][user] = json.loads(comments)
+    return Poll.from_dict(raw), _int(first[2]), at, _int(row_version)
+
+
+def _commit_vote(ws, row, user, version, at, row_version):
+    """読んだ時の 版 と その人の行（位置・行の版）のままなら、その人の行を書く。変わっていれば VersionConflict"""
+    with _sheet_lock(ws):
+        # 比較に使うセルは1回の読み込みで取る
+        values = ws.batch_get(['C1:D1', 'A:A'] + ([f'E{at}'] if at is not None else []))
+        current_version, revision = _head(values[0])
+        names = _column(values[1])
+        current_row_version = _int(_column(values[2])[0]) if at is not None and values[2] else 0
+        if current_version != version or _voter_row_no(names, user) != at or current_row_version != row_version:
+            raise VersionConflict(user)
+        if at is None:
+            # 新しい投票者は最後の名前の次の行へ（表の行数が足りなければ先に広げる）
+            at = max(len(names), 1) + 1
+            if at > ws.row_count:
+                ws.resize(rows=at)
+        # 行と更新回数は1回の呼び出しでまとめて書く
+        ws.batch_update([
+            {"range": f"A{at}", "values": [row]},
+            {"range": "D1", "values": [[revision + 1]]},
+        ], value_input_option='RAW')
+    return revision, revision + 1
+
+
+def submit_vote(ws, user, score_changes, comment_changes, max_attempts=MAX_ATTEMPTS):
+    """最新の内容に自分の変わったセルだけを重ねて書く。版が変わっていたら読み直して重ね直す。
+    (書く前の更新回数, 書いた後の更新回数, 版, 重ねた (点数の変更, 備考の変更)) を返す。
+    書く前の更新回数が手元で読んだものと同じなら、手元の Poll に同じ変更を重ねたものが最新の内容"""
+    for attempt in range(max_attempts):
+        poll, version, at, row_version = load_voter(ws, user)
+        # 読み直した間に消えた候補日への変更は捨てる
+        labels = set(poll.dates)
+        applied = ({d: s for d, s in score_changes.items() if d in labels},
+                   {d: c for d, c in comment_changes.items() if d in labels})
+        poll.apply_vote_changes(user, *applied)
+        try:
+            before, after = _commit_vote(ws, voter_row(poll, user, row_version + 1), user, version, at, row_version)
+        except VersionConflict:
+            _count('conflicts')
+            # フルジッター付きの指数バックオフ
+            time.sleep(random.uniform(0, min(MAX_DELAY, BASE_DELAY * (2 ** attempt))))
+            continue
+        _count('committed')
+        return before, after, version, applied
+    _count('gave_up')
+    raise VersionConflict(f"{user}さんの投票を {max_attempts} 回試しても保存できませんでした")
+
+
+if __name__ == "__main__":
+    import numpy as np
+    from concurrent.futures import ThreadPoolExecutor
+    import gsheet_emulator
+    from gspread.exceptions import APIError
+
+    # 旧形式（A1 に全体の JSON）からの移行（投票者 300人 × 候補日 120日）
+    rng = np.random.default_rng(0)
+    dates = [f"{1 + d // 28}/{1 + d % 28}(土) 19:00〜" for d in range(120)]
+    legacy = {"title": "移行テスト", "dates": dates, "votes": {}, "comments": {}}
+    for u in range(300):
+        legacy["votes"][f"user{u}"] = {d: int(s) for d, s in zip(dates, rng.integers(0, 4, len(dates)))}
+        legacy["comments"][f"user{u}"] = {d: "遅れます" for d in dates if rng.random() < 0.05}
+    blob = json.dumps(legacy, ensure_ascii=False)
+
+    ws = gsheet_emulator.EmulatorClient(latency=0).open_by_key('bench').sheet1
+    ws.update_acell('A1', blob)
+    t0 = time.perf_counter()
+    poll = load_poll(ws)
+    t1 = time.perf_counter()
+    assert ws.acell('A1').value == META_MARKER
+    for u in range(0, 300, 7):
+        user = f"user{u}"
+        assert poll.answers(user) == legacy["votes"][user]
+        assert poll.user_comments(user) == legacy["comments"][user]
+    largest = max(len(str(v)) for line in ws.get_all_values() for v in line)
+
+    # 移行の書き込みが失敗しても旧形式の JSON は消えず、次に読んだ時にもう一度移行される
+    retry_ws = gsheet_emulator.EmulatorClient(latency=0).open_by_key('retry').sheet1
+    retry_ws.update_acell('A1', blob)
+
+    def unavailable(*args, **kwargs):
+        raise gsheet_emulator._api_error(503, "UNAVAILABLE", "The service is currently unavailable.")
+    retry_ws.update = unavailable
+    try:
+        load_poll(retry_ws)
+        raise AssertionError("書き込みの失敗が伝わっていない")
+    except APIError:
+        pass
+    assert retry_ws.acell('A1').value == blob
+    del retry_ws.update
+    assert load_poll(retry_ws).answers("user0") == legacy["votes"]["user0"]
+    # 投票者が減った書き直しでも、古い行は残らない
+    save_all(retry_ws, Poll("作り直し"))
+    remaining = retry_ws.get_all_values()
+    assert len(remaining) == 1 and remaining[0][:4] == [META_MARKER, meta_json(Poll("作り直し")), "2", "2"]
+    print(f"旧形式の A1: {len(blob):,}文字（上限 50,000） / 新配置の最大セル: {largest:,}文字 / 移行 {(t1 - t0) * 1000:.0f}ms")
+
+    # LINE で一斉に投票が来た時の模擬（API 1回 20〜60ms）: 20人が同時に投票し、半分の人は別の画面からも
+    # 同時に備考を送る。途中で幹事が候補日を1つ足す。全員の回答と備考が残っているかを確かめる
+    dates = [f"3/{d}(土) 19:00〜" for d in range(1, 15)]
+    expected = {}
+    tasks = []
+    for u in range(20):
+        user = f"参加者{u}"
+        answers = {d: int(s) for d, s in zip(dates, rng.integers(0, 4, len(dates)))}
+        comments = {dates[2]: "遅れます"} if u % 2 == 0 else {}
+        expected[user] = (answers, comments)
+        tasks.append((user, answers, {}))
+        if comments:
+            tasks.append((user, {}, comments))
+    tasks.append((None, None, None))
+
+    def burst(vote):
+        client = gsheet_emulator.EmulatorClient(latency=0.02, jitter=0.04, seed=1)
+        sheet = client.open_by_key('burst').sheet1
+        base = Poll("飲み会")
+        base.set_dates(dates)
+        save_all(sheet, base)
+
+        def run(task):
+            user, answers, comments = task
+            if user is None:
+                time.sleep(0.1)
+                organizer, version, _, _ = load_snapshot(sheet)
+                organizer.set_dates(organizer.dates + ["3/15(日) 19:00〜"])
+                save_meta(sheet, organizer, version)
+            else:
+                vote(sheet, user, answers, comments)
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=len(tasks)) as pool:
+            list(pool.map(run, tasks))
+        elapsed = time.perf_counter() - t0
+        final = load_poll(sheet)
+        lost = 0
+        for user, (answers, comments) in expected.items():
+            got = final.answers(user)
+            lost += any(got.get(d) != s for d, s in answers.items()) or final.user_comments(user) != comments
+        return elapsed, lost, read_revision(sheet)
+
+    def blob_read_modify_write(sheet, user, answers, comments):
+        # 以前の「全体を読んで、直して、全体を書く」やり方（版の確認なし）
+        current, version, revision, _ = load_snapshot(sheet)
+        current.apply_vote_changes(user, answers, comments)
+        rows = [meta_row(current, version, revision + 1)] + [voter_row(current, u, 1) for u in current.users]
+        sheet.update(range_name='A1', values=rows, value_input_option='RAW')
+
+    n_votes = len(tasks) - 1
+    elapsed, lost, _ = burst(blob_read_modify_write)
+    print(f"版の確認なし: {n_votes}回の送信 / {elapsed:.2f}s / 投票が欠けた人 {lost}人")
+    elapsed, lost, revision = burst(submit_vote)
+    print(f"版の比較と再試行: {n_votes}回の送信 / {elapsed:.2f}s（{n_votes / elapsed:.0f}回/s） / 投票が欠けた人 {lost}人 / {metrics()}")
+    assert lost == 0
+    # 更新回数は 作成・候補日の追加・投票 の書き込みごとに1つずつ上がっている
+    assert revision == n_votes + 2, revision
+
+    # 投票で読むのは 1行目・A列・その人の行だけ。新しい投票者の行も更新回数と一緒に1回で書き、
+    # 表の行数が足りなければ広げる
+    client = gsheet_emulator.EmulatorClient(latency=0)
+    sheet = client.open_by_key('voter-reads').sheet1
+    crowd = Poll("大人数")
+    crowd.set_dates(dates)
+    for u in range(200):
+        crowd.apply_vote_changes(f"user{u}", {dates[0]: 3}, {})
+    save_all(sheet, crowd)
+    sheet.resize(rows=201)
+    client.reset_stats()
+    before, after, _, applied = submit_vote(sheet, "user5", {dates[1]: 2, "消えた日": 1}, {})
+    assert after == before + 1 and applied == ({dates[1]: 2}, {})
+    submit_vote(sheet, "新人", {dates[2]: 1}, {dates[2]: "遅れます"})
+    vote_stats = dict(client.stats)
+    assert 'get_all_values' not in vote_stats and 'append_row' not in vote_stats, vote_stats
+    assert vote_stats['batch_update'] == 2 and vote_stats['writes'] == 3 and sheet.row_count == 202, vote_stats
+    final = load_poll(sheet)
+    assert final.answers("user5") == {dates[0]: 3, dates[1]: 2} and final.answers("新人") == {dates[2]: 1}
+    assert len(final.users) == 201 and final.user_comments("新人") == {dates[2]: "遅れます"}
+    print(f"投票2回（200人のシート）: 読み込み {vote_stats['reads']}回 / 書き込み {vote_stats['writes']}回 / {vote_stats}")
+
+    # 同じシートを別々に開いたオブジェクトでも同じロックを使い、使い終わったロックは残らない
+    fresh = gsheet_emulator.EmulatorClient(latency=0, fresh_objects=True)
+    first, second = fresh.open_by_key('locks').sheet1, fresh.open_by_key('locks').sheet1
+    assert first is not second and _sheet_lock(first) is _sheet_lock(second)
+    with _sheet_lock(first):
+        assert not _sheet_lock(second)._lock.acquire(blocking=False)
+    assert ('locks', first.id) not in _locks
+
+    # タイトルを1文字ずつ打った時の模擬: 20回の編集が待ち時間のあとの1回の書き込みにまとまる
+    sheet = gsheet_emulator.EmulatorClient(latency=0).open_by_key('typing').sheet1
+    event = Poll("")
+    _, _, version = save_all(sheet, event)
+    writer = MetaWriteBehind(sheet, version, delay=0.2)
+    for ch in "忘年会2026 幹事より日程調整のお願い"[:20]:
+        event.title += ch
+        writer.submit(event)
+        time.sleep(0.01)
+    assert writer.status == 'unsaved' and writer.writes == 0
+    time.sleep(0.5)
+    assert writer.status == 'saved' and load_poll(sheet).title == event.title
+    print(f"タイトルの編集 {writer.edits}回 → 書き込み {writer.writes}回")
+
+    # 同じ版を読んだ2つの画面が候補日を編集: 後から書く方は上書きせずに conflict になる
+    other = MetaWriteBehind(sheet, version, delay=60)
+    other.submit(Poll("別の画面の編集"))
+    other.flush()
+    assert other.status == 'conflict' and isinstance(other.error, VersionConflict)
+    assert load_poll(sheet).title == event.title and not other.has_pending
+    # 読み直して版を合わせれば書ける。続けて編集しても自分の書き込みで進んだ版のまま書ける
+    other.rebase(load_snapshot(sheet)[1])
+    for title in ["読み直して編集", "さらに編集"]:
+        other.submit(Poll(title))
+        other.flush()
+        assert other.status == 'saved' and load_poll(sheet).title == title
+    try:
+        save_meta(sheet, event, version)
+        raise AssertionError("古い版のまま書けてしまった")
+    except VersionConflict:
+        pass
+
+    # 書けた後の通知（一覧の更新）が失敗しても、書けた編集をもう一度書こうとはしない
+    def broken_index(title):
+        raise gsheet_emulator._api_error(503, "UNAVAILABLE", "The service is currently unavailable.")
+    notified = MetaWriteBehind(sheet, load_snapshot(sheet)[1], delay=60, on_saved=broken_index)
+    notified.submit(Poll("通知に失敗"))
+    notified.flush()
+    assert notified.status == 'saved' and notified.writes == 1 and not notified.has_pending
+    assert load_poll(sheet).title == "通知に失敗"
+
+    # 投票リンクを 50人が同時に開いた時の模擬（API 1回 50ms）: 読み込みは1回にまとまる
+    client = gsheet_emulator.EmulatorClient(latency=0.05)
+    sheet = client.open_by_key('viewers').sheet1
+    save_all(sheet, load_poll(ws))
+    cache = EventCache(sheet)
+    client.reset_stats()
+    # D1 は画面側で数秒ごとに1回だけ読んだ値を全員で使う
+    latest = read_revision(sheet)
+    with ThreadPoolExecutor(max_workers=50) as pool:
+        seen = list(pool.map(lambda _: cache.get(latest), range(50)))
+    assert len({id(poll) for poll, _, _ in seen}) == 1
+    # 共有の Poll を書き換える時は複製になり、他の人の画面には影響しない
+    title = seen[0][0].title
+    mine = cache.editable(seen[0][0])
+    mine.title = "自分だけの編集"
+    assert mine is not seen[0][0] and cache.get(seen[0][1])[0].title == title
+    print(f"50人が同時に表示: シートの読み込み {client.stats['get_all_values']}回 / D1 {client.stats['acell']}回 / {dict(cache.stats)}")
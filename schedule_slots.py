@@ -0,0 +1,137 @@
+import datetime
+import numpy as np
+import pandas as pd
+
+# ==========================================
+# 時間帯モード（30分刻みの空き時間グリッド）
+# ==========================================
+# 1日を30分 × 48コマに分け、投票者ごと・日ごとの空き時間を 48bit のビット集合で持つ。
+# 「2時間続けて空いている開始時刻」は、ビット集合を右シフトして AND を重ねるだけで求まる
+# （倍々にシフトするので log(長さ) 回の演算）。全投票者・全日をまとめて uint64 配列で計算する。
+
+SLOTS_PER_DAY = 48
+SLOT_MINUTES = 30
+WEEKDAYS = ["月", "火", "水", "木", "金", "土", "日"]
+
+
+def slot_label(slot):
+    minutes = slot * SLOT_MINUTES
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+
+def duration_label(n_slots):
+    hours, minutes = divmod(n_slots * SLOT_MINUTES, 60)
+    return "".join([f"{hours}時間" if hours else "", f"{minutes}分" if minutes else ""])
+
+
+def day_label(day):
+    d = datetime.date.fromisoformat(day)
+    return f"{d.month}/{d.day}({WEEKDAYS[d.weekday()]})"
+
+
+def window_starts(bits, length):
+    """bits の各ビット s が「s から length コマ連続で立っている」かを表すビット集合を返す（配列のまま計算）"""
+    bits = np.asarray(bits, dtype=np.uint64)
+    span = 1
+    result = bits
+    # result は「s から span コマ連続」。span を倍々に伸ばし、最後に重なりを許して length にそろえる
+    while span * 2 <= length:
+        result = result & (result >> np.uint64(span))
+        span *= 2
+    if span < length:
+        result = result & (result >> np.uint64(length - span))
+    return result
+
+
+class SlotGrid:
+    def __init__(self, days, start_slot=18, end_slot=46):
+        self.days = list(days)          # 'YYYY-MM-DD' の文字列
+        self.start_slot = start_slot    # 表示する最初のコマ（18 = 9:00）
+        self.end_slot = end_slot        # 表示する最後のコマの次（46 = 23:00）
+        self.availability = {}          # 投票者 → [日ごとの 48bit 整数]
+
+    @property
+    def slots(self):
+        return list(range(self.start_slot, self.end_slot))
+
+    # --- 入力表との変換 ---
+    def to_frame(self, voter):
+        """その人の空き時間を 時刻 × 日 の True/False 表にする"""
+        bits = np.asarray(self.availability.get(voter, [0] * len(self.days)), dtype=np.uint64)
+        slots = np.arange(self.start_slot, self.end_slot, dtype=np.uint64)
+        table = ((bits[None, :] >> slots[:, None]) & np.uint64(1)).astype(bool)
+        return pd.DataFrame(table, index=[slot_label(s) for s in self.slots], columns=[day_label(d) for d in self.days])
+
+    def set_from_frame(self, voter, frame):
+        """入力表（時刻 × 日 の True/False）から日ごとのビット集合を作って保存する"""
+        table = frame.to_numpy(dtype=bool, na_value=False)
+        weights = np.uint64(1) << np.arange(self.start_slot, self.end_slot, dtype=np.uint64)
+        bits = (table.astype(np.uint64) * weights[:, None]).sum(axis=0, dtype=np.uint64)
+        self.availability[voter] = [int(b) for b in bits]
+
+    # --- 集計 ---
+    def best_windows(self, length, k=10, min_people=1):
+        """length コマ連続で空いている人が多い時間帯の上位 k 件（同数なら早い日・早い時刻）"""
+        if not self.availability or not self.days:
+            return pd.DataFrame(columns=["日付", "開始", "終了", "人数", "参加できない人"])
+        voters = list(self.availability)
+        bits = np.array([self.availability[v] for v in voters], dtype=np.uint64)  # 投票者 × 日
+        starts = window_starts(bits, length)
+        # 表示範囲からはみ出す開始時刻は落とす
+        last_start = self.end_slot - length
+        slots = np.arange(self.start_slot, max(self.start_slot, last_start + 1), dtype=np.uint64)
+        free = ((starts[:, :, None] >> slots[None, None, :]) & np.uint64(1)).astype(bool)  # 投票者 × 日 × 開始
+        counts = free.sum(axis=0)  # 日 × 開始
+
+        flat = counts.ravel()
+        order = np.lexsort((np.arange(len(flat)), -flat))
+        rows = []
+        for idx in order[:k]:
+            if flat[idx] < min_people:
+                break
+            day, col = divmod(int(idx), len(slots))
+            start = int(slots[col])
+            missing = [voters[v] for v in np.flatnonzero(~free[:, day, col])]
+            rows.append({
+                "日付": day_label(self.days[day]),
+                "開始": slot_label(start),
+                "終了": slot_label(start + length),
+                "人数": int(flat[idx]),
+                "参加できない人": ", ".join(missing),
+            })
+        return pd.DataFrame(rows, columns=["日付", "開始", "終了", "人数", "参加できない人"])
+
+    # --- 保存形式との変換 ---
+    def to_dict(self):
+        return {"days": self.days, "start": self.start_slot, "end": self.end_slot, "availability": self.availability}
+
+    @classmethod
+    def from_dict(cls, raw):
+        grid = cls(raw["days"], raw.get("start", 18), raw.get("end", 46))
+        grid.availability = {v: [int(b) for b in bits] for v, bits in raw.get("availability", {}).items()}
+        return grid
+
+
+if __name__ == "__main__":
+    import time
+
+    # 簡易ベンチマーク: 投票者 100人 × 14日 × 48コマ で「2時間続けて空いている」上位10件
+    rng = np.random.default_rng(0)
+    start = datetime.date(2026, 3, 1)
+    grid = SlotGrid([str(start + datetime.timedelta(days=i)) for i in range(14)], 0, SLOTS_PER_DAY)
+    for v in range(100):
+        free = rng.random((SLOTS_PER_DAY, 14)) < 0.7
+        grid.set_from_frame(f"user{v}", pd.DataFrame(free))
+
+    t0 = time.perf_counter()
+    best = grid.best_windows(4, k=10)
+    t1 = time.perf_counter()
+
+    # 1コマずつ確かめる素朴な数え方と照合する
+    for _, row in best.iterrows():
+        day = [day_label(d) for d in grid.days].index(row["日付"])
+        s = int(row["開始"][:2]) * 2 + int(row["開始"][3:]) // 30
+        naive = sum(all(bits[day] >> t & 1 for t in range(s, s + 4)) for bits in grid.availability.values())
+        assert naive == row["人数"]
+    print(best[["日付", "開始", "終了", "人数"]].head(3).to_string())
+    print(f"上位10件: {(t1 - t0) * 1000:.1f}ms")
@@ -0,0 +1,251 @@
+import os
+import re
+import copy
+import json
+import time
+import atexit
+import secrets
+import threading
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from schedule_poll import Poll
+
+# ==========================================
+# 複数イベントのプロセス内ストア（LRU でディスクに退避）
+# ==========================================
+# イベントは URL の ?event=<ID> で指定し、サーバープロセス全体で共有する。
+# メモリ上のイベントの合計サイズ（概算）が上限を超えたら、最後に使われてから
+# 一番時間のたったイベントから JSON（schedule_poll の保存形式）でディスクに書き出して捨てる。
+# 退避したイベントは次にアクセスされた時に読み込み直す。
+#
+# 共有の Poll は読むだけにする。editing() は複製を渡し、書き換え終わった複製をまるごと差し替えるので、
+# 画面の描画中に別のセッションの投票が入っても、描画中の Poll は途中の状態にならない。
+# イベントは「作成」した時だけ作る（知らない ?event= を開いてもイベントは増えない）。
+# 変更のあるイベントは FLUSH_SECONDS ごとにディスクへ書き出す（プロセスが落ちても失うのはその間の変更だけ）。
+
+STORE_DIR = '.schedule_events'
+DEFAULT_BUDGET_BYTES = int(float(os.environ.get('SCHEDULE_STORE_BUDGET_MB', '64')) * 1024 * 1024)
+FLUSH_SECONDS = float(os.environ.get('SCHEDULE_STORE_FLUSH_SECONDS', '30'))
+EVENT_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{6,32}$')
+
+
+def valid_event_id(event_id):
+    """ファイル名に使うので、英数字と - _ だけの ID に限る"""
+    return bool(event_id) and EVENT_ID_PATTERN.match(event_id) is not None
+
+
+def estimate_size(poll):
+    """イベントがメモリ上で使うおおよそのバイト数"""
+    size = 2048 + poll.next_id * 16
+    size += sum(len(label) * 3 + 120 for label in poll.labels.values())
+    size += sum(len(packed) + len(user) * 3 + 200 for user, (_, packed) in poll.votes.items())
+    size += sum(len(c) * 3 + 150 for cs in poll.comments.values() for c in cs.values())
+    if poll.slot_grid is not None:
+        size += sum(len(v) * 3 + 100 + len(bits) * 40 for v, bits in poll.slot_grid.availability.items())
+    return size
+
+
+class EventStore:
+    def __init__(self, directory=STORE_DIR, budget_bytes=DEFAULT_BUDGET_BYTES):
+        self.directory = directory
+        self.budget_bytes = budget_bytes
+        self._events = OrderedDict()  # イベントID → Poll（末尾ほど最近使われた）
+        self._sizes = {}
+        self._used = 0
+        self._dirty = set()
+        self._event_locks = {}
+        self._editors = Counter()     # イベントID → editing() で使っている・待っている数
+        self._lock = threading.RLock()
+        self.stats = {"loaded": 0, "evicted": 0, "created": 0}
+
+    def _path(self, event_id):
+        return os.path.join(self.directory, f"{event_id}.json")
+
+    def new_event_id(self):
+        with self._lock:
+            while True:
+                event_id = secrets.token_urlsafe(8)
+                if valid_event_id(event_id) and event_id not in self._events and not os.path.exists(self._path(event_id)):
+                    return event_id
+
+    def create_event(self, title=None):
+        """新しいイベントを作ってIDを返す"""
+        with self._lock:
+            event_id = self.new_event_id()
+            poll = Poll() if title is None else Poll(title)
+            self._dirty.add(event_id)
+            self.stats["created"] += 1
+            self._put(event_id, poll)
+            return event_id
+
+    def get(self, event_id):
+        """イベントを返す（読むだけに使う）。退避済みならディスクから読み込み、どこにも無ければ None"""
+        if not valid_event_id(event_id):
+            return None
+        with self._lock:
+            poll = self._events.get(event_id)
+            if poll is not None:
+                self._events.move_to_end(event_id)
+                return poll
+            path = self._path(event_id)
+            if not os.path.exists(path):
+                return None
+            with open(path, encoding='utf-8') as f:
+                poll = Poll.from_dict(json.load(f))
+            self.stats["loaded"] += 1
+            self._put(event_id, poll)
+            return poll
+
+    def _put(self, event_id, poll):
+        self._events[event_id] = poll
+        self._events.move_to_end(event_id)
+        self._resize(event_id, poll)
+        self._evict()
+
+    def _resize(self, event_id, poll):
+        size = estimate_size(poll)
+        self._used += size - self._sizes.get(event_id, 0)
+        self._sizes[event_id] = size
+
+    @contextmanager
+    def editing(self, event_id):
+        """イベントを書き換える時に使う。同じイベントへの同時編集を直列化する。
+        渡すのは複製で、抜けた時に差し替える（途中で例外になった編集は反映しない）"""
+        with self._lock:
+            lock = self._event_locks.setdefault(event_id, threading.Lock())
+            self._editors[event_id] += 1
+        try:
+            with lock:
+                current = self.get(event_id)
+                if current is None:
+                    raise KeyError(event_id)
+                poll = copy.deepcopy(current)
+                poll.view_cache = {}
+                yield poll
+                with self._lock:
+                    self._dirty.add(event_id)
+                    self._put(event_id, poll)
+        finally:
+            with self._lock:
+                self._editors[event_id] -= 1
+                if not self._editors[event_id]:
+                    del self._editors[event_id]
+
+    def memory_bytes(self):
+        with self._lock:
+            return self._used
+
+    def _write(self, event_id, poll):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(event_id)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(poll.to_dict(), f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmp_path, path)
+
+    def _evict(self):
+        """上限を超えている間、古い順にディスクへ書き出して手放す（編集中のイベントと最後の1件は残す）"""
+        skipped = 0
+        while self._used > self.budget_bytes and len(self._events) - skipped > 1:
+            event_id = next(iter(self._events))
+            if self._editors[event_id]:
+                # 編集中・編集待ちのものは一番新しい扱いにして次を見る
+                self._events.move_to_end(event_id)
+                skipped += 1
+                continue
+            poll = self._events.pop(event_id)
+            self._used -= self._sizes.pop(event_id)
+            # 誰も使っていないロックなので、イベントと一緒に手放す
+            self._event_locks.pop(event_id, None)
+            if event_id in self._dirty:
+                self._write(event_id, poll)
+                self._dirty.discard(event_id)
+            self.stats["evicted"] += 1
+
+    def flush(self):
+        """変更のあるイベントをすべてディスクに書き出す（定期的に・終了時）"""
+        with self._lock:
+            for event_id in list(self._dirty):
+                if event_id in self._events:
+                    self._write(event_id, self._events[event_id])
+            self._dirty.clear()
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def _flush_periodically(store, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            store.flush()
+        except Exception as e:
+            print(f"Log: {e}")
+
+
+def get_store():
+    """プロセス全体で1つのストアを返す"""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = EventStore()
+            atexit.register(_store.flush)
+            threading.Thread(target=_flush_periodically, args=(_store, FLUSH_SECONDS), daemon=True).start()
+        return _store
+
+
+if __name__ == "__main__":
+    import time
+    import tempfile
+    import numpy as np
+
+    # 簡易ベンチマーク: 上限 2MB のストアに 2000 イベントを作り、ランダムに開き直す
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        store = EventStore(tmp, budget_bytes=2 * 1024 * 1024)
+        ids = [store.create_event() for _ in range(2000)]
+        t0 = time.perf_counter()
+        for event_id in ids:
+            with store.editing(event_id) as poll:
+                poll.set_dates([f"3/{d}(土) 19:00〜" for d in range(1, 21)])
+                for u in range(int(rng.integers(1, 30))):
+                    poll.apply_vote_changes(f"user{u}", {d: int(rng.integers(0, 4)) for d in poll.dates}, {})
+        t1 = time.perf_counter()
+        for event_id in rng.choice(ids, size=2000):
+            store.get(event_id)
+        t2 = time.perf_counter()
+        print(f"作成 {len(ids)}件: {t1 - t0:.2f}s / ランダムに開く 2000回: {t2 - t1:.2f}s")
+        print(f"メモリ上 {len(store._events)}件 / 概算 {store.memory_bytes() / 1024:,.0f}KB / {store.stats}")
+        # 退避したイベントのロックは残らない
+        assert set(store._event_locks) <= set(store._events) and not store._editors
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = EventStore(tmp)
+        # 知らないIDを開いてもイベントは作られない
+        assert store.get("unknown-event") is None and store.get("../etc") is None
+        assert store.stats["created"] == 0 and not os.listdir(tmp)
+        event_id = store.create_event("飲み会")
+
+        # 描画中の Poll は、別のセッションの編集が終わっても書き換わらない
+        shown = store.get(event_id)
+        with store.editing(event_id) as poll:
+            poll.set_dates(["3/14(土) 19:00〜"])
+            poll.apply_vote_changes("A", {"3/14(土) 19:00〜": 3}, {})
+            assert store.get(event_id) is shown
+        assert shown.dates == [] and not shown.votes
+        assert store.get(event_id).answers("A") == {"3/14(土) 19:00〜": 3}
+        # 途中で失敗した編集は反映しない
+        try:
+            with store.editing(event_id) as poll:
+                poll.title = "途中まで"
+                raise ValueError
+        except ValueError:
+            pass
+        assert store.get(event_id).title == "飲み会"
+
+        # 変更は終了を待たずに定期的に書き出される
+        threading.Thread(target=_flush_periodically, args=(store, 0.05), daemon=True).start()
+        time.sleep(0.3)
+        with open(os.path.join(tmp, f"{event_id}.json"), encoding='utf-8') as f:
+            assert Poll.from_dict(json.load(f)).answers("A") == {"3/14(土) 19:00〜": 3}
@@ -0,0 +1,301 @@
+import copy
+import time
+import random
+import threading
+from collections import Counter
+from gspread.exceptions import APIError
+
+# ==========================================
+# Sheets API 呼び出しの交通整理
+# ==========================================
+# すべての Sheets 呼び出しをここを通して実行する。
+#  - 読み込み/書き込みそれぞれのトークンバケットで分あたりクォータ以内に抑える
+#  - 429 / 5xx は指数バックオフ + ジッターで再試行する。ただし 5xx は「実は書けていた」ことがあるので、
+#    追記（append_row など）のように2回実行すると結果が変わる書き込みは 429 の時だけ再試行する
+#  - 同時に走った同一の読み込みは1回の呼び出しにまとめる（結果は呼び出し側ごとの複製を返す）。
+#    gspread はブック・ワークシートを開くたびに別のオブジェクトを返すので、まとめる単位はオブジェクトではなくシートの ID
+#  - 待たされた・再試行した・まとめた回数を metrics() で見られる
+
+# Google Sheets API の既定クォータ（1ユーザー・1プロジェクトあたり 60回/分）
+READ_PER_MINUTE = 60
+WRITE_PER_MINUTE = 60
+
+READ_METHODS = {"get", "get_all_values", "get_all_records", "acell", "cell", "col_values", "row_values", "batch_get", "worksheets", "get_worksheet", "worksheet", "sheet1"}
+WRITE_METHODS = {"update", "batch_update", "update_acell", "update_cell", "append_row", "append_rows", "clear", "add_worksheet", "del_worksheet", "resize", "update_title"}
+
+# 429 はリクエスト自体が断られているので、どの呼び出しも再試行してよい
+QUOTA_CODE = 429
+SERVER_ERROR_CODES = {500, 502, 503}
+# 同じ内容で2回実行しても結果が変わらない書き込み（5xx でも再試行してよい）
+IDEMPOTENT_WRITE_METHODS = {"update", "batch_update", "update_acell", "update_cell", "clear", "resize", "update_title"}
+
+
+def _error_code(error):
+    code = getattr(error, 'code', None)
+    if code is None and getattr(error, 'response', None) is not None:
+        code = getattr(error.response, 'status_code', None)
+    return code
+
+
+def target_key(target):
+    """同じブック / ワークシートなら、別々に開いたオブジェクトでも同じになるキー"""
+    if hasattr(target, 'spreadsheet_id'):
+        return (target.spreadsheet_id, target.id)
+    return (target.id,)
+
+
+class TokenBucket:
+    """分あたり rate_per_minute 回、最大 capacity 回までの連続呼び出しを許すバケツ"""
+
+    def __init__(self, rate_per_minute, capacity):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """トークンを1つ予約し、足りなければ補充されるまで待つ。待った秒数を返す"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+def _retryable(code, kind, method):
+    if code == QUOTA_CODE:
+        return True
+    return code in SERVER_ERROR_CODES and (kind == 'read' or method in IDEMPOTENT_WRITE_METHODS)
+
+
+def _copy_result(value):
+    # 値のリスト（get_all_values など）だけを複製する。ワークシートのリストはそのまま
+    if isinstance(value, list) and not (value and hasattr(value[0], 'get_all_values')):
+        return copy.deepcopy(value)
+    return value
+
+
+class _InFlight:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.followers = 0
+
+
+class SheetsScheduler:
+    def __init__(self, read_per_minute=READ_PER_MINUTE, write_per_minute=WRITE_PER_MINUTE, burst=10,
+                 max_retries=5, base_delay=1.0, max_delay=32.0):
+        self.read_bucket = TokenBucket(read_per_minute, burst)
+        self.write_bucket = TokenBucket(write_per_minute, burst)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._metrics = Counter()
+
+    def metrics(self):
+        with self._lock:
+            return dict(self._metrics)
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self._metrics[name] += n
+
+    def _execute(self, kind, fn, method=None):
+        bucket = self.read_bucket if kind == 'read' else self.write_bucket
+        attempt = 0
+        while True:
+            waited = bucket.acquire()
+            if waited:
+                self._count('throttled')
+                self._count('throttled_ms', int(waited * 1000))
+            self._count(f'{kind}_calls')
+            try:
+                return fn()
+            except APIError as e:
+                code = _error_code(e)
+                if not _retryable(code, kind, method) or attempt >= self.max_retries:
+                    self._count('failed')
+                    raise
+                if code == QUOTA_CODE:
+                    self._count('quota_errors')
+                # フルジッター付きの指数バックオフ
+                delay = min(self.max_delay, self.base_delay * (2 ** attempt))
+                attempt += 1
+                self._count('retried')
+                time.sleep(random.uniform(0, delay))
+
+    def call(self, kind, fn, key=None, method=None):
+        """kind は 'read' / 'write'。method は呼び出すメソッド名（5xx を再試行してよいかの判定用）。
+        key を渡した読み込みは同時実行中の同じ呼び出しに相乗りする"""
+        if kind != 'read' or key is None:
+            return self._execute(kind, fn, method)
+
+        with self._lock:
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = _InFlight()
+            else:
+                flight.followers += 1
+                self._metrics['coalesced'] += 1
+
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return _copy_result(flight.result)
+
+        try:
+            flight.result = self._execute(kind, fn, method)
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+                shared = flight.followers > 0
+            flight.event.set()
+        # 相乗りした人がいれば、どこかで書き換えられても互いに影響しないよう自分も複製を使う
+        return _copy_result(flight.result) if shared else flight.result
+
+
+class ScheduledProxy:
+    """gspread の Spreadsheet / Worksheet を包み、API を叩くメソッドをスケジューラ経由にする"""
+
+    def __init__(self, target, scheduler):
+        self._target = target
+        self._scheduler = scheduler
+
+    def __getattr__(self, name):
+        target = self._target
+        if name in READ_METHODS and not callable(getattr(type(target), name, None)):
+            # sheet1 のようにプロパティ参照で API を叩くもの
+            return _wrap_result(self._scheduler.call('read', lambda: getattr(target, name), key=(target_key(target), name), method=name), self._scheduler)
+
+        attr = getattr(target, name)
+        if not callable(attr) or (name not in READ_METHODS and name not in WRITE_METHODS):
+            return attr
+
+        def scheduled(*args, **kwargs):
+            if name in READ_METHODS:
+                key = (target_key(target), name, repr(args), repr(sorted(kwargs.items())))
+                result = self._scheduler.call('read', lambda: attr(*args, **kwargs), key=key, method=name)
+            else:
+                result = self._scheduler.call('write', lambda: attr(*args, **kwargs), method=name)
+            return _wrap_result(result, self._scheduler)
+        return scheduled
+
+    def __eq__(self, other):
+        other = getattr(other, '_target', other)
+        return hasattr(other, 'id') and target_key(self._target) == target_key(other)
+
+    def __hash__(self):
+        return hash(target_key(self._target))
+
+
+def _wrap_result(value, scheduler):
+    # 返ってきたワークシート / ブックも包んで、以降の呼び出しも交通整理の対象にする
+    if hasattr(value, 'get_all_values') or hasattr(value, 'worksheets'):
+        return ScheduledProxy(value, scheduler)
+    if isinstance(value, list) and value and hasattr(value[0], 'get_all_values'):
+        return [ScheduledProxy(v, scheduler) for v in value]
+    return value
+
+
+_default_scheduler = None
+_default_lock = threading.Lock()
+
+
+def get_scheduler():
+    """プロセス全体で1つのスケジューラ（クォータはサービスアカウント単位のため）"""
+    global _default_scheduler
+    with _default_lock:
+        if _default_scheduler is None:
+            _default_scheduler = SheetsScheduler()
+        return _default_scheduler
+
+
+def wrap(target):
+    return ScheduledProxy(target, get_scheduler())
+
+
+def open_by_key(client, key):
+    """client.open_by_key もスケジューラ経由で呼び、包んだブックを返す"""
+    scheduler = get_scheduler()
+    sh = scheduler.call('read', lambda: client.open_by_key(key), key=('open_by_key', key))
+    return ScheduledProxy(sh, scheduler)
+
+
+if __name__ == "__main__":
+    import gsheet_emulator
+
+    scheduler = SheetsScheduler(base_delay=0.01, max_delay=0.05)
+
+    def flaky(method, code, applied):
+        """1回目だけ code のエラーを返す。applied なら Sheets 側では書き込みが済んでいる（応答だけが失敗）"""
+        state = {'failed': False}
+
+        def call(*args, **kwargs):
+            if state['failed']:
+                return method(*args, **kwargs)
+            state['failed'] = True
+            if applied:
+                method(*args, **kwargs)
+            raise gsheet_emulator._api_error(code, "UNAVAILABLE" if code != 429 else "RESOURCE_EXHAUSTED", "injected")
+        return call
+
+    ws = gsheet_emulator.EmulatorClient(latency=0).open_by_key("scheduler").sheet1
+    proxy = ScheduledProxy(ws, scheduler)
+
+    # 追記は 5xx では再試行しない（書けていた時に2行になるため）。エラーはそのまま呼び出し側へ
+    ws.append_row = flaky(type(ws).append_row.__get__(ws), 503, applied=True)
+    try:
+        proxy.append_row(["2026-01-01", "食費", "昼ごはん", "現金", 800])
+        raise AssertionError("append_row の 503 が再試行された")
+    except APIError:
+        pass
+    del ws.append_row
+    assert len(ws.get_all_values()) == 1
+
+    # 429 は断られているだけなので追記でも再試行し、1行だけ書かれる
+    ws.append_rows = flaky(type(ws).append_rows.__get__(ws), 429, applied=False)
+    proxy.append_rows([["2026-01-02", "交通費", "電車", "現金", 200]])
+    del ws.append_rows
+    assert len(ws.get_all_values()) == 2
+
+    # 上書き（update）は何度書いても同じなので 5xx でも再試行する
+    ws.update = flaky(type(ws).update.__get__(ws), 503, applied=True)
+    proxy.update(range_name='A1', values=[["2026-01-03", "食費", "夕ごはん", "現金", 1200]])
+    del ws.update
+    assert len(ws.get_all_values()) == 2 and ws.get_all_values()[0][2] == "夕ごはん"
+
+    # 同時に走った同じ読み込みはまとめるが、呼び出し側はそれぞれ別のリストを受け取る。
+    # 本番と同じく、呼び出し側ごとにブックを開き直して別のワークシートのオブジェクトから読む
+    slow_client = gsheet_emulator.EmulatorClient(latency=0.1, fresh_objects=True)
+    slow_client.open_by_key("scheduler").sheet1.append_rows([["a", "b"], ["c", "d"]])
+    sheets = [ScheduledProxy(slow_client.open_by_key("scheduler"), scheduler).sheet1 for _ in range(4)]
+    assert sheets[0]._target is not sheets[1]._target and sheets[0] == sheets[1]
+    before = scheduler.metrics().get('coalesced', 0)
+    results = [None] * len(sheets)
+
+    def read(i):
+        results[i] = sheets[i].get_all_values()
+
+    threads = [threading.Thread(target=read, args=(i,)) for i in range(len(results))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert scheduler.metrics().get('coalesced', 0) > before
+    results[0][0][0] = "書き換え"
+    results[0].append(["追加"])
+    assert all(r == [["a", "b"], ["c", "d"]] for r in results[1:])
+    print(scheduler.metrics())
@@ -1,5 +1,6 @@
 import streamlit as st
 import pandas as pd # 表計算用にpandasを追加
+import warikan_logic
 
 # ==========================================
 # 0. アプリ設定
@@ -25,63 +26,18 @@ def calculate_and_show_warikan():
         st.error("支払いデータがありません。")
         return
 
-    # 集計用変数の初期化
-    # 1. 実際に財布から出した金額
-    paid_totals = {m: 0 for m in data["members"]}
-    # 2. 本来負担すべき金額（飲み食いした分）
-    burden_totals = {m: 0 for m in data["members"]}
-    
-    total_amount = 0
-
     # --- 集計処理 ---
-    for p in data["payments"]:
-        payer = p["payer"]
-        amount = p["amount"]
-        mode = p.get("mode", "equal")
-        
-        total_amount += amount
-        
-        # 支払った額を加算
-        if payer in paid_totals:
-            paid_totals[payer] += amount
-        
-        # 負担額を加算
-        if mode == "equal":
-            # 均等割り
-            targets = p["targets"]
-            if targets:
-                per_person = amount / len(targets)
-                for t in targets:
-                    if t in burden_totals:
-                        burden_totals[t] += per_person
-        
-        elif mode == "custom":
-            # 金額指定
-            details = p["details"]
-            for name, debt in details.items():
-                if name in burden_totals:
-                    burden_totals[name] += debt
+    # 支払い × メンバー の負担行列（warikan_logic.py）。メンバーが変わるまでは同じ行列を使い回し、
+    # 前回の計算から増えた支払いだけを行列に足す
+    matrix = st.session_state.get("warikan_matrix")
+    if matrix is None or matrix.members != data["members"]:
+        matrix = st.session_state.warikan_matrix = warikan_logic.BurdenMatrix(data["members"])
+    # 払った額・本来負担すべき額（円単位、合計は総額と一致）
+    paid, burden, total_amount = matrix.sync(data["payments"]).totals()
+    balances = paid - burden # 収支 (+なら受取、-なら支払)
 
     # --- 途中式（収支表）の作成 ---
-    summary_data = []
-    balances = {} # 精算計算用
-
-    for m in data["members"]:
-        paid = paid_totals[m]       # 払った
-        burden = burden_totals[m]   # 負担すべき
-        balance = paid - burden     # 収支 (+なら受取、-なら支払)
-        
-        balances[m] = balance # 後で精算ロジックに使う
-        
-        summary_data.append({
-            "名前": m,
-            "支払った額": int(paid),
-            "本来の負担額": int(burden),
-            "収支(過不足)": int(balance)
-        })
-
-    # データフレーム作成
-    df_summary = pd.DataFrame(summary_data)
+    df_summary = warikan_logic.summary_frame(data["members"], paid, burden)
     
     # --- 途中式の表示エリア ---
     st.write("---")
@@ -104,37 +60,9 @@ def calculate_and_show_warikan():
     
     st.caption("🟢 緑色(プラス)の人 = 払いすぎているので**もらう側**\n🔴 赤色(マイナス)の人 = 負担額より払っていないので**払う側**")
 
-    # --- 精算最適化ロジック (既存のコードと同様) ---
-    receivers = []
-    payers = []
-
-    for name, val in balances.items():
-        val = int(round(val))
-        if val > 0:
-            receivers.append([name, val])
-        elif val < 0:
-            payers.append([name, -val])
-
-    receivers.sort(key=lambda x: x[1], reverse=True)
-    payers.sort(key=lambda x: x[1], reverse=True)
-
-    results = []
-    r_idx, p_idx = 0, 0
-
-    while r_idx < len(receivers) and p_idx < len(payers):
-        rec_name, rec_val = receivers[r_idx]
-        pay_name, pay_val = payers[p_idx]
-
-        move_amount = min(rec_val, pay_val)
-
-        if move_amount > 0:
-            results.append(f"{rec_name} ← {pay_name} {move_amount}円")
-
-        receivers[r_idx][1] -= move_amount
-        payers[p_idx][1] -= move_amount
-
-        if receivers[r_idx][1] == 0: r_idx += 1
-        if payers[p_idx][1] == 0: p_idx += 1
+    # --- 精算最適化ロジック ---
+    # もらう人・払う人をそれぞれ多い順に並べ、前から順に組み合わせる
+    results = [f"{rec_name} ← {pay_name} {move_amount}円" for rec_name, pay_name, move_amount in warikan_logic.settle(data["members"], balances)]
 
     # --- 最終結果テキストの生成 ---
     st.write("---")
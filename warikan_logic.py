@@ -0,0 +1,256 @@
+from itertools import repeat
+import numpy as np
+import pandas as pd
+
+# ==========================================
+# 割り勘の集計（支払い × メンバー の負担行列）
+# ==========================================
+# 支払いを「どの支払いの・誰が・いくら負担するか」の疎な行列（COO: 行番号・列番号・金額の3本の配列）に
+# まとめ、払った額と負担額はメンバーの列ごとに np.bincount で足し上げる。
+# 変換は支払いのリストを1回なめて平らな配列（列番号・金額・支払いごとの要素数）を作るだけにし、結果は覚えておく。
+# 計算し直す時は、前回と同じ支払い（同じオブジェクト）が続く先頭部分はそのまま使い、その後ろだけを変換して足す
+# （追加なら新しい支払いだけ、途中の削除ならそこから後ろだけ）。
+# 負担額は最後に円単位へそろえる（切り捨て + 端数の大きい順に1円ずつ）ので、全員の負担額の合計は
+# 総額と一致し、収支は整数で合計0になる。
+# 精算は「多くもらう人」と「多く払う人」をそれぞれ多い順に並べ、累積和の区切りを重ねて
+# 前から順に割り当てる（従来の2本のポインタで進める貪欲法と同じ組み合わせになる）。
+
+
+def to_yen(values):
+    """合計を保ったまま円単位にそろえる（切り捨てて、端数の大きい人から1円ずつ足す）"""
+    values = np.asarray(values, dtype=np.float64)
+    floor = np.floor(values)
+    extra = int(round(values.sum() - floor.sum()))
+    # 端数の大きい順（同じならメンバーの登録順）。足し算の順で出る誤差は同じ端数として扱う
+    order = np.lexsort((np.arange(len(values)), -np.round(values - floor, 6)))
+    result = floor.astype(np.int64)
+    result[order[:extra]] += 1
+    return result
+
+
+class BurdenMatrix:
+    def __init__(self, members):
+        self.members = list(members)
+        self.index = {m: i for i, m in enumerate(self.members)}
+        self.payments = []  # 変換済みの支払い。支払いは追加後に書き換えない前提
+        # 変換済みの配列。支払い k の負担は cols / shares の offsets[k]:offsets[k + 1]
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.cols = np.zeros(0, dtype=np.int64)
+        self.shares = np.zeros(0, dtype=np.float64)
+        self.amounts = np.zeros(0, dtype=np.float64)
+        self.payer_idx = np.zeros(0, dtype=np.int64)
+        self._coo = None
+
+    def _flatten(self, payments):
+        """支払いを平らな配列 (列番号, 金額, 支払いごとの要素数, 支払額, 払った人の列番号) にする。メンバーにいない人の分は落とす"""
+        # 均等割りは支払いごとに1人分の金額だけを持ち、金額指定の支払いだけ1人ずつの金額を持つ
+        names, per_person, custom_shares, counts, amounts, payers = [], [], [], [], [], []
+        for p in payments:
+            mode = p.get("mode", "equal")
+            if mode == "equal":
+                targets = p["targets"]
+                names.extend(targets)
+                per_person.append(p["amount"] / len(targets) if targets else 0.0)
+                counts.append(len(targets))
+            elif mode == "custom":
+                details = p["details"]
+                names.extend(details)
+                custom_shares.extend(details.values())
+                per_person.append(np.nan)
+                counts.append(len(details))
+            else:
+                per_person.append(0.0)
+                counts.append(0)
+            amounts.append(p["amount"])
+            payers.append(p["payer"])
+        counts = np.array(counts, dtype=np.int64)
+        shares = np.repeat(np.array(per_person, dtype=np.float64), counts)
+        if custom_shares:
+            shares[np.isnan(shares)] = np.fromiter(custom_shares, dtype=np.float64, count=len(custom_shares))
+        # 名前 → 列番号 は中間のリストを作らずに配列へ直接引く（メンバーにいない人は -1）
+        cols = np.fromiter(map(self.index.get, names, repeat(-1)), dtype=np.int64, count=len(names))
+        known = cols >= 0
+        if not known.all():
+            owner = np.repeat(np.arange(len(counts)), counts)
+            counts = np.bincount(owner[known], minlength=len(counts))
+            cols, shares = cols[known], shares[known]
+        payer_idx = np.fromiter(map(self.index.get, payers, repeat(-1)), dtype=np.int64, count=len(payers))
+        return cols, shares, counts, np.array(amounts, dtype=np.float64), payer_idx
+
+    def sync(self, payments):
+        """今の支払いリストに合わせる。前回から変わっていない先頭部分の後ろだけを変換して足す"""
+        old = self.payments
+        keep = 0
+        limit = min(len(old), len(payments))
+        while keep < limit and old[keep] is payments[keep]:
+            keep += 1
+        if keep == len(old) == len(payments):
+            return self
+        cols, shares, counts, amounts, payers = self._flatten(payments[keep:])
+        end = self.offsets[keep]
+        self.cols = np.concatenate([self.cols[:end], cols])
+        self.shares = np.concatenate([self.shares[:end], shares])
+        self.offsets = np.concatenate([self.offsets[:keep + 1], end + np.cumsum(counts)])
+        self.amounts = np.concatenate([self.amounts[:keep], amounts])
+        self.payer_idx = np.concatenate([self.payer_idx[:keep], payers])
+        self.payments = list(payments)
+        self._coo = None
+        return self
+
+    def coo(self):
+        """支払い × メンバー の負担額を COO 形式 (行, 列, 金額) で返す（次に支払いが変わるまで同じ配列を返す）"""
+        if self._coo is None:
+            rows = np.repeat(np.arange(len(self.payments), dtype=np.int64), np.diff(self.offsets))
+            self._coo = (rows, self.cols, self.shares)
+        return self._coo
+
+    def totals(self):
+        """(払った額, 負担額, 総額) を返す。払った額・負担額はメンバー順の整数（円）配列"""
+        n = len(self.members)
+        known = self.payer_idx >= 0
+        paid = np.bincount(self.payer_idx[known], weights=self.amounts[known], minlength=n)
+        burden = np.bincount(self.cols, weights=self.shares, minlength=n)
+        return to_yen(paid), to_yen(burden), int(round(self.amounts.sum()))
+
+
+def totals(members, payments):
+    return BurdenMatrix(members).sync(payments).totals()
+
+
+def settle(names, balances):
+    """収支（+ならもらう・-なら払う）から [(もらう人, 払う人, 金額), ...] を作る"""
+    names = np.asarray(names, dtype=object)
+    balances = np.asarray(balances, dtype=np.int64)
+    # 多い順（同じなら元の順）に並べる
+    receivers = np.flatnonzero(balances > 0)
+    receivers = receivers[np.argsort(-balances[receivers], kind="stable")]
+    payers = np.flatnonzero(balances < 0)
+    payers = payers[np.argsort(balances[payers], kind="stable")]
+    rec_cum = np.cumsum(balances[receivers])
+    pay_cum = np.cumsum(-balances[payers])
+    if not len(rec_cum) or not len(pay_cum):
+        return []
+
+    # 両方の累積和の区切りを合わせた各区間が1件の送金。区間の中ほどがどの人に入るかで相手を決める
+    end = min(rec_cum[-1], pay_cum[-1])
+    cuts = np.union1d(rec_cum, pay_cum)
+    cuts = cuts[cuts <= end]
+    starts = np.concatenate(([0], cuts[:-1]))
+    amounts = cuts - starts
+    r = np.searchsorted(rec_cum, starts, side="right")
+    p = np.searchsorted(pay_cum, starts, side="right")
+    return [(names[receivers[i]], names[payers[j]], int(a)) for i, j, a in zip(r, p, amounts)]
+
+
+def summary_frame(members, paid, burden):
+    """途中式（収支表）の表"""
+    return pd.DataFrame({
+        "名前": members,
+        "支払った額": paid,
+        "本来の負担額": burden,
+        "収支(過不足)": paid - burden,
+    })
+
+
+if __name__ == "__main__":
+    import time
+
+    def loop_settlement(members, payments):
+        """従来の1件ずつ辞書に足していく集計と精算（照合用）"""
+        paid_totals = {m: 0 for m in members}
+        burden_totals = {m: 0 for m in members}
+        for p in payments:
+            if p["payer"] in paid_totals:
+                paid_totals[p["payer"]] += p["amount"]
+            if p.get("mode", "equal") == "equal":
+                if p["targets"]:
+                    per_person = p["amount"] / len(p["targets"])
+                    for t in p["targets"]:
+                        if t in burden_totals:
+                            burden_totals[t] += per_person
+            elif p.get("mode") == "custom":
+                for name, debt in p["details"].items():
+                    if name in burden_totals:
+                        burden_totals[name] += debt
+        receivers, payers = [], []
+        for m in members:
+            val = int(round(paid_totals[m] - burden_totals[m]))
+            if val > 0:
+                receivers.append([m, val])
+            elif val < 0:
+                payers.append([m, -val])
+        receivers.sort(key=lambda x: x[1], reverse=True)
+        payers.sort(key=lambda x: x[1], reverse=True)
+        results = []
+        r_idx, p_idx = 0, 0
+        while r_idx < len(receivers) and p_idx < len(payers):
+            move = min(receivers[r_idx][1], payers[p_idx][1])
+            if move > 0:
+                results.append((receivers[r_idx][0], payers[p_idx][0], move))
+            receivers[r_idx][1] -= move
+            payers[p_idx][1] -= move
+            if receivers[r_idx][1] == 0: r_idx += 1
+            if payers[p_idx][1] == 0: p_idx += 1
+        return paid_totals, burden_totals, results
+
+    def make_payments(rng, members, n, divisible=False):
+        payments = []
+        for _ in range(n):
+            payer = members[rng.integers(len(members))]
+            k = int(rng.integers(2, len(members) + 1))
+            group = [members[i] for i in rng.choice(len(members), size=k, replace=False)]
+            if rng.random() < 0.8:
+                amount = int(rng.integers(1, 200)) * (k if divisible else 100)
+                payments.append({"payer": payer, "amount": amount, "mode": "equal", "targets": group, "details": {}})
+            else:
+                # 金額指定: 何人かは金額を入れ、残りを未入力の人で山分け（UI と同じく小数になりうる）
+                fixed = {m: int(rng.integers(1, 30)) * 100 for m in group[:k // 2]}
+                blank = group[k // 2:]
+                rest = int(rng.integers(0, 50)) * 100 * (len(blank) if divisible else 1)
+                details = dict(fixed, **{m: rest / len(blank) for m in blank})
+                payments.append({"payer": payer, "amount": sum(fixed.values()) + rest, "mode": "custom", "targets": [], "details": details})
+        return payments
+
+    rng = np.random.default_rng(0)
+
+    # 割り切れる金額だけなら、従来の集計と送金リストまで完全に一致する
+    members = [f"m{i}" for i in range(12)]
+    payments = make_payments(rng, members, 300, divisible=True)
+    paid, burden, _ = totals(members, payments)
+    _, _, expected = loop_settlement(members, payments)
+    assert settle(members, paid - burden) == expected
+
+    # 簡易ベンチマーク: メンバー 200人 × 支払い 10,000件
+    members = [f"member{i}" for i in range(200)]
+    payments = make_payments(rng, members, 10_000)
+
+    t0 = time.perf_counter()
+    loop_paid, loop_burden, loop_results = loop_settlement(members, payments)
+    t1 = time.perf_counter()
+    matrix = BurdenMatrix(members).sync(payments[:-1])
+    t2 = time.perf_counter()
+    # 1件追加して計算し直す（画面で「計算する！」を押した時）。変換するのは追加した1件だけ
+    paid, burden, total = matrix.sync(payments).totals()
+    transfers = settle(members, paid - burden)
+    t3 = time.perf_counter()
+
+    # 途中の支払いを消した時は、そこから後ろだけを変換し直して最初から作った時と同じになる
+    removed = payments[:5000] + payments[5001:]
+    matrix.sync(removed)
+    fresh = BurdenMatrix(members).sync(removed)
+    for got, want in zip(matrix.coo() + matrix.totals()[:2], fresh.coo() + fresh.totals()[:2]):
+        assert np.array_equal(got, want)
+    matrix.sync(payments)
+
+    # 払った額は一致、負担額は1円未満の差（円単位にそろえた分）で、合計は総額からメンバー外の分を除いた額
+    assert list(paid) == [loop_paid[m] for m in members]
+    assert np.abs(burden - np.array([loop_burden[m] for m in members])).max() < 1
+    assert burden.sum() == round(sum(loop_burden.values()))
+    # 送金すると全員の収支がちょうど0になる
+    net = dict(zip(members, (paid - burden).tolist()))
+    for rec, pay, amount in transfers:
+        net[rec] -= amount
+        net[pay] += amount
+    assert not any(net.values()) and len(transfers) < len(members)
+    print(f"送金 {len(transfers)}件（従来 {len(loop_results)}件）/ 総額 {total:,}円")
+    print(f"従来のループ: {(t1 - t0) * 1000:.0f}ms / 負担行列の変換（{len(payments) - 1}件）: {(t2 - t1) * 1000:.0f}ms / 1件追加して再計算: {(t3 - t2) * 1000:.1f}ms")